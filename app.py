@@ -2,10 +2,26 @@ import streamlit as st
 from dotenv import load_dotenv
 import os
 import time
-import pandas as pd # <--- 新增：导入 pandas
 
-from openai_utils import get_gpt4o_response, generate_initial_analysis_prompt
-from persistence_utils import save_app_state, load_app_state, STATE_FILE
+from openai_utils import get_gpt4o_response, get_gpt4o_response_stream
+from persistence_utils import STATE_DB_FILE, save_app_state, load_app_state, load_file_details
+from batch_utils import DEFAULT_MAX_CONCURRENCY
+from job_utils import (
+    JOB_POLL_INTERVAL, JOB_STATUS_LABELS, ACTIVE_JOB_STATUSES,
+    start_batch_job, list_jobs, has_active_jobs, drain_job_results,
+    pause_job, resume_job, cancel_job, remove_job,
+)
+from cache_utils import get_cache_stats, clear_response_cache
+from metrics_utils import get_metric_records, summarize_requests, summarize_batches, export_metrics_jsonl, clear_metrics
+from ingest_utils import DEFAULT_EXCEL_OPTIONS, EXCEL_OUTPUT_FORMATS, EXCEL_SAMPLING_MODES, SUPPORTED_FILE_TYPES
+from multifile_processor import load_results
+from content_utils import CONTENT_OWNER_KEY, claim_file_contents, get_file_content, new_content_owner
+from dedup_utils import DEDUP_NEAR_MODES, DEFAULT_DEDUP_OPTIONS
+from search_utils import SEARCH_AVAILABLE, SEARCH_SOURCE_LABELS, search_files
+from history_utils import (
+    DEFAULT_HISTORY_TOKEN_BUDGET, HISTORY_COMPACTION_MODES,
+    build_chat_messages, compact_history, estimate_request_tokens,
+)
 
 # Page config (should be the first Streamlit command)
 st.set_page_config(page_title="批量文件智能处理助手", layout="wide", initial_sidebar_state="expanded")
@@ -15,6 +31,12 @@ load_dotenv() # 在本地开发时仍然有用
 
 # --- Application State Initialization ---
 DEFAULT_USER_INSTRUCTION = "请仔细检查以下文本的翻译质量，评估其准确性、流畅性和文化适应性。如果存在不合理之处，请具体指出并提供修改建议。"
+# 分页显示：每次重新运行只创建当前页的组件，文件数量增加时界面响应时间保持不变
+SIDEBAR_PAGE_SIZE = 50 # 侧边栏文件列表每页的文件数
+OVERVIEW_PAGE_SIZE = 30 # 概览每页的文件数（3 列）
+CHAT_HISTORY_PAGE_SIZE = 20 # 对话历史默认显示最近的消息数，每次“加载更早的消息”再多显示这么多
+CONTENT_PREVIEW_CHARS = 20000 # 文件内容预览的字符数，更长的内容需要点击后才完整显示
+SEARCH_RESULT_LIMIT = 20 # 全文搜索最多显示的文件数
 
 # 获取API密钥的辅助函数 (与上一版本相同，用于云端部署)
 def get_configured_api_key():
@@ -31,13 +53,27 @@ if 'app_initialized' not in st.session_state:
 
     if 'api_key' not in st.session_state: 
         st.session_state.api_key = "" 
+    # 文件内容在进程内按哈希共享，会话持有其 files_data 引用的内容，会话结束时自动释放
+    st.session_state[CONTENT_OWNER_KEY] = new_content_owner()
 
     default_values = {
         'files_data': {},
         'current_view': "main_upload",
         'selected_file_for_chat': None,
         'user_general_instruction': DEFAULT_USER_INSTRUCTION,
-        'confirm_clear_history': False
+        'confirm_clear_history': False,
+        'max_concurrency': DEFAULT_MAX_CONCURRENCY,
+        'excel_output_format': DEFAULT_EXCEL_OPTIONS["output_format"],
+        'excel_max_rows_per_sheet': DEFAULT_EXCEL_OPTIONS["max_rows_per_sheet"],
+        'excel_max_columns': DEFAULT_EXCEL_OPTIONS["max_columns"],
+        'excel_sampling': DEFAULT_EXCEL_OPTIONS["sampling"],
+        'dedup_skip_exact': DEFAULT_DEDUP_OPTIONS["skip_exact"],
+        'dedup_near_mode': DEFAULT_DEDUP_OPTIONS["near_mode"],
+        'dedup_threshold': DEFAULT_DEDUP_OPTIONS["threshold"],
+        'pack_small_files': False,
+        'batch_job_ids': [], # 本会话提交的后台任务（任务表由所有会话共享）
+        'history_token_budget': DEFAULT_HISTORY_TOKEN_BUDGET,
+        'history_compaction_mode': "summarize"
     }
     for key_name, default_value in default_values.items(): 
         if key_name not in st.session_state:
@@ -45,6 +81,126 @@ if 'app_initialized' not in st.session_state:
     
     st.session_state.app_initialized = True
 
+# 每次运行时同步本会话持有的内容：已删除、被覆盖或清空的文件的内容在没有其他会话引用时被释放
+claim_file_contents(st.session_state[CONTENT_OWNER_KEY].id, st.session_state.files_data)
+
+def paginate_filenames(filenames, filter_text, page_size, page_key):
+    """
+    按文件名筛选（不区分大小写）并显示分页控件，返回当前页的文件名。
+
+    参数:
+    - page_key (str): 保存页码的 session_state 键，筛选结果变少时页码会被自动调整。
+
+    返回:
+    - tuple: (当前页的文件名列表, 筛选后的文件总数)
+    """
+    filter_text = filter_text.strip().lower()
+    if filter_text:
+        filenames = [filename for filename in filenames if filter_text in filename.lower()]
+    page_count = max(1, -(-len(filenames) // page_size))
+    if st.session_state.get(page_key, 1) > page_count:
+        st.session_state[page_key] = page_count
+    page = 1
+    if page_count > 1:
+        page = st.number_input(
+            f"页码 (共 {page_count} 页)", min_value=1, max_value=page_count, step=1, key=page_key
+        )
+    return filenames[(page - 1) * page_size:page * page_size], len(filenames)
+
+# --- Background Batch Jobs ---
+def render_batch_jobs(detailed):
+    """
+    显示后台批处理任务的进度与控制按钮，并把新完成的结果存入 files_data。
+
+    detailed 为 True 时额外显示进行中文件的流式输出和已完成文件的列表（主页面），否则只显示进度（侧边栏）。
+    """
+    new_results = {}
+    for job_id in st.session_state.batch_job_ids:
+        new_results.update(drain_job_results(job_id, st.session_state[CONTENT_OWNER_KEY].id))
+    if new_results:
+        st.session_state.files_data.update(new_results)
+        claim_file_contents(st.session_state[CONTENT_OWNER_KEY].id, st.session_state.files_data) # 释放被覆盖的同名文件的内容
+        if 'streamlit_sharing' not in os.environ:
+            save_app_state()
+    # 轮询中的任务全部结束时刷新整个页面，使侧边栏和概览包含全部结果，并停止轮询
+    if st.session_state.get("batch_jobs_polling") and not has_active_jobs(st.session_state.batch_job_ids):
+        st.session_state.batch_jobs_polling = False
+        st.rerun()
+
+    for job in list_jobs(st.session_state.batch_job_ids):
+        job_key = f"{job['id']}_{'main' if detailed else 'sidebar'}"
+        job_active = job["status"] in ACTIVE_JOB_STATUSES
+        with st.container(border=True):
+            st.markdown(
+                f"**批处理任务 {time.strftime('%H:%M:%S', time.localtime(job['created_at']))}** · "
+                f"{JOB_STATUS_LABELS[job['status']]}"
+            )
+            st.progress(
+                job["completed"] / job["total"] if job["total"] else 1.0,
+                text=(
+                    f"已读取 {job['parsed']}/{job['total']}，已完成 {job['completed']}/{job['total']} "
+                    f"(缓存命中 {job['cached']}，重复文件 {job['deduplicated']}，失败 {len(job['failures'])})，进行中 {job['in_flight']}"
+                )
+            )
+            if job["error"]:
+                st.error(f"批处理出错: {job['error']}")
+
+            control_cols = st.columns(2)
+            with control_cols[0]:
+                if job["status"] == "running":
+                    if st.button("⏸️ 暂停", key=f"pause_job_btn_{job_key}", help="不再发出新的请求，进行中的请求会继续完成。"):
+                        pause_job(job["id"])
+                        st.rerun(scope="fragment")
+                elif job["status"] == "paused":
+                    if st.button("▶️ 继续", key=f"resume_job_btn_{job_key}"):
+                        resume_job(job["id"])
+                        st.rerun(scope="fragment")
+            with control_cols[1]:
+                if job["status"] in ("running", "paused"):
+                    if st.button("⏹️ 取消", key=f"cancel_job_btn_{job_key}", help="已完成的结果会保留。"):
+                        cancel_job(job["id"])
+                        st.rerun(scope="fragment")
+                elif not job_active:
+                    if st.button("✖️ 关闭", key=f"remove_job_btn_{job_key}"):
+                        remove_job(job["id"])
+                        st.session_state.batch_job_ids.remove(job["id"])
+                        st.rerun()
+
+            if not detailed:
+                continue
+            if job["partial_responses"]:
+                live_filenames = sorted(job["partial_responses"].keys())
+                num_live_columns = 3
+                for i_live in range(0, len(live_filenames), num_live_columns):
+                    live_cols = st.columns(num_live_columns)
+                    for j_live, live_filename in enumerate(live_filenames[i_live:i_live + num_live_columns]):
+                        with live_cols[j_live]:
+                            with st.container(border=True):
+                                st.markdown(f"**⏳ {live_filename}**")
+                                # 只显示最新的一段，避免长输出反复重绘
+                                st.caption(job["partial_responses"][live_filename][-600:])
+            if job["finished_files"]:
+                with st.expander(f"已完成的文件 ({len(job['finished_files'])})，可立即进入对话"):
+                    for finished_filename in reversed(job["finished_files"][-20:]): # 最近完成的在前
+                        if st.button(f"💬 {finished_filename}", key=f"job_file_btn_{job_key}_{finished_filename}"):
+                            st.session_state.selected_file_for_chat = finished_filename
+                            st.session_state.current_view = "chat_view"
+                            st.rerun()
+            if job["notices"]:
+                with st.expander(f"读取提示 ({len(job['notices'])})"):
+                    for notice_level, notice_text in job["notices"]:
+                        (st.warning if notice_level == "warning" else st.info)(notice_text)
+            if job["failures"]:
+                with st.expander(f"失败的文件 ({len(job['failures'])})"):
+                    for failed_filename, failure in job["failures"].items():
+                        st.caption(f"- {failed_filename}: {failure}")
+
+def render_batch_jobs_fragment(detailed):
+    """有任务在运行时以局部刷新的方式定期重绘任务面板，不影响页面的其余部分。"""
+    st.session_state.batch_jobs_polling = has_active_jobs(st.session_state.batch_job_ids)
+    run_every = JOB_POLL_INTERVAL if st.session_state.batch_jobs_polling else None
+    st.fragment(run_every=run_every)(render_batch_jobs)(detailed)
+
 # --- Sidebar ---
 with st.sidebar:
     st.title("⚙️ 设置与导航")
@@ -55,24 +211,108 @@ with st.sidebar:
         key="api_key" 
     )
 
+    st.number_input(
+        "批量处理最大并发请求数",
+        min_value=1,
+        max_value=32,
+        step=1,
+        key="max_concurrency",
+        help="同时发送给模型的请求数上限。数值越大批量处理越快，但更容易触发API速率限制。"
+    )
+
+    st.number_input(
+        "单次对话请求的token上限",
+        min_value=1000,
+        max_value=128000,
+        step=1000,
+        key="history_token_budget",
+        help="对话时发送给模型的内容（文件内容、首次分析和对话历史）超过此上限时，会压缩较早的对话轮次。"
+    )
+    st.radio(
+        "超出上限时",
+        options=list(HISTORY_COMPACTION_MODES.keys()),
+        format_func=lambda mode: HISTORY_COMPACTION_MODES[mode],
+        key="history_compaction_mode",
+        horizontal=True
+    )
+
     if st.button("🏠 返回主上传/结果页", key="home_btn_sidebar"):
         st.session_state.current_view = "main_upload"
         st.session_state.selected_file_for_chat = None
         st.rerun()
 
+    if st.session_state.current_view != "main_upload": # 主页面显示完整的任务面板
+        render_batch_jobs_fragment(detailed=False)
+
     st.markdown("---")
     st.subheader("当前已处理文件")
     if not st.session_state.files_data:
         st.caption("尚未处理任何文件。")
     else:
+        sidebar_filter = st.text_input("按文件名筛选", key="sidebar_file_filter", placeholder="输入部分文件名")
         sorted_filenames = sorted(list(st.session_state.files_data.keys()))
-        for filename_key_nav in sorted_filenames: 
+        page_filenames, matched_count = paginate_filenames(
+            sorted_filenames, sidebar_filter, SIDEBAR_PAGE_SIZE, "sidebar_file_page"
+        )
+        st.caption(f"共 {matched_count} 个文件" + (f"（已筛选，总数 {len(sorted_filenames)}）" if sidebar_filter.strip() else ""))
+        for filename_key_nav in page_filenames: 
             safe_nav_key = f"nav_btn_sidebar_{filename_key_nav.replace('.', '_').replace(' ', '_')}"
             if st.button(f"📄 {filename_key_nav}", key=safe_nav_key):
                 st.session_state.selected_file_for_chat = filename_key_nav
                 st.session_state.current_view = "chat_view"
                 st.rerun()
     
+    st.markdown("---")
+    cache_stats = get_cache_stats()
+    st.caption(
+        f"响应缓存：命中 {cache_stats['hits']} / 未命中 {cache_stats['misses']}，"
+        f"共 {cache_stats['entries']} 条 ({cache_stats['bytes'] / 1024 / 1024:.1f} MB)"
+    )
+    if st.button("🧹 清空响应缓存", key="clear_cache_btn_sidebar"):
+        clear_response_cache()
+        st.rerun()
+
+    with st.expander("📊 性能统计"):
+        def format_seconds(seconds):
+            return f"{seconds:.2f}s" if seconds is not None else "-"
+
+        request_summary = summarize_requests(get_metric_records("request"))
+        if not request_summary["requests"]:
+            st.caption("尚无请求记录。")
+        else:
+            st.caption(
+                f"请求 {request_summary['requests']} 次 (缓存 {request_summary['cached']}，失败 {request_summary['errors']}，"
+                f"重试 {request_summary['retries']})\n\n"
+                f"延迟 p50 {format_seconds(request_summary['p50_latency'])} / p95 {format_seconds(request_summary['p95_latency'])}，"
+                f"排队 p95 {format_seconds(request_summary['p95_queue_wait'])}，"
+                f"限流等待 p95 {format_seconds(request_summary['p95_throttle_wait'])}\n\n"
+                f"token: 输入 {request_summary['prompt_tokens']} / 输出 {request_summary['completion_tokens']}"
+                + (f"，{request_summary['tokens_per_second']:.1f} 输出tokens/s" if request_summary["tokens_per_second"] else "")
+            )
+        for batch_summary in summarize_batches():
+            st.markdown(
+                f"**批次 {time.strftime('%H:%M:%S', time.localtime(batch_summary['started_at']))}** "
+                f"({batch_summary['completed']}/{batch_summary['files']} 个文件，耗时 {format_seconds(batch_summary['wall_time'])})"
+            )
+            st.caption(
+                f"解析 {batch_summary['bytes_parsed'] / 1024 / 1024:.1f} MB，用时 {format_seconds(batch_summary['parse_time'])}；"
+                f"请求 {batch_summary['requests']} 次 (缓存 {batch_summary['cached']}，失败 {batch_summary['errors']}，"
+                f"重试 {batch_summary['retries']})，p50 {format_seconds(batch_summary['p50_latency'])} / "
+                f"p95 {format_seconds(batch_summary['p95_latency'])}；"
+                f"输出 {batch_summary['completion_tokens']} tokens"
+                + (f"；最慢: {batch_summary['slowest_file']}" if batch_summary["slowest_file"] else "")
+            )
+        st.download_button(
+            "⬇️ 导出记录 (JSONL)",
+            data=export_metrics_jsonl(),
+            file_name="metrics.jsonl",
+            mime="application/x-ndjson",
+            key="export_metrics_btn_sidebar"
+        )
+        if st.button("清空统计", key="clear_metrics_btn_sidebar"):
+            clear_metrics()
+            st.rerun()
+
     st.markdown("---")
     if st.button("💾 保存当前状态 (云端效果有限)", key="save_state_btn_sidebar"):
         if 'streamlit_sharing' not in os.environ: 
@@ -129,132 +369,169 @@ if st.session_state.current_view == "main_upload":
     uploaded_files = st.file_uploader(
         "选择文件进行批量处理 (支持 .txt, .md, .csv, .json, .py, .html, .css, .js, .xls, .xlsx)",
         accept_multiple_files=True,
-        type=['txt', 'md', 'csv', 'json', 'py', 'html', 'css', 'js', 'xls', 'xlsx', 'xlsm'], # 添加 Excel 类型
+        type=SUPPORTED_FILE_TYPES, # 含 Excel 类型
         key="file_uploader_input_main" 
     )
 
+    with st.expander("Excel 读取选项"):
+        st.selectbox(
+            "表格输出格式",
+            options=list(EXCEL_OUTPUT_FORMATS.keys()),
+            format_func=lambda fmt: EXCEL_OUTPUT_FORMATS[fmt],
+            key="excel_output_format",
+            help="CSV/TSV 比 Markdown 表格占用更少的 token。"
+        )
+        excel_col1, excel_col2 = st.columns(2)
+        with excel_col1:
+            st.number_input("每个工作表最多保留行数 (0 表示不限制)", min_value=0, step=500, key="excel_max_rows_per_sheet")
+        with excel_col2:
+            st.number_input("每行最多保留列数 (0 表示不限制)", min_value=0, step=10, key="excel_max_columns")
+        st.radio(
+            "超出行数上限时",
+            options=list(EXCEL_SAMPLING_MODES.keys()),
+            format_func=lambda mode: EXCEL_SAMPLING_MODES[mode],
+            key="excel_sampling",
+            horizontal=True
+        )
+
+    with st.expander("重复文件检测"):
+        st.checkbox(
+            "内容完全相同的文件只分析一次",
+            key="dedup_skip_exact",
+            help="同一批次中转换后文本完全相同的文件（即使文件名不同）直接复用第一个文件的分析结果。"
+        )
+        st.radio(
+            "近似重复的文件",
+            options=list(DEDUP_NEAR_MODES.keys()),
+            format_func=lambda mode: DEDUP_NEAR_MODES[mode],
+            key="dedup_near_mode",
+            horizontal=True,
+            help="如同一文档的不同修订版本。只分析差异时，AI会参考同组代表文件的分析结果，只针对改动部分进行分析。"
+        )
+        st.slider(
+            "近似重复的相似度阈值",
+            min_value=0.5,
+            max_value=0.99,
+            step=0.01,
+            key="dedup_threshold",
+            disabled=st.session_state.dedup_near_mode == "off"
+        )
+
+    st.checkbox(
+        "合并小文件为一次请求 (打包模式)",
+        key="pack_small_files",
+        help="把多个较小的文件（如短文本、JSON、代码文件）放在同一个请求中分析，大幅减少请求数和等待时间。"
+             "每个文件的分析结果和后续对话与单独处理时相同；合并请求的结果无效时会自动改为逐个请求。"
+    )
+
+    bypass_cache = st.checkbox(
+        "本批次跳过响应缓存 (强制重新请求AI)",
+        value=False,
+        key="bypass_cache_checkbox_main",
+        help="默认情况下，相同模型、指令和文件内容的请求会直接复用之前的分析结果。"
+    )
+
     if st.button("🚀 开始处理上传的文件", disabled=not effective_api_key or not uploaded_files, key="process_files_btn_main"):
         if not st.session_state.user_general_instruction.strip():
             st.error("请输入通用的处理指令！")
         else:
-            progress_bar = st.progress(0, text="准备开始处理...")
-            total_files = len(uploaded_files)
-            processing_errors_local = {} 
-
-            for i, uploaded_file in enumerate(uploaded_files):
-                filename = uploaded_file.name
-                file_content_str = "" # 初始化文件内容字符串
-
-                # --- 修改处：添加 Excel 文件处理逻辑 ---
-                if filename.lower().endswith(('.xls', '.xlsx', '.xlsm')):
-                    try:
-                        excel_data = pd.read_excel(uploaded_file, sheet_name=None, engine='openpyxl') # 读取所有工作表
-                        
-                        content_parts = []
-                        if isinstance(excel_data, dict): # 多工作表情况
-                            if not excel_data: # 检查excel_data是否为空字典 (即没有工作表)
-                                content_parts.append(f"--- 文件: {filename} (Excel) ---\n")
-                                content_parts.append("Excel 文件中没有找到工作表。\n\n")
-                            else:
-                                for sheet_name, df in excel_data.items():
-                                    content_parts.append(f"--- 工作表: {sheet_name} (来自文件: {filename}) ---\n")
-                                    if not df.empty:
-                                        # 将DataFrame转换为Markdown表格字符串，更适合LLM阅读
-                                        content_parts.append(df.to_markdown(index=False))
-                                    else:
-                                        content_parts.append("此工作表为空。")
-                                    content_parts.append("\n\n")
-                        else: # 单工作表情况 (pandas 直接返回 DataFrame)
-                            df = excel_data
-                            content_parts.append(f"--- 文件: {filename} (Excel) ---\n")
-                            if not df.empty:
-                                content_parts.append(df.to_markdown(index=False))
-                            else:
-                                content_parts.append("Excel 文件（或其唯一工作表）为空。")
-                            content_parts.append("\n\n")
-
-                        file_content_str = "".join(content_parts)
-                        if not file_content_str.strip():
-                             file_content_str = f"文件 {filename} (Excel) 内容为空或未能提取有效文本。"
-                             st.info(file_content_str)
-
-
-                    except Exception as e:
-                        st.error(f"读取 Excel 文件 {filename} 时发生错误: {e}")
-                        processing_errors_local[filename] = f"Excel 读取错误: {e}"
-                        file_content_str = f"错误：无法读取Excel文件 {filename}。错误信息：{e}" # 提供错误信息给AI
-                        # continue # 可以选择跳过此文件，或者像下面这样继续但发送错误信息
-                
-                else: # 原有的文本文件处理逻辑
-                    try:
-                        file_content_bytes = uploaded_file.getvalue()
-                        try:
-                            file_content_str = file_content_bytes.decode("utf-8")
-                        except UnicodeDecodeError:
-                            try:
-                                file_content_str = file_content_bytes.decode("gbk") # 尝试 GBK
-                            except UnicodeDecodeError:
-                                file_content_str = file_content_bytes.decode("latin-1", errors='replace') # 最后尝试 latin-1
-                                st.warning(f"文件 {filename} 使用UTF-8和GBK解码失败，已尝试latin-1解码。")
-                        if not file_content_str.strip():
-                            file_content_str = f"文件 {filename} 内容为空。"
-                            st.info(file_content_str)
-
-                    except Exception as e:
-                        st.error(f"读取文本文件 {filename} 时发生错误: {e}")
-                        processing_errors_local[filename] = f"文本文件读取错误: {e}"
-                        file_content_str = f"错误：无法读取文本文件 {filename}。错误信息：{e}" # 提供错误信息给AI
-                        # continue
-
-                # --- 文件内容准备完毕 (file_content_str) ---
-
-                progress_text = f"处理中 ({i+1}/{total_files}): {filename} (请求AI分析...)"
-                progress_bar.progress((i + 0.5) / total_files, text=progress_text)
-                
-                # 即使读取出错，也尝试将包含错误信息的内容发给AI，让AI知道哪个文件出错了
-                initial_prompt_content = generate_initial_analysis_prompt(file_content_str, st.session_state.user_general_instruction)
-                messages_for_api = [{"role": "user", "content": initial_prompt_content}]
-                initial_response = get_gpt4o_response(effective_api_key, messages_for_api)
-
-                if initial_response:
-                    st.session_state.files_data[filename] = {
-                        "content_str": file_content_str, # 保存转换后的文本内容或错误信息
-                        "initial_user_prompt_content": initial_prompt_content,
-                        "initial_response": initial_response,
-                        "chat_history": [
-                            {"role": "user", "content": initial_prompt_content}, 
-                            {"role": "assistant", "content": initial_response}
-                        ]
-                    }
-                    if filename not in processing_errors_local: # 如果之前没有记录错误
-                        st.success(f"文件 {filename} 初步分析完成！")
-                    else: # 如果之前读取时就有错误，这里提示一下，但AI还是处理了包含错误信息的内容
-                        st.info(f"文件 {filename} 读取时存在问题，已将包含错误描述的内容发送给AI进行分析。")
-
-                else: # API 调用失败
-                    st.error(f"文件 {filename} 分析失败，未能从API获取回应。")
-                    if filename not in processing_errors_local:
-                        processing_errors_local[filename] = "API无回应或错误"
-                
-                progress_bar.progress((i + 1) / total_files, text=f"已完成: {filename}")
-                time.sleep(0.1) 
-
-            progress_bar.empty()
-            if processing_errors_local: 
-                st.warning("部分文件在预处理或API调用环节遇到问题：")
-                for fname, err_msg in processing_errors_local.items(): 
-                    st.caption(f"- {fname}: {err_msg}")
-            
-            st.session_state.current_view = "file_results" 
-            if 'streamlit_sharing' not in os.environ:
-                save_app_state() 
-            st.rerun() 
+            # 同名文件以最后上传的为准；文件内容在后台任务的解析阶段按需读取
+            file_sources = list({uploaded_file.name: uploaded_file.getvalue for uploaded_file in uploaded_files}.items())
+            excel_options = {
+                "output_format": st.session_state.excel_output_format,
+                "max_rows_per_sheet": st.session_state.excel_max_rows_per_sheet,
+                "max_columns": st.session_state.excel_max_columns,
+                "sampling": st.session_state.excel_sampling,
+            }
+            dedup_options = {
+                "skip_exact": st.session_state.dedup_skip_exact,
+                "near_mode": st.session_state.dedup_near_mode,
+                "threshold": st.session_state.dedup_threshold,
+            }
+            # 在后台运行：切换页面、与已完成的文件对话都不会中断批处理
+            batch_job_id = start_batch_job(
+                effective_api_key,
+                file_sources,
+                st.session_state.user_general_instruction,
+                st.session_state.max_concurrency,
+                bypass_cache=bypass_cache,
+                excel_options=excel_options,
+                dedup_options=dedup_options,
+                pack_small_files=st.session_state.pack_small_files
+            )
+            st.session_state.batch_job_ids.append(batch_job_id)
+            st.rerun()
+
+    render_batch_jobs_fragment(detailed=True)
+
+    with st.expander("📂 导入命令行批处理结果"):
+        st.caption("载入 `python -m multifile_processor run ... --out 目录` 的输出，同名文件会被覆盖。")
+        cli_results_dir = st.text_input("输出目录路径", key="cli_results_dir_input_main")
+        if st.button("导入", disabled=not cli_results_dir.strip(), key="import_cli_results_btn_main"):
+            if not os.path.isdir(cli_results_dir.strip()):
+                st.error(f"找不到目录: {cli_results_dir}")
+            else:
+                imported_files_data = load_results(cli_results_dir.strip())
+                if not imported_files_data:
+                    st.warning("该目录中没有已完成的结果。")
+                else:
+                    st.session_state.files_data.update(imported_files_data)
+                    if 'streamlit_sharing' not in os.environ:
+                        save_app_state()
+                    st.rerun()
 
     st.markdown("---")
     if st.session_state.files_data:
+        # 全文搜索：查询保存状态时增量维护的索引，不遍历 files_data
+        search_query = st.text_input(
+            "🔍 全文搜索", key="full_text_search_query", placeholder="在文件内容、分析结果和对话中搜索，多个关键词用空格分隔"
+        )
+        if search_query.strip():
+            if 'streamlit_sharing' in os.environ:
+                st.caption("当前部署环境不保存应用状态，全文搜索不可用。")
+            elif not SEARCH_AVAILABLE:
+                st.caption("当前Python所带的SQLite不支持FTS5，全文搜索不可用。")
+            else:
+                search_started = time.perf_counter()
+                search_results = [
+                    result for result in search_files(search_query, STATE_DB_FILE, SEARCH_RESULT_LIMIT)
+                    if result["filename"] in st.session_state.files_data
+                ]
+                st.caption(f"找到 {len(search_results)} 个文件（{(time.perf_counter() - search_started) * 1000:.0f} 毫秒）")
+                for result_index, search_result in enumerate(search_results):
+                    with st.container(border=True):
+                        result_cols = st.columns([4, 1])
+                        result_cols[0].markdown(f"**📄 {search_result['filename']}**")
+                        if result_cols[1].button("💬 打开", key=f"search_result_btn_{result_index}"):
+                            st.session_state.selected_file_for_chat = search_result["filename"]
+                            st.session_state.current_view = "chat_view"
+                            st.rerun()
+                        for hit in search_result["hits"]:
+                            st.markdown(f"`{SEARCH_SOURCE_LABELS[hit['source']]}` {hit['snippet']}")
+
         st.subheader("📋 已处理文件概览")
+        duplicate_groups = {} # 代表文件名 -> [重复/相似的文件名]
+        for filename_main, file_data_main in st.session_state.files_data.items():
+            duplicate_of = file_data_main.get("duplicate_of")
+            if duplicate_of and duplicate_of["filename"] in st.session_state.files_data:
+                duplicate_groups.setdefault(duplicate_of["filename"], []).append(filename_main)
+        if duplicate_groups:
+            with st.expander(f"重复/相似文件分组 ({len(duplicate_groups)} 组)"):
+                sorted_representatives = sorted(duplicate_groups)
+                for representative_filename in sorted_representatives[:OVERVIEW_PAGE_SIZE]:
+                    st.markdown(
+                        f"**{representative_filename}**："
+                        + "、".join(sorted(duplicate_groups[representative_filename]))
+                    )
+                if len(sorted_representatives) > OVERVIEW_PAGE_SIZE:
+                    st.caption(f"另有 {len(sorted_representatives) - OVERVIEW_PAGE_SIZE} 组未显示，可在下方按文件名筛选查看。")
+        overview_filter = st.text_input("按文件名筛选", key="overview_file_filter", placeholder="输入部分文件名")
+        sorted_filenames_main, matched_count_main = paginate_filenames(
+            sorted(list(st.session_state.files_data.keys())), overview_filter, OVERVIEW_PAGE_SIZE, "overview_file_page"
+        )
+        if overview_filter.strip():
+            st.caption(f"匹配 {matched_count_main} / {len(st.session_state.files_data)} 个文件")
         num_columns = 3 
-        sorted_filenames_main = sorted(list(st.session_state.files_data.keys()))
         for i in range(0, len(sorted_filenames_main), num_columns):
             cols = st.columns(num_columns)
             for j in range(num_columns):
@@ -265,6 +542,19 @@ if st.session_state.current_view == "main_upload":
                     with cols[j]:
                         with st.container(border=True, key=f"overview_container_{safe_filename_display}"):
                             st.markdown(f"**📄 {filename_main}**")
+                            duplicate_of = file_data_main.get("duplicate_of")
+                            if duplicate_of:
+                                if duplicate_of["kind"] == "exact":
+                                    duplicate_note = f"🔁 与 {duplicate_of['filename']} 内容相同"
+                                else:
+                                    duplicate_note = f"≈ 与 {duplicate_of['filename']} 相似 ({duplicate_of['similarity']:.0%})"
+                                if duplicate_of.get("analysis") == "reused":
+                                    duplicate_note += "，复用其分析"
+                                elif duplicate_of.get("analysis") == "diff":
+                                    duplicate_note += "，只分析了差异"
+                                st.caption(duplicate_note)
+                            elif filename_main in duplicate_groups:
+                                st.caption(f"🗂️ 代表文件，另有 {len(duplicate_groups[filename_main])} 个重复/相似文件")
                             st.caption("初步分析摘要:")
                             with st.expander("查看摘要", expanded=False): 
                                 st.markdown(f"> {file_data_main['initial_response']}")
@@ -287,7 +577,12 @@ elif st.session_state.current_view == "chat_view":
         st.session_state.current_view = "main_upload" 
         st.rerun()
     else:
-        file_data_chat = st.session_state.files_data[filename_chat]
+        # 冷启动时文件只加载了概要，打开对话时再按需加载内容与对话历史
+        file_data_chat = load_file_details(filename_chat)
+        if file_data_chat is None: # 如文件已在其他会话中被删除
+            st.error(f"无法加载文件 '{filename_chat}' 的数据，请返回主页重新选择。")
+            st.session_state.current_view = "main_upload"
+            st.stop()
         safe_filename_chat = filename_chat.replace('.', '_').replace(' ', '_')
         
         effective_api_key_chat = get_configured_api_key()
@@ -296,33 +591,77 @@ elif st.session_state.current_view == "chat_view":
         with st.expander("原始文件内容 (点击展开/折叠)"): 
             # 对于Excel，原始文件内容是转换后的文本，而不是二进制
             # 如果需要显示原始Excel的某种预览，需要更复杂的处理
+            file_content_chat = get_file_content(file_data_chat) or '无内容'
+            show_full_content_key = f"show_full_content_{safe_filename_chat}"
+            # 折叠的 expander 中的内容同样会发送给浏览器，较长的内容默认只显示开头部分
+            content_truncated = (
+                len(file_content_chat) > CONTENT_PREVIEW_CHARS and not st.session_state.get(show_full_content_key)
+            )
             st.text_area(
                 "已处理的文件内容 (文本格式)", 
-                # 注意：file_data_chat['content_str'] 现在可能是Markdown表格字符串
-                # 如果过长，text_area可能会很慢，但对于调试是好的
-                file_data_chat.get('content_str', '无内容'), 
+                # 注意：文件内容现在可能是Markdown表格字符串
+                file_content_chat[:CONTENT_PREVIEW_CHARS] if content_truncated else file_content_chat, 
                 height=300, 
                 disabled=True, 
-                key=f"processed_content_text_{safe_filename_chat}"
+                key=f"processed_content_text_{safe_filename_chat}_{'preview' if content_truncated else 'full'}"
             )
+            if content_truncated:
+                st.caption(f"仅显示前 {CONTENT_PREVIEW_CHARS} 个字符（共 {len(file_content_chat)} 个字符）。")
+                if st.button("显示全部内容", key=f"show_full_content_btn_{safe_filename_chat}"):
+                    st.session_state[show_full_content_key] = True
+                    st.rerun()
+
+        if file_data_chat.get("chunks"):
+            # 超长文件被分块分析，保留各分块的结果供对话中引用 ([块 N])
+            with st.expander(f"分块分析结果 (共 {len(file_data_chat['chunks'])} 块，点击展开/折叠)"):
+                for chunk in file_data_chat["chunks"]:
+                    st.markdown(f"**[块 {chunk['index']}]** (原文第 {chunk['start']}–{chunk['end']} 字符)")
+                    st.markdown(chunk["response"])
         
         st.markdown("---")
         st.markdown("##### 对话历史")
         
         chat_container_height = st.sidebar.slider("调整对话框高度:", 200, 800, 400, 50, key=f"chat_height_slider_chatview_{safe_filename_chat}")
-        with st.container(height=chat_container_height, key=f"chat_display_container_chatview_{safe_filename_chat}"): 
-            for i_msg, message in enumerate(file_data_chat["chat_history"]): 
+        chat_display_container = st.container(height=chat_container_height, key=f"chat_display_container_chatview_{safe_filename_chat}")
+        chat_visible_key = f"chat_visible_messages_{safe_filename_chat}"
+        chat_visible_count = st.session_state.get(chat_visible_key, CHAT_HISTORY_PAGE_SIZE)
+        chat_hidden_count = max(0, len(file_data_chat["chat_history"]) - chat_visible_count)
+        with chat_display_container: 
+            # 只显示最近的消息，较早的消息按需加载
+            if chat_hidden_count:
+                if st.button(f"⬆️ 加载更早的消息 (还有 {chat_hidden_count} 条)", key=f"load_earlier_messages_btn_{safe_filename_chat}"):
+                    st.session_state[chat_visible_key] = chat_visible_count + CHAT_HISTORY_PAGE_SIZE
+                    st.rerun()
+            for i_msg, message in enumerate(file_data_chat["chat_history"][chat_hidden_count:], start=chat_hidden_count): 
                 with st.chat_message(message["role"]): 
                     if message["role"] == "user" and i_msg == 0:
+                        if file_data_chat.get("chunks"):
+                            analysis_note = (
+                                f"(文件较长，已分为 {len(file_data_chat['chunks'])} 块分别分析后合并。"
+                                f"AI已收到各分块的分析结果，合并后的分析见下方AI回复)"
+                            )
+                        elif (file_data_chat.get("duplicate_of") or {}).get("analysis") == "diff":
+                            analysis_note = (
+                                f"(首次分析只对比了本文件与 {file_data_chat['duplicate_of']['filename']} 的差异，结果见下方AI回复。"
+                                f"继续提问时AI会收到本文件转换后的完整文本内容)"
+                            )
+                        else:
+                            analysis_note = "(AI已收到转换后的文件文本内容并进行了首次分析。首次分析结果见下方AI回复)"
                         display_content = (
                             f"用户为文件 '{filename_chat}' 提交了分析请求。\n\n"
                             f"**通用处理指令**:\n{st.session_state.user_general_instruction}\n\n"
-                            f"(AI已收到转换后的文件文本内容并进行了首次分析。首次分析结果见下方AI回复)"
+                            f"{analysis_note}"
                         )
                         st.markdown(display_content)
                     else:
                         st.markdown(message["content"])
         
+        request_estimate = estimate_request_tokens(file_data_chat)
+        st.caption(
+            f"下一次提问约发送 {request_estimate['total']} tokens（其中文件与首次分析 {request_estimate['prefix']} tokens，"
+            f"上限 {st.session_state.history_token_budget}）"
+            + (f"；已压缩较早的 {request_estimate['compacted_messages']} 条消息" if request_estimate["compacted_messages"] else "")
+        )
         user_chat_input = st.chat_input(f"就 '{filename_chat}' 继续提问...", key=f"chat_input_chatview_{safe_filename_chat}")
 
         if user_chat_input:
@@ -330,8 +669,26 @@ elif st.session_state.current_view == "chat_view":
                 st.warning("请输入API密钥后才能发送消息，或确保云端部署已正确配置Secrets。")
             else:
                 file_data_chat["chat_history"].append({"role": "user", "content": user_chat_input})
-                messages_for_api = file_data_chat["chat_history"]
-                ai_response = get_gpt4o_response(effective_api_key_chat, messages_for_api)
+                with st.spinner("对话较长，正在压缩较早的对话..."):
+                    compact_history(
+                        file_data_chat,
+                        st.session_state.history_token_budget,
+                        st.session_state.history_compaction_mode,
+                        summarize_fn=lambda prompt: get_gpt4o_response(
+                            effective_api_key_chat, [{"role": "user", "content": prompt}],
+                            metric_tags={"source": "history_summary", "label": filename_chat}
+                        ),
+                    )
+                # 文件内容与首次分析作为固定前缀原样发送，其后是早期对话摘要和近期对话
+                messages_for_api = build_chat_messages(file_data_chat)
+                with chat_display_container:
+                    with st.chat_message("user"):
+                        st.markdown(user_chat_input)
+                    with st.chat_message("assistant"):
+                        # 逐段显示模型输出，完整内容在流结束后一次性写入对话历史
+                        ai_response = st.write_stream(get_gpt4o_response_stream(
+                            effective_api_key_chat, messages_for_api, metric_tags={"source": "chat", "label": filename_chat}
+                        ))
                 if ai_response:
                     file_data_chat["chat_history"].append({"role": "assistant", "content": ai_response})
                 else:
@@ -0,0 +1,645 @@
+import collections
+import concurrent.futures
+import html
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+
+from cache_utils import get_cached_response, store_cached_response
+from chunking_utils import MAX_SINGLE_REQUEST_TOKENS, CHUNK_TARGET_TOKENS, count_tokens, split_into_chunks
+from content_utils import INITIAL_PROMPT_REF, get_content, make_initial_prompt_ref, store_content
+from dedup_utils import (
+    DEFAULT_DEDUP_OPTIONS, MIN_NEAR_DUPLICATE_CHARS, find_duplicate, make_content_diff, minhash_signature, new_dedup_index,
+)
+from ingest_utils import EXCEL_EXTENSIONS, parse_file
+from metrics_utils import record_metric
+from openai_utils import (
+    MODEL_NAME,
+    PACKED_ANALYSIS_RESPONSE_FORMAT,
+    PRIORITY_BATCH,
+    stream_gpt4o_completion,
+    generate_initial_analysis_prompt,
+    generate_chunk_analysis_prompt,
+    generate_reduce_prompt,
+    generate_diff_analysis_prompt,
+    generate_packed_analysis_prompt,
+)
+
+DEFAULT_MAX_CONCURRENCY = 8
+PARTIAL_UPDATE_INTERVAL = 0.25  # 产出流式中间结果的最短间隔（秒）
+DEFAULT_PARSE_QUEUE_DEPTH = 4  # 解析阶段最多领先请求阶段的文件数
+PARSE_PROCESS_WORKERS = min(4, os.cpu_count() or 1)
+PROCESS_PARSE_MIN_BYTES = 256 * 1024  # 小于此大小的文本文件直接在线程中解码，省去进程间传输开销
+PACK_MAX_FILE_TOKENS = 1500  # 打包模式下，内容不超过此token数的文件才会与其他小文件合并请求
+PACK_TOKEN_BUDGET = 12000  # 一个打包请求中文件内容的token总数上限
+PACK_MAX_FILES = 12  # 一个打包请求最多包含的文件数（回应长度随文件数增长）
+
+_parse_pool = None
+_parse_pool_unavailable = False # 进程池在当前环境中无法工作时改为在线程中解析
+_parse_pool_lock = threading.Lock()
+
+def _get_parse_pool():
+    """获取进程内共享的文件解析进程池（按需创建，在多次批处理之间复用）；不可用时返回None。"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool_unavailable:
+            return None
+        if _parse_pool is None:
+            # 不直接 fork 含有多个线程的 Streamlit 进程
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _parse_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PARSE_PROCESS_WORKERS, mp_context=multiprocessing.get_context(start_method)
+            )
+        return _parse_pool
+
+def _disable_parse_pool():
+    """进程池损坏（如子进程无法启动或崩溃）后关闭它，之后的文件改为在线程中解析。"""
+    global _parse_pool, _parse_pool_unavailable
+    with _parse_pool_lock:
+        broken_pool, _parse_pool = _parse_pool, None
+        _parse_pool_unavailable = True
+    if broken_pool is not None:
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+
+def _parse_error_result(filename, error):
+    return {
+        "filename": filename,
+        "content_str": f"错误：无法读取文件 {filename}。错误信息：{error}", # 提供错误信息给AI
+        "error": f"文件读取错误: {error}",
+        "notices": [],
+        "bytes": 0,
+        "parse_time": 0.0,
+    }
+
+def _parse_and_fingerprint(filename, data, excel_options, fingerprint):
+    """解析文件，并按需计算近似重复检测用的签名（与解析一起在进程池中进行，不占用请求阶段的时间）。"""
+    parsed = parse_file(filename, data, excel_options)
+    if fingerprint and len(parsed["content_str"]) >= MIN_NEAR_DUPLICATE_CHARS:
+        parsed["signature"] = minhash_signature(parsed["content_str"])
+    return parsed
+
+def _start_parse_stage(file_sources, excel_options, queue_depth, stop_event, fingerprint=False):
+    """
+    启动解析阶段：生产者线程依次读取文件字节，把 Excel 和较大的文本文件交给进程池解析，
+    解析结果放入返回的队列。fingerprint 为True时解析结果中另含 "signature"（见 dedup_utils）。
+
+    已读取但尚未被消费者取走的文件数不超过 queue_depth：消费者每取出一个结果，
+    必须调用一次返回的 parse_slots.release()。每个解析结果带有 "queued_at"（放入队列的时间），
+    用于统计解析完成后等待请求阶段的时间。
+
+    返回:
+    - tuple: (parsed_queue, parse_slots)
+    """
+    parsed_queue = queue.Queue()
+    parse_slots = threading.Semaphore(max(1, int(queue_depth)))
+
+    def put_parsed(parsed):
+        parsed["queued_at"] = time.monotonic()
+        parsed_queue.put(parsed)
+
+    def parse_in_thread(filename, data):
+        try:
+            put_parsed(_parse_and_fingerprint(filename, data, excel_options, fingerprint))
+        except Exception as e:
+            put_parsed(_parse_error_result(filename, e))
+
+    def put_process_result(future, filename, data):
+        try:
+            put_parsed(future.result())
+        except concurrent.futures.process.BrokenProcessPool:
+            _disable_parse_pool()
+            threading.Thread(target=parse_in_thread, args=(filename, data), daemon=True).start()
+        except Exception as e:
+            put_parsed(_parse_error_result(filename, e))
+
+    def produce():
+        for filename, load_bytes in file_sources:
+            while not parse_slots.acquire(timeout=PARTIAL_UPDATE_INTERVAL):
+                if stop_event.is_set():
+                    return
+            if stop_event.is_set():
+                return
+            try:
+                data = load_bytes()
+            except Exception as e:
+                put_parsed(_parse_error_result(filename, e))
+                continue
+            parse_pool = None
+            if filename.lower().endswith(EXCEL_EXTENSIONS) or len(data) >= PROCESS_PARSE_MIN_BYTES:
+                parse_pool = _get_parse_pool()
+            if parse_pool is None:
+                parse_in_thread(filename, data)
+                continue
+            try:
+                future = parse_pool.submit(_parse_and_fingerprint, filename, data, excel_options, fingerprint)
+            except Exception: # 进程池已关闭或损坏
+                _disable_parse_pool()
+                parse_in_thread(filename, data)
+                continue
+            future.add_done_callback(
+                lambda f, filename=filename, data=data: put_process_result(f, filename, data)
+            )
+
+    threading.Thread(target=produce, name="file-parse-producer", daemon=True).start()
+    return parsed_queue, parse_slots
+
+def build_file_entry(content_str, user_instruction, initial_response, chunks=None, content_owner_id=None):
+    """
+    构造 st.session_state.files_data 中单个文件的数据结构。
+
+    文件内容只在内容库中保存一份（条目中只记录 content_hash），初始分析请求及 chat_history[0]
+    以引用的形式保存，发送请求时再由 content_utils 重建。
+    chunks 仅在文件被分块分析时提供：[{"index", "start", "end", "response"}]，
+    start/end 为分块在文件内容中的字符位置。
+    content_owner_id 为持有文件内容的持有者（见 content_utils.store_content）。
+    """
+    content_hash = store_content(content_str, content_owner_id) # 转换后的文本内容或错误信息
+    file_entry = {
+        "content_hash": content_hash,
+        "initial_prompt_ref": make_initial_prompt_ref(content_hash, user_instruction, chunked=bool(chunks)),
+        "initial_response": initial_response,
+        "chat_history": [
+            {"role": "user", "prompt_ref": INITIAL_PROMPT_REF},
+            {"role": "assistant", "content": initial_response}
+        ]
+    }
+    if chunks:
+        file_entry["chunks"] = chunks
+    return file_entry
+
+def _reuse_file_entry(file_entry):
+    """为内容完全相同的文件复制一份已有的分析结果（对话历史从首次分析开始）。"""
+    reused_entry = {key: value for key, value in file_entry.items() if key not in ("chat_history", "duplicate_of")}
+    reused_entry["chat_history"] = [dict(message) for message in file_entry["chat_history"][:2]]
+    return reused_entry
+
+def _stream_analysis(
+    api_key, label, prompt, partial_responses, partial_lock, metric_tags, queued_at, stop_event, response_format=None
+):
+    """
+    在工作线程中流式请求一次分析，并把已收到的文本持续写入 partial_responses[label]。
+
+    queued_at 为任务进入待处理队列的时间，用于记录请求开始前的排队时间。
+    stop_event 被设置（批处理被取消或中断）时立即关闭数据流，不再消耗后续的token。
+    response_format 为结构化输出的格式要求（打包请求使用）。
+    """
+    metric_tags = {**metric_tags, "label": label, "queue_wait": time.monotonic() - queued_at}
+    response_parts = []
+    # 缓存已由调用方检查过，这里只需写入新结果
+    for delta_content in stream_gpt4o_completion(
+        api_key, [{"role": "user", "content": prompt}], use_cache=False, metric_tags=metric_tags,
+        priority=PRIORITY_BATCH, response_format=response_format,
+    ):
+        if stop_event.is_set():
+            break
+        response_parts.append(delta_content)
+        with partial_lock:
+            partial_responses[label] = "".join(response_parts)
+    return "".join(response_parts)
+
+def _plan_file_tasks(filename, content_str, user_instruction):
+    """
+    为单个文件生成待执行的请求任务及文件状态。
+
+    能放进一次请求的文件只有一个 "single" 任务；超长文件拆成若干 "map" 任务，
+    全部完成后再追加一个 "reduce" 任务合并结果。
+    任务格式为 (filename, kind, chunk_index, prompt)。
+    """
+    prompt = generate_initial_analysis_prompt(content_str, user_instruction)
+    file_state = {"content_str": content_str, "cached": True, "error": None}
+    if count_tokens(prompt) <= MAX_SINGLE_REQUEST_TOKENS:
+        return file_state, [(filename, "single", None, prompt)]
+
+    chunks = split_into_chunks(content_str, CHUNK_TARGET_TOKENS)
+    file_state["chunks"] = chunks
+    file_state["chunk_responses"] = [None] * len(chunks)
+    file_state["chunks_remaining"] = len(chunks)
+    tasks = [
+        (filename, "map", i, generate_chunk_analysis_prompt(chunk["text"], user_instruction, i + 1, len(chunks)))
+        for i, chunk in enumerate(chunks)
+    ]
+    return file_state, tasks
+
+def _parse_packed_response(response, filenames):
+    """
+    校验打包请求的结构化回应并按文件拆分。
+
+    返回:
+    - dict: 文件名 -> 分析结果，只包含 filenames 中回应有效（非空）的文件；回应不是有效JSON时为空。
+    """
+    try:
+        payload = json.loads(response)
+    except (TypeError, ValueError):
+        return {}
+    items = payload.get("files") if isinstance(payload, dict) else None
+    if not isinstance(items, list):
+        return {}
+    expected_filenames = set(filenames)
+    analyses = {}
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("filename"), str):
+            continue
+        filename = html.unescape(item["filename"])
+        analysis = item.get("analysis")
+        if filename in expected_filenames and filename not in analyses and isinstance(analysis, str) and analysis.strip():
+            analyses[filename] = analysis.strip()
+    return analyses
+
+def _task_label(task, file_states):
+    """生成在进度显示中区分各个请求的标签。"""
+    filename, kind, chunk_index, _ = task
+    if kind == "pack":
+        return f"打包请求 #{filename[1]} ({len(file_states[filename]['pack_files'])} 个文件)"
+    if kind == "map":
+        return f"{filename} [块 {chunk_index + 1}/{len(file_states[filename]['chunks'])}]"
+    if kind == "reduce":
+        return f"{filename} [合并结果]"
+    if kind == "diff":
+        return f"{filename} [对比 {file_states[filename]['duplicate_of']['filename']}]"
+    return filename
+
+def iter_batch_analysis(
+    api_key,
+    file_sources,
+    user_instruction,
+    max_workers=DEFAULT_MAX_CONCURRENCY,
+    bypass_cache=False,
+    excel_options=None,
+    parse_queue_depth=DEFAULT_PARSE_QUEUE_DEPTH,
+    batch_id=None,
+    pause_event=None,
+    cancel_event=None,
+    dedup_options=None,
+    pack_small_files=False,
+    content_owner_id=None,
+):
+    """
+    读取并分析一批文件，按完成顺序逐个产出结果。
+
+    处理分为两个重叠的阶段：解析阶段在后台线程/进程池中解码文本和解析 Excel，
+    请求阶段以有限并发度把解析好的文件发送给模型。只有请求阶段有空闲名额时才取下一个
+    已解析的文件，因此同时驻留内存的文件数受并发数和解析队列深度约束。
+    请求以流式方式进行，等待期间会定期产出进行中请求的部分回应。
+    超出单次请求长度的文件会按自然边界分块并行分析，再合并为一份整体分析。
+    批次内内容完全相同的文件只请求一次；近似重复的文件可以只针对与代表文件的差异进行分析。
+    打包模式下，多个小文件合并为一次结构化输出的请求，回应按文件拆分后与单独分析的结果格式相同；
+    回应无效（或缺少某些文件）时，这些文件改为单独请求。
+
+    参数:
+    - api_key (str): OpenAI API密钥。
+    - file_sources (list): [(文件名, 返回文件原始字节的无参函数)]，文件名不应重复。
+    - user_instruction (str): 通用处理指令。
+    - max_workers (int): 同时进行中的最大请求数。
+    - bypass_cache (bool): 为True时本批次不读取响应缓存，全部重新请求。
+    - excel_options (dict): Excel 读取选项，见 ingest_utils.DEFAULT_EXCEL_OPTIONS。
+    - parse_queue_depth (int): 解析阶段最多领先请求阶段的文件数。
+    - batch_id (str): 本批次的性能记录所带的批次标识，缺省时自动生成。
+    - pause_event (threading.Event): 被设置期间不再发出新的请求（进行中的请求会继续完成）。
+    - cancel_event (threading.Event): 被设置后尽快结束，不再产出后续事件。
+      两者供在后台线程中运行批处理时从其他线程控制（见 job_utils）。
+    - dedup_options (dict): 重复文件检测选项，见 dedup_utils.DEFAULT_DEDUP_OPTIONS。
+    - pack_small_files (bool): 为True时启用打包模式，见 PACK_MAX_FILE_TOKENS 等设置。
+    - content_owner_id (str): 结果引用的内容在放入内容库时即由它持有（见 content_utils.store_content），
+      缺省时由调用方自行持有。
+
+    产出:
+    - dict: 三类事件，均包含 "event", "completed", "in_flight", "total"：
+            - event == "parsed": 另含 "filename", "error", "notices", "parsed"，
+              error 为读取错误（内容仍会连同错误描述发送给AI），notices 为 [(级别, 提示文本)]。
+            - event == "result": 另含 "filename", "file_data", "error", "cached", "duplicate_of"，
+              file_data 为可直接存入 files_data 的数据，失败时为 None 且 error 中包含失败原因；
+              duplicate_of 为 {"filename", "kind", "similarity", "analysis"}（前三项见 dedup_utils.find_duplicate），
+              analysis 为 "reused"（复用代表文件的结果）、"diff"（只分析差异）或 "full"（完整分析）；
+              非重复文件为None，也会记录在 file_data["duplicate_of"] 中。
+            - event == "partial": 另含 "partial_responses"（请求标签 -> 目前已收到的文本）。
+    """
+    total = len(file_sources)
+    if total == 0:
+        return
+
+    dedup_options = {**DEFAULT_DEDUP_OPTIONS, **(dedup_options or {})}
+    batch_id = batch_id or uuid.uuid4().hex[:12]
+    metric_tags = {"source": "batch", "batch_id": batch_id}
+    batch_started_at = time.monotonic()
+    stop_event = threading.Event()
+    parsed_count = 0
+    file_states = {}
+    pending_tasks = collections.deque()
+    task_queued_at = {} # 任务 -> 进入待处理队列的时间
+    cache_checked_files = set() # 安排时已确认单独请求未命中缓存的文件，发送前不再重复查找
+    dedup_index = new_dedup_index()
+    representative_results = {} # 已完成的文件名 -> file_data（失败为None），供其重复文件复用或对比
+    duplicate_waiters = collections.defaultdict(list) # 文件名 -> 等待其结果的重复文件
+    pack_buffer = {"files": [], "tokens": 0} # 尚未发出的打包请求
+    pack_count = 0
+
+    completed = 0
+    in_flight_files = collections.Counter() # 文件名 -> 进行中的请求数
+    partial_responses = {}
+    partial_lock = threading.Lock()
+    future_to_task = {}
+
+    def queue_tasks(tasks, first=False):
+        if first:
+            pending_tasks.extendleft(reversed(tasks))
+        else:
+            pending_tasks.extend(tasks)
+        task_queued_at.update((task, time.monotonic()) for task in tasks)
+
+    def plan_file(filename, content_str, signature=None):
+        """为解析完成的文件安排请求；需要等待代表文件的重复文件暂不安排。返回要立即产出的 result 事件。"""
+        duplicate_of = find_duplicate(dedup_index, filename, content_str, dedup_options, signature)
+        if duplicate_of:
+            duplicate_of["analysis"] = "full" # 安排请求后改为 "reused" 或 "diff"
+        file_states[filename] = {"content_str": content_str, "cached": True, "error": None, "duplicate_of": duplicate_of}
+        if duplicate_of and (
+            (duplicate_of["kind"] == "exact" and dedup_options["skip_exact"])
+            or (duplicate_of["kind"] == "near" and dedup_options["near_mode"] == "diff")
+        ):
+            if duplicate_of["filename"] in representative_results:
+                return plan_duplicate(filename)
+            duplicate_waiters[duplicate_of["filename"]].append(filename)
+            return []
+        return plan_full_analysis(filename)
+
+    def plan_full_analysis(filename):
+        """安排文件的完整分析；打包时可能在这里直接命中缓存。返回要立即产出的 result 事件列表。"""
+        file_state = file_states[filename]
+        planned_state, file_tasks = _plan_file_tasks(filename, file_state["content_str"], user_instruction)
+        file_state.update(planned_state)
+        if pack_small_files and file_tasks[0][1] == "single":
+            content_tokens = count_tokens(file_state["content_str"])
+            if content_tokens <= PACK_MAX_FILE_TOKENS:
+                # 只查找一次缓存：命中时直接完成，未命中时打包，之后（如打包失败改为单独请求时）不再重复查找
+                task = file_tasks[0]
+                cached_response = None if bypass_cache else get_cached_response(MODEL_NAME, [{"role": "user", "content": task[3]}])
+                if cached_response is not None:
+                    record_metric(
+                        "request", model=MODEL_NAME, label=_task_label(task, file_states), wall_time=0.0, cached=True,
+                        **metric_tags,
+                    )
+                    return finish_task(task, cached_response, None, True)
+                cache_checked_files.add(filename)
+                add_to_pack(filename, content_tokens)
+                return []
+        queue_tasks(file_tasks)
+        return []
+
+    def add_to_pack(filename, content_tokens):
+        if pack_buffer["files"] and pack_buffer["tokens"] + content_tokens > PACK_TOKEN_BUDGET:
+            flush_pack()
+        pack_buffer["files"].append(filename)
+        pack_buffer["tokens"] += content_tokens
+        if len(pack_buffer["files"]) >= PACK_MAX_FILES:
+            flush_pack()
+
+    def flush_pack():
+        """把积攒的小文件作为一个打包请求放入待处理队列（只有一个文件时按普通请求发送）。"""
+        nonlocal pack_count
+        pack_files = pack_buffer["files"]
+        if not pack_files:
+            return
+        pack_buffer["files"], pack_buffer["tokens"] = [], 0
+        if len(pack_files) == 1:
+            queue_single_task(pack_files[0])
+            return
+        pack_count += 1
+        pack_key = ("pack", pack_count) # 不会与文件名冲突
+        file_states[pack_key] = {"pack_files": pack_files, "cached": True, "error": None}
+        pack_prompt = generate_packed_analysis_prompt(
+            [(filename, file_states[filename]["content_str"]) for filename in pack_files], user_instruction
+        )
+        queue_tasks([(pack_key, "pack", None, pack_prompt)])
+
+    def queue_single_task(filename):
+        prompt = generate_initial_analysis_prompt(file_states[filename]["content_str"], user_instruction)
+        queue_tasks([(filename, "single", None, prompt)])
+
+    def task_filenames(task):
+        """任务涉及的文件（打包请求为其中的全部文件）。"""
+        return file_states[task[0]]["pack_files"] if task[1] == "pack" else [task[0]]
+
+    def finish_pack(task, response, error, cached):
+        """拆分打包请求的回应；无效或缺失的文件改为单独请求。返回要产出的 result 事件列表。"""
+        pack_state = file_states.pop(task[0])
+        analyses = {} if error else _parse_packed_response(response, pack_state["pack_files"])
+        result_events = []
+        for filename in pack_state["pack_files"]:
+            analysis = analyses.get(filename)
+            if analysis is None:
+                queue_single_task(filename)
+                continue
+            cache_checked_files.discard(filename)
+            file_state = file_states[filename]
+            file_state["cached"] = cached
+            # 对话时以单独分析的请求作为前缀，并写入该请求的缓存，之后重新处理相同文件时直接命中
+            store_cached_response(
+                MODEL_NAME,
+                [{"role": "user", "content": generate_initial_analysis_prompt(file_state["content_str"], user_instruction)}],
+                analysis,
+            )
+            file_data = build_file_entry(file_state["content_str"], user_instruction, analysis, content_owner_id=content_owner_id)
+            result_events.extend(complete_file(filename, file_data))
+        if len(analyses) < len(pack_state["pack_files"]):
+            record_metric(
+                "pack_fallback", files=len(pack_state["pack_files"]), fallback_files=len(pack_state["pack_files"]) - len(analyses),
+                error=error, batch_id=batch_id,
+            )
+        return result_events
+
+    def plan_duplicate(filename):
+        """代表文件已有结果时：完全相同的文件直接复用，近似重复的文件只分析差异；代表文件失败或差异过大时完整分析。"""
+        file_state = file_states[filename]
+        duplicate_of = file_state["duplicate_of"]
+        representative = representative_results[duplicate_of["filename"]]
+        if representative is None:
+            return plan_full_analysis(filename)
+        if duplicate_of["kind"] == "exact":
+            file_state["cached"] = False # 未发送请求，但也不计为缓存命中
+            duplicate_of["analysis"] = "reused"
+            return complete_file(filename, _reuse_file_entry(representative))
+        content_diff = make_content_diff(get_content(representative["content_hash"]), file_state["content_str"])
+        diff_prompt = content_diff and generate_diff_analysis_prompt(
+            duplicate_of["filename"], representative["initial_response"], content_diff, user_instruction
+        )
+        if not diff_prompt or count_tokens(diff_prompt) > MAX_SINGLE_REQUEST_TOKENS:
+            return plan_full_analysis(filename)
+        duplicate_of["analysis"] = "diff"
+        queue_tasks([(filename, "diff", None, diff_prompt)])
+        return []
+
+    def complete_file(filename, file_data):
+        """产出文件的 result 事件，并处理等待该文件结果的重复文件。返回要产出的 result 事件列表。"""
+        nonlocal completed
+        completed += 1
+        file_state = file_states[filename]
+        duplicate_of = file_state.get("duplicate_of")
+        if file_data is not None and duplicate_of:
+            file_data["duplicate_of"] = duplicate_of
+        file_states[filename] = {"finished": True} # 释放该文件的内容，控制内存占用
+        representative_results[filename] = file_data
+        result_events = [{
+            "event": "result",
+            "filename": filename,
+            "file_data": file_data,
+            "error": None if file_data else file_state["error"],
+            "cached": file_state["cached"] and file_data is not None,
+            "duplicate_of": duplicate_of,
+            "completed": completed,
+            "in_flight": len(in_flight_files),
+            "total": total,
+        }]
+        for waiting_filename in duplicate_waiters.pop(filename, []):
+            result_events.extend(plan_duplicate(waiting_filename))
+        return result_events
+
+    def finish_task(task, response, error, cached):
+        """记录一个任务的结果；返回要产出的 result 事件列表（文件尚未全部完成时为空）。"""
+        filename, kind, chunk_index, prompt = task
+        if kind == "pack":
+            return finish_pack(task, response, error, cached)
+        file_state = file_states[filename]
+        if file_state.get("finished"): # 该文件已失败，忽略其余分块的结果
+            return []
+        file_state["cached"] = file_state["cached"] and cached
+        if error or not response:
+            file_state["error"] = error or "API无回应或错误"
+            if kind == "map":
+                file_state["error"] = f"分块 {chunk_index + 1} 分析失败: {file_state['error']}"
+                # 丢弃同一文件尚未开始的分块任务
+                for pending_task in [t for t in pending_tasks if t[0] == filename]:
+                    pending_tasks.remove(pending_task)
+                    task_queued_at.pop(pending_task, None)
+            file_data = None
+        elif kind == "map":
+            file_state["chunk_responses"][chunk_index] = response
+            file_state["chunks_remaining"] -= 1
+            if file_state["chunks_remaining"] > 0:
+                return []
+            reduce_prompt = generate_reduce_prompt(file_state["chunk_responses"], user_instruction)
+            queue_tasks([(filename, "reduce", None, reduce_prompt)], first=True) # 优先合并，尽早产出完整结果
+            return []
+        elif kind == "reduce":
+            chunks = [
+                {"index": i + 1, "start": chunk["start"], "end": chunk["end"], "response": chunk_response}
+                for i, (chunk, chunk_response) in enumerate(zip(file_state["chunks"], file_state["chunk_responses"]))
+            ]
+            file_data = build_file_entry(
+                file_state["content_str"], user_instruction, response, chunks, content_owner_id=content_owner_id
+            )
+        else:
+            # 差异分析的请求只用于首次分析：对话的前缀仍是包含该文件完整内容的标准请求，后续提问时模型能看到全文
+            file_data = build_file_entry(file_state["content_str"], user_instruction, response, content_owner_id=content_owner_id)
+        return complete_file(filename, file_data)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(max_workers)))
+    try:
+        parsed_queue, parse_slots = _start_parse_stage(
+            file_sources, excel_options, parse_queue_depth, stop_event, fingerprint=dedup_options["near_mode"] != "off"
+        )
+        last_partial_at = time.monotonic()
+        while parsed_count < total or pending_tasks or future_to_task or pack_buffer["files"]:
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            paused = pause_event is not None and pause_event.is_set()
+            while not paused:
+                if parsed_count >= total:
+                    flush_pack()
+                # 补充任务直到达到并发上限；缓存命中的任务在当前线程中立即完成，不占用并发名额
+                while pending_tasks and len(future_to_task) < max_workers:
+                    task = pending_tasks.popleft()
+                    queued_at = task_queued_at.pop(task)
+                    filename, _, _, prompt = task
+                    label = _task_label(task, file_states)
+                    cache_checked = task[1] == "single" and filename in cache_checked_files
+                    cache_checked_files.discard(filename)
+                    cached_response = (
+                        None if bypass_cache or cache_checked
+                        else get_cached_response(MODEL_NAME, [{"role": "user", "content": prompt}])
+                    )
+                    if cached_response is not None:
+                        record_metric("request", model=MODEL_NAME, label=label, wall_time=0.0, cached=True, **metric_tags)
+                        yield from finish_task(task, cached_response, None, True)
+                        continue
+                    future = executor.submit(
+                        _stream_analysis, api_key, label, prompt, partial_responses, partial_lock, metric_tags, queued_at,
+                        stop_event, PACKED_ANALYSIS_RESPONSE_FORMAT if task[1] == "pack" else None,
+                    )
+                    future_to_task[future] = (task, label)
+                    in_flight_files.update(task_filenames(task))
+                if pending_tasks or len(future_to_task) >= max_workers or parsed_count >= total:
+                    break
+                # 有空闲名额时才取下一个已解析的文件；没有进行中的请求时阻塞等待解析结果
+                try:
+                    if future_to_task:
+                        parsed = parsed_queue.get_nowait()
+                    else:
+                        parsed = parsed_queue.get(timeout=PARTIAL_UPDATE_INTERVAL)
+                except queue.Empty:
+                    if not future_to_task: # 请求阶段已空闲时不再等待凑满打包请求
+                        flush_pack()
+                    break
+                parse_slots.release()
+                parsed_count += 1
+                filename = parsed["filename"]
+                record_metric(
+                    "parse", filename=filename, bytes=parsed["bytes"], wall_time=parsed["parse_time"],
+                    queue_wait=time.monotonic() - parsed["queued_at"], error=parsed["error"], batch_id=batch_id,
+                )
+                yield {
+                    "event": "parsed",
+                    "filename": filename,
+                    "error": parsed["error"],
+                    "notices": parsed["notices"],
+                    "parsed": parsed_count,
+                    "completed": completed,
+                    "in_flight": len(in_flight_files),
+                    "total": total,
+                }
+                # 即使读取出错，也尝试将包含错误信息的内容发给AI，让AI知道哪个文件出错了
+                yield from plan_file(filename, parsed["content_str"], parsed.get("signature"))
+            if not future_to_task:
+                if paused:
+                    time.sleep(PARTIAL_UPDATE_INTERVAL)
+                continue
+
+            done, _ = concurrent.futures.wait(
+                future_to_task, timeout=PARTIAL_UPDATE_INTERVAL, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                task, label = future_to_task.pop(future)
+                for task_filename in task_filenames(task):
+                    in_flight_files[task_filename] -= 1
+                    if in_flight_files[task_filename] <= 0:
+                        del in_flight_files[task_filename]
+                response, error = None, None
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = f"API调用错误: {e}"
+                with partial_lock:
+                    partial_responses.pop(label, None)
+                yield from finish_task(task, response, error, False)
+            if future_to_task and time.monotonic() - last_partial_at >= PARTIAL_UPDATE_INTERVAL:
+                last_partial_at = time.monotonic()
+                with partial_lock:
+                    partial_snapshot = dict(partial_responses)
+                yield {
+                    "event": "partial",
+                    "partial_responses": partial_snapshot,
+                    "completed": completed,
+                    "in_flight": len(in_flight_files),
+                    "total": total,
+                }
+    finally:
+        # 被取消或中断时停止解析新文件，取消尚未开始的请求，并关闭进行中的数据流
+        stop_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        record_metric(
+            "batch", batch_id=batch_id, files=total, completed=completed,
+            wall_time=time.monotonic() - batch_started_at,
+        )
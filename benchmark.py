@@ -0,0 +1,311 @@
+"""
+离线基准测试：在本地模拟的 OpenAI 兼容服务上运行批量分析流程、文件解析以及状态保存/加载，
+以 10/100/1000 个文件等规模输出吞吐量、p95 延迟、峰值内存和持久化数据大小。
+
+用法:
+    python benchmark.py                                  # 全部场景，默认规模 10,100,1000
+    python benchmark.py --scenarios pipeline --sizes 100 --concurrency 16 --rate-429 0.05
+    python benchmark.py --output bench_results.json      # 同时保存JSON结果，便于前后对比
+    python benchmark.py --scenarios small,packed         # 对比小文件逐个请求与打包请求
+
+每个 (场景, 规模) 都在独立的子进程中运行，峰值内存互不影响。
+"""
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import unicodedata
+
+try:
+    import resource
+except ImportError: # Windows 上没有 resource 模块，不统计峰值内存
+    resource = None
+
+from fake_openai_server import add_server_arguments, server_config_from_args, start_fake_server
+
+SCENARIOS = ("pipeline", "ingest", "persistence", "small", "packed")
+DEFAULT_SIZES = "10,100,1000"
+BENCH_INSTRUCTION = "请总结文件的主要内容，并指出其中可能存在的问题。"
+TEXT_FILE_CHARS = 6000 # 普通文本文件的大致字符数
+LARGE_FILE_EVERY = 50 # 每多少个文件中有一个需要分块分析的超长文本文件
+LARGE_FILE_CHARS = 300000
+EXCEL_FILE_EVERY = 10 # 每多少个文件中有一个 Excel 文件
+EXCEL_ROWS = 500
+CHAT_TURNS_PER_FILE = 3 # 持久化场景中每个文件的追问轮数
+SMALL_FILE_CHARS = 800 # small/packed 场景中小文件的大致字符数
+
+def _peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 # Linux 上单位为KB
+
+def _make_text(rng, chars):
+    words = ["销售", "合同", "季度", "报告", "客户", "数据", "风险", "预算", "project", "invoice", "total", "review"]
+    lines = []
+    length = 0
+    while length < chars:
+        line = " ".join(rng.choice(words) for _ in range(rng.randint(8, 20))) + f" {rng.randint(0, 99999)}"
+        lines.append(line)
+        length += len(line) + 1
+        if rng.random() < 0.1:
+            lines.append("")
+    return "\n".join(lines)
+
+def _make_excel_bytes(rng):
+    import openpyxl
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet("数据")
+    worksheet.append(["日期", "客户", "产品", "数量", "单价", "金额", "地区", "备注"])
+    for row_index in range(EXCEL_ROWS):
+        quantity, price = rng.randint(1, 100), round(rng.uniform(1, 500), 2)
+        worksheet.append([
+            f"2024-01-{row_index % 28 + 1:02d}", f"客户{rng.randint(1, 200)}", f"产品{rng.randint(1, 50)}",
+            quantity, price, round(quantity * price, 2), rng.choice(["华东", "华北", "华南"]), "",
+        ])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+def make_file_sources(count, seed=0):
+    """
+    生成 count 个合成文件，混合普通文本、超长文本和 Excel 文件。
+
+    返回:
+    - list: [(文件名, 返回文件原始字节的无参函数)]，格式与 iter_batch_analysis 的 file_sources 一致。
+    """
+    rng = random.Random(seed)
+    excel_bytes = _make_excel_bytes(rng) # 所有 Excel 文件共用同一份内容，避免生成数据本身拖慢测试
+    file_sources = []
+    for i in range(count):
+        if i % EXCEL_FILE_EVERY == EXCEL_FILE_EVERY - 1:
+            file_sources.append((f"sheet_{i:05d}.xlsx", lambda data=excel_bytes: data))
+            continue
+        chars = LARGE_FILE_CHARS if i % LARGE_FILE_EVERY == LARGE_FILE_EVERY - 1 else TEXT_FILE_CHARS
+        data = _make_text(rng, chars).encode("utf-8")
+        file_sources.append((f"text_{i:05d}.txt", lambda data=data: data))
+    return file_sources
+
+def make_small_file_sources(count, seed=0):
+    """生成 count 个小文件（短文本、JSON 和代码），格式同 make_file_sources。"""
+    rng = random.Random(seed)
+    file_sources = []
+    for i in range(count):
+        text = _make_text(rng, SMALL_FILE_CHARS)
+        if i % 3 == 1:
+            filename, data = f"config_{i:05d}.json", json.dumps({"id": i, "notes": text.splitlines()}, ensure_ascii=False)
+        elif i % 3 == 2:
+            filename, data = f"script_{i:05d}.py", "\n".join(f"# {line}" for line in text.splitlines()) + f"\nVALUE = {i}\n"
+        else:
+            filename, data = f"note_{i:05d}.txt", text
+        file_sources.append((filename, lambda data=data.encode("utf-8"): data))
+    return file_sources
+
+def run_pipeline(count, concurrency, file_sources=None, pack_small_files=False):
+    """批量分析流程（解析 + 并发流式请求 + 分块合并），所有请求都发送到模拟服务。"""
+    from batch_utils import iter_batch_analysis
+    from metrics_utils import get_metric_records, summarize_requests
+
+    file_sources = file_sources or make_file_sources(count)
+    errors = 0
+    started_at = time.perf_counter()
+    for event in iter_batch_analysis(
+        "benchmark-key", file_sources, BENCH_INSTRUCTION, max_workers=concurrency, bypass_cache=True,
+        pack_small_files=pack_small_files,
+    ):
+        if event["event"] == "result" and event["error"]:
+            errors += 1
+    elapsed = time.perf_counter() - started_at
+    request_summary = summarize_requests(get_metric_records("request"))
+    return {
+        "seconds": elapsed,
+        "files_per_second": count / elapsed,
+        "p95_latency": request_summary["p95_latency"],
+        "requests": request_summary["requests"],
+        "retries": request_summary["retries"],
+        "errors": errors,
+    }
+
+def run_ingest(count):
+    """只测文件解析（文本解码与 Excel 流式读取），在当前进程中依次进行。"""
+    from ingest_utils import parse_file
+
+    file_sources = make_file_sources(count)
+    parse_times = []
+    total_bytes = 0
+    errors = 0
+    started_at = time.perf_counter()
+    for filename, load_bytes in file_sources:
+        parsed = parse_file(filename, load_bytes())
+        parse_times.append(parsed["parse_time"])
+        total_bytes += parsed["bytes"]
+        errors += bool(parsed["error"])
+    elapsed = time.perf_counter() - started_at
+    parse_times.sort()
+    return {
+        "seconds": elapsed,
+        "files_per_second": count / elapsed,
+        "p95_latency": parse_times[max(0, -(-len(parse_times) * 95 // 100) - 1)],
+        "megabytes_per_second": total_bytes / 1024 / 1024 / elapsed,
+        "errors": errors,
+    }
+
+def run_persistence(count, db_path):
+    """保存/增量保存/冷启动加载 count 个带对话历史的文件。"""
+    from batch_utils import build_file_entry
+    from persistence_utils import save_app_state, load_app_state, load_file_details
+
+    rng = random.Random(0)
+    files_data = {}
+    for i in range(count):
+        content_str = _make_text(rng, TEXT_FILE_CHARS)
+        file_entry = build_file_entry(content_str, BENCH_INSTRUCTION, _make_text(rng, 800))
+        for turn in range(CHAT_TURNS_PER_FILE):
+            file_entry["chat_history"].append({"role": "user", "content": f"追问 {turn}: " + _make_text(rng, 100)})
+            file_entry["chat_history"].append({"role": "assistant", "content": _make_text(rng, 600)})
+        files_data[f"text_{i:05d}.txt"] = file_entry
+    state = {"api_key": "", "user_general_instruction": BENCH_INSTRUCTION, "files_data": files_data}
+
+    started_at = time.perf_counter()
+    saved = save_app_state(state, db_path)
+    full_save_seconds = time.perf_counter() - started_at
+
+    # 模拟一轮对话后的保存：约十分之一的文件新增一问一答
+    for filename in list(files_data)[::10]:
+        files_data[filename]["chat_history"].append({"role": "user", "content": "再详细说明一下。"})
+        files_data[filename]["chat_history"].append({"role": "assistant", "content": _make_text(rng, 600)})
+    started_at = time.perf_counter()
+    save_app_state(state, db_path)
+    incremental_save_seconds = time.perf_counter() - started_at
+
+    loaded_state = {}
+    started_at = time.perf_counter()
+    load_app_state(loaded_state, db_path)
+    load_seconds = time.perf_counter() - started_at
+    started_at = time.perf_counter()
+    for filename in list(loaded_state["files_data"])[:10]:
+        load_file_details(filename, loaded_state, db_path)
+    open_file_seconds = (time.perf_counter() - started_at) / min(10, count)
+
+    persisted_bytes = sum(
+        os.path.getsize(path) for path in (db_path, db_path + "-wal") if os.path.exists(path)
+    )
+    return {
+        "seconds": full_save_seconds,
+        "files_per_second": count / full_save_seconds,
+        "incremental_save_seconds": incremental_save_seconds,
+        "load_seconds": load_seconds,
+        "open_file_seconds": open_file_seconds,
+        "persisted_bytes": persisted_bytes,
+        "errors": 0 if saved and len(loaded_state["files_data"]) == count else 1,
+    }
+
+def _run_worker(args):
+    """子进程入口：运行单个场景并把结果以JSON输出到标准输出的最后一行。"""
+    if args.scenario == "pipeline":
+        result = run_pipeline(args.files, args.concurrency)
+    elif args.scenario in ("small", "packed"):
+        result = run_pipeline(
+            args.files, args.concurrency, make_small_file_sources(args.files), pack_small_files=args.scenario == "packed"
+        )
+    elif args.scenario == "ingest":
+        result = run_ingest(args.files)
+    else:
+        result = run_persistence(args.files, os.path.join(args.workdir, "bench_state.sqlite3"))
+    result["peak_rss_bytes"] = _peak_rss_bytes()
+    print(json.dumps(result))
+
+TABLE_COLUMNS = [("场景", 12), ("文件数", 8), ("耗时(s)", 10), ("文件/s", 10), ("p95(s)", 10),
+                 ("请求数", 8), ("峰值RSS(MB)", 13), ("持久化(MB)", 12), ("失败", 6)]
+
+def _pad(text, width, align_left=False):
+    """按显示宽度（中文字符占两格）对齐文本。"""
+    text = str(text)
+    padding = " " * max(0, width - sum(2 if unicodedata.east_asian_width(ch) in "WF" else 1 for ch in text))
+    return text + padding if align_left else padding + text
+
+def _format_row(cells):
+    return "".join(_pad(cell, width, i == 0) for i, (cell, (_, width)) in enumerate(zip(cells, TABLE_COLUMNS)))
+
+def _result_cells(scenario, count, result):
+    def fmt(value, pattern):
+        return pattern.format(value) if value is not None else "-"
+    return [
+        scenario,
+        count,
+        fmt(result.get("seconds"), "{:.2f}"),
+        fmt(result.get("files_per_second"), "{:.1f}"),
+        fmt(result.get("p95_latency"), "{:.3f}"),
+        fmt(result.get("requests"), "{}"),
+        fmt(result["peak_rss_bytes"] / 1024 / 1024 if result.get("peak_rss_bytes") else None, "{:.1f}"),
+        fmt(result["persisted_bytes"] / 1024 / 1024 if result.get("persisted_bytes") else None, "{:.2f}"),
+        result.get("errors", 0),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description="离线基准测试（使用本地模拟的 OpenAI 兼容服务）")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="要运行的场景，逗号分隔")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="文件数量规模，逗号分隔")
+    parser.add_argument("--concurrency", type=int, default=16, help="批量分析的最大并发请求数")
+    parser.add_argument("--output", help="把结果保存为JSON文件")
+    parser.add_argument("--worker", dest="scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--files", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    add_server_arguments(parser)
+    parser.set_defaults(latency_ms=100, tokens_per_second=1000) # 默认模拟较快的服务，使大规模测试在几分钟内完成
+    args = parser.parse_args()
+
+    if args.scenario:
+        _run_worker(args)
+        return
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(",") if scenario.strip()]
+    unknown = [scenario for scenario in scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知的场景: {', '.join(unknown)}（可选: {', '.join(SCENARIOS)}）")
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+
+    server, base_url, server_stats = start_fake_server(**server_config_from_args(args))
+    print(f"模拟服务: {base_url}  (延迟中位数 {args.latency_ms}ms，{args.tokens_per_second} tokens/s，"
+          f"429 概率 {args.rate_429}，5xx 概率 {args.rate_5xx})")
+    print(_format_row([name for name, _ in TABLE_COLUMNS]))
+
+    results = []
+    try:
+        for scenario in scenarios:
+            for count in sizes:
+                with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+                    env = {
+                        **os.environ,
+                        "OPENAI_BASE_URL": base_url,
+                        # 使用独立的缓存与日志文件，不影响（也不命中）正式数据
+                        "RESPONSE_CACHE_FILE": os.path.join(workdir, "response_cache.sqlite3"),
+                        "METRICS_LOG_FILE": "",
+                    }
+                    completed = subprocess.run(
+                        [sys.executable, os.path.abspath(__file__), "--worker", scenario,
+                         "--files", str(count), "--workdir", workdir, "--concurrency", str(args.concurrency)],
+                        cwd=workdir, env=env, capture_output=True, text=True,
+                    )
+                if completed.returncode != 0:
+                    print(f"{_pad(scenario, 12, True)}{_pad(count, 8)}  运行失败:\n{completed.stderr[-2000:]}")
+                    continue
+                result = json.loads(completed.stdout.strip().splitlines()[-1])
+                results.append({"scenario": scenario, "files": count, **result})
+                print(_format_row(_result_cells(scenario, count, result)))
+    finally:
+        server.shutdown()
+
+    print(f"模拟服务共收到 {server_stats['requests']} 个请求，注入 429 {server_stats['injected_429']} 次、"
+          f"5xx {server_stats['injected_5xx']} 次，超出额度被拒绝 {server_stats['quota_429']} 次")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"server": server_config_from_args(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
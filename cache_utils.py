@@ -0,0 +1,143 @@
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_FILE = os.getenv("RESPONSE_CACHE_FILE", "response_cache.sqlite3")
+CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))  # 缓存总大小上限
+CACHE_MAX_AGE_SECONDS = int(os.getenv("RESPONSE_CACHE_MAX_AGE_SECONDS", str(30 * 24 * 3600)))  # 条目最长保留时间
+EVICTION_CHECK_INTERVAL = 50  # 每写入多少条检查一次是否需要淘汰
+
+_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+_writes_since_eviction = 0
+
+def make_cache_key(model, messages):
+    """根据模型名称和完整消息列表计算内容寻址的缓存键。"""
+    payload = json.dumps({"model": model, "messages": messages}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+@contextlib.contextmanager
+def _connect():
+    """打开缓存数据库连接，成功时提交事务，结束后关闭连接。"""
+    conn = sqlite3.connect(CACHE_FILE, timeout=30)
+    try:
+        with conn:
+            _ensure_schema(conn)
+            yield conn
+    finally:
+        conn.close()
+
+def _ensure_schema(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS responses (
+               cache_key TEXT PRIMARY KEY,
+               model TEXT NOT NULL,
+               response TEXT NOT NULL,
+               size INTEGER NOT NULL,
+               created_at REAL NOT NULL,
+               last_access REAL NOT NULL
+           )"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+
+def _count(stat_name):
+    with _stats_lock:
+        _stats[stat_name] += 1
+
+def get_cached_response(model, messages):
+    """
+    查找缓存的模型回应。
+
+    返回:
+    - str: 命中时返回缓存内容（并刷新其最近访问时间），未命中或已过期返回None。
+    """
+    cache_key = make_cache_key(model, messages)
+    try:
+        with _connect() as conn:
+            row = conn.execute(
+                "SELECT response, created_at FROM responses WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+            now = time.time()
+            if row is None or now - row[1] > CACHE_MAX_AGE_SECONDS:
+                _count("misses")
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE cache_key = ?", (now, cache_key))
+    except sqlite3.Error:
+        _count("misses")
+        return None
+    _count("hits")
+    return row[0]
+
+def store_cached_response(model, messages, response):
+    """将模型回应写入缓存，必要时按最近最少使用顺序淘汰旧条目。"""
+    global _writes_since_eviction
+    if not response:
+        return
+    cache_key = make_cache_key(model, messages)
+    now = time.time()
+    try:
+        with _connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (cache_key, model, response, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (cache_key, model, response, len(response.encode("utf-8")), now, now),
+            )
+        with _stats_lock:
+            _writes_since_eviction += 1
+            should_evict = _writes_since_eviction >= EVICTION_CHECK_INTERVAL
+            if should_evict:
+                _writes_since_eviction = 0
+        if should_evict:
+            evict_cache_entries()
+    except sqlite3.Error:
+        pass # 缓存写入失败不影响正常结果
+
+def evict_cache_entries():
+    """删除过期条目，并在总大小超过上限时从最久未访问的条目开始删除。"""
+    try:
+        with _connect() as conn:
+            conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - CACHE_MAX_AGE_SECONDS,))
+            total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total_bytes <= CACHE_MAX_BYTES:
+                return
+            bytes_to_free = total_bytes - CACHE_MAX_BYTES
+            keys_to_delete = []
+            for cache_key, size in conn.execute("SELECT cache_key, size FROM responses ORDER BY last_access"):
+                keys_to_delete.append((cache_key,))
+                bytes_to_free -= size
+                if bytes_to_free <= 0:
+                    break
+            conn.executemany("DELETE FROM responses WHERE cache_key = ?", keys_to_delete)
+    except sqlite3.Error:
+        pass
+
+def clear_response_cache():
+    """清空所有缓存条目并重置命中统计。"""
+    with _connect() as conn:
+        conn.execute("DELETE FROM responses")
+    with _stats_lock:
+        _stats["hits"] = 0
+        _stats["misses"] = 0
+
+def get_cache_stats():
+    """
+    返回缓存统计信息。
+
+    返回:
+    - dict: {"hits", "misses", "entries", "bytes"}，命中/未命中为当前进程内的计数。
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    try:
+        with _connect() as conn:
+            entries, total_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+    except sqlite3.Error:
+        entries, total_bytes = 0, 0
+    stats["entries"] = entries
+    stats["bytes"] = total_bytes
+    return stats
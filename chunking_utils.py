@@ -0,0 +1,112 @@
+import functools
+import os
+import re
+
+try:
+    import tiktoken
+except ImportError: # tiktoken 为可选依赖，缺失时使用粗略估算
+    tiktoken = None
+
+MAX_SINGLE_REQUEST_TOKENS = int(os.getenv("MAX_SINGLE_REQUEST_TOKENS", "60000"))  # 超过此长度的文件将分块分析
+CHUNK_TARGET_TOKENS = int(os.getenv("CHUNK_TARGET_TOKENS", "12000"))  # 每个分块的目标长度
+
+SHEET_HEADER_PATTERN = re.compile(r"(?m)^(?=--- 工作表: )")  # Excel 转换后每个工作表的起始行
+CJK_CHAR_PATTERN = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+TABLE_SEPARATOR_PATTERN = re.compile(r"^\|?\s*:?-{3,}")
+
+@functools.lru_cache(maxsize=1)
+def _get_encoding():
+    try:
+        return tiktoken.get_encoding("o200k_base") # GPT-4o 使用的编码
+    except Exception:
+        return None
+
+def count_tokens(text):
+    """
+    统计文本的token数。
+
+    安装了 tiktoken 时使用 GPT-4o 的编码精确计算，否则按字符粗略估算
+    （中日韩字符约1个token，其余约4个字符1个token）。
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding() if tiktoken is not None else None
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk_chars = len(CJK_CHAR_PATTERN.findall(text))
+    return cjk_chars + (len(text) - cjk_chars + 3) // 4
+
+def _split_hard(text, max_tokens):
+    """在找不到自然边界时按长度硬切分。"""
+    total_tokens = count_tokens(text)
+    pieces_needed = max(1, -(-total_tokens // max_tokens))
+    piece_length = max(1, -(-len(text) // pieces_needed))
+    return [text[i:i + piece_length] for i in range(0, len(text), piece_length)]
+
+def _get_table_header(text):
+    """
+    返回需要在每个分块开头重复的表头部分：Markdown 表格的表头（可带工作表标题行），
+    或 CSV/TSV 工作表的标题行加列名行。不是表格时返回空字符串。
+    """
+    lines = text.split("\n", 4)
+    for i in range(min(3, len(lines) - 1)):
+        if lines[i].lstrip().startswith("|") and TABLE_SEPARATOR_PATTERN.match(lines[i + 1].strip()):
+            return "\n".join(lines[:i + 2]) + "\n"
+    if SHEET_HEADER_PATTERN.match(text) and len(lines) > 2:
+        return "\n".join(lines[:2]) + "\n"
+    return ""
+
+def _split_by(text, level, max_tokens):
+    """按 level 指定的边界（段落 -> 行 -> 硬切分）递归切分，返回不超过 max_tokens 的片段。"""
+    if count_tokens(text) <= max_tokens:
+        return [text]
+    if level == 0:
+        parts = re.split(r"(?<=\n\n)", text)
+    elif level == 1:
+        parts = re.split(r"(?<=\n)", text)
+    else:
+        return _split_hard(text, max_tokens)
+    parts = [part for part in parts if part]
+    if len(parts) <= 1:
+        return _split_by(text, level + 1, max_tokens)
+
+    pieces = []
+    for part in parts:
+        pieces.extend(_split_by(part, level + 1, max_tokens))
+    return pieces
+
+def split_into_chunks(text, max_tokens=CHUNK_TARGET_TOKENS):
+    """
+    在自然边界（工作表、段落、表格行）处把长文本切分为若干分块。
+
+    相邻的小片段会被合并到接近 max_tokens；按行切分表格时会在后续分块开头重复表头（表头超过 max_tokens 的一半时不重复）。
+
+    返回:
+    - list: [{"start": int, "end": int, "text": str}]，start/end 为分块在原文中的字符位置
+            （重复的表头不计入位置范围）。
+    """
+    pieces = [] # (start, text, token_count, 需要重复的表头)
+    position = 0
+    for section in [part for part in SHEET_HEADER_PATTERN.split(text) if part]:
+        table_header = _get_table_header(section)
+        if count_tokens(table_header) > max_tokens // 2: # 表头过长时重复它会挤占分块的大部分预算，不再重复
+            table_header = ""
+        section_pieces = _split_by(section, 0, max_tokens - count_tokens(table_header))
+        for i_piece, piece in enumerate(section_pieces):
+            pieces.append((position, piece, count_tokens(piece), table_header if i_piece > 0 else ""))
+            position += len(piece)
+
+    chunks = []
+    current_parts, current_tokens, current_start = [], 0, 0
+    for piece_start, piece, piece_tokens, table_header in pieces:
+        if current_parts and current_tokens + piece_tokens > max_tokens:
+            chunks.append({"start": current_start, "end": piece_start, "text": "".join(current_parts)})
+            current_parts, current_tokens, current_start = [], 0, piece_start
+            if table_header:
+                current_parts.append(table_header)
+                current_tokens = count_tokens(table_header)
+        current_parts.append(piece)
+        current_tokens += piece_tokens
+    if current_parts:
+        chunks.append({"start": current_start, "end": position, "text": "".join(current_parts)})
+    return chunks
@@ -0,0 +1,221 @@
+import collections
+import hashlib
+import os
+import re
+import threading
+import uuid
+import weakref
+import zlib
+
+try:
+    import zstandard
+except ImportError: # zstandard 为可选依赖，缺失时使用 zlib 压缩
+    zstandard = None
+
+from openai_utils import generate_initial_analysis_prompt, generate_reduce_prompt
+
+# 持久化时文件内容的压缩方式："zlib"（默认）、"zstd"（需要安装 zstandard）或 "none"
+CONTENT_COMPRESSION = os.getenv("CONTENT_COMPRESSION", "zlib")
+ZLIB_LEVEL = 6
+INITIAL_PROMPT_REF = "initial" # chat_history[0] 的 prompt_ref 标记：内容为文件的初始分析请求
+CONTENT_OWNER_KEY = "content_owner" # session_state 中保存会话内容持有者（见 new_content_owner）的键
+PROMPT_INSTRUCTION_PATTERN = re.compile(r"用户指令：\n(.*?)\n\n(?:文件内容：|各部分的分析结果：)", re.S)
+
+# 内容哈希 -> 文本，在所有会话之间共享：相同内容的文件（即使文件名不同）只保存一份。
+# 内容按持有者（会话、后台任务）计数引用，最后一个持有者不再引用时从内容库中释放。
+_contents = {}
+_contents_lock = threading.Lock()
+_content_owners = {} # 持有者ID -> 其引用的内容哈希集合
+_content_refcounts = collections.Counter() # 内容哈希 -> 引用它的持有者数
+
+def hash_content(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def store_content(text, owner_id=None):
+    """
+    把文本放入内容库并返回其哈希；内容已存在时复用已有的对象。
+
+    提供 owner_id 时在同一次加锁中由它持有该内容，避免内容在被持有之前因其他持有者释放而被移除。
+    """
+    content_hash = hash_content(text)
+    with _contents_lock:
+        _contents.setdefault(content_hash, text)
+        if owner_id is not None:
+            _retain_hashes(owner_id, (content_hash,))
+    return content_hash
+
+def put_content(content_hash, text):
+    """放入已知哈希的内容（如从数据库加载时）。"""
+    with _contents_lock:
+        _contents.setdefault(content_hash, text)
+
+def has_content(content_hash):
+    with _contents_lock:
+        return content_hash in _contents
+
+def get_content(content_hash):
+    """按哈希取出内容，不存在时返回None。"""
+    with _contents_lock:
+        return _contents.get(content_hash)
+
+class _ContentOwner:
+    """会话的内容持有者标记，对象被回收（会话结束）时释放其引用的内容。"""
+    def __init__(self):
+        self.id = f"session-{uuid.uuid4().hex}"
+
+def new_content_owner():
+    """创建一个会话的内容持有者，保存在 session_state 中；其 id 用于 retain_contents 等函数。"""
+    owner = _ContentOwner()
+    weakref.finalize(owner, release_content_owner, owner.id)
+    return owner
+
+def _release_hashes(content_hashes):
+    # 调用方需持有 _contents_lock
+    for content_hash in content_hashes:
+        _content_refcounts[content_hash] -= 1
+        if _content_refcounts[content_hash] <= 0:
+            del _content_refcounts[content_hash]
+            _contents.pop(content_hash, None)
+
+def _retain_hashes(owner_id, content_hashes):
+    # 调用方需持有 _contents_lock
+    owned = _content_owners.setdefault(owner_id, set())
+    for content_hash in content_hashes:
+        if content_hash not in owned:
+            owned.add(content_hash)
+            _content_refcounts[content_hash] += 1
+
+def retain_contents(owner_id, content_hashes):
+    """
+    让 owner_id 持有（引用）这些内容，已持有的内容不重复计数。
+
+    尚未放入内容库的哈希也可以先被持有，之后放入的内容不会在持有者释放之前被移除。
+    """
+    content_hashes = set(content_hashes)
+    if not content_hashes:
+        return
+    with _contents_lock:
+        _retain_hashes(owner_id, content_hashes)
+
+def set_owned_contents(owner_id, content_hashes):
+    """把 owner_id 持有的内容设为 content_hashes：不再持有且已无其他持有者的内容被释放。"""
+    content_hashes = set(content_hashes)
+    with _contents_lock:
+        owned = _content_owners.pop(owner_id, set())
+        for content_hash in content_hashes - owned:
+            _content_refcounts[content_hash] += 1
+        _release_hashes(owned - content_hashes)
+        if content_hashes:
+            _content_owners[owner_id] = content_hashes
+
+def release_content_owner(owner_id):
+    """释放 owner_id 持有的全部内容（会话结束、后台任务被移除时）。"""
+    with _contents_lock:
+        _release_hashes(_content_owners.pop(owner_id, ()))
+
+def compress_content(text):
+    """
+    按 CONTENT_COMPRESSION 压缩文本，用于持久化。
+
+    返回:
+    - tuple: (压缩方式, 字节数据)
+    """
+    data = text.encode("utf-8")
+    if CONTENT_COMPRESSION == "zstd" and zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor().compress(data)
+    if CONTENT_COMPRESSION == "none":
+        return "none", data
+    return "zlib", zlib.compress(data, ZLIB_LEVEL)
+
+def decompress_content(compression, data):
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("读取 zstd 压缩的内容需要安装 zstandard (pip install zstandard)。")
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    if compression == "zlib":
+        return zlib.decompress(data).decode("utf-8")
+    return bytes(data).decode("utf-8")
+
+def get_file_content(file_entry):
+    """取出文件条目对应的文件文本（兼容直接保存 content_str 的旧格式），内容不可用时返回None。"""
+    if "content_hash" in file_entry:
+        return get_content(file_entry["content_hash"])
+    return file_entry.get("content_str")
+
+def get_initial_prompt(file_entry):
+    """
+    按需重建文件的初始分析请求（即 chat_history[0] 的内容）。
+
+    重建结果与当初发送的请求逐字节相同，因此响应缓存与服务端的提示缓存都能继续命中。
+    """
+    prompt_ref = file_entry.get("initial_prompt_ref")
+    if prompt_ref is None: # 旧格式
+        return file_entry.get("initial_user_prompt_content")
+    if prompt_ref["kind"] == "initial":
+        return generate_initial_analysis_prompt(get_content(prompt_ref["content_hash"]), prompt_ref["instruction"])
+    if prompt_ref["kind"] == "reduce":
+        return generate_reduce_prompt([chunk["response"] for chunk in file_entry["chunks"]], prompt_ref["instruction"])
+    return get_content(prompt_ref["content_hash"]) # "stored": 无法重建的请求原样保存在内容库中
+
+def get_prompt_content_hashes(file_entry):
+    """文件条目引用的全部内容哈希（文件内容以及原样保存的请求）。"""
+    hashes = []
+    if file_entry.get("content_hash"):
+        hashes.append(file_entry["content_hash"])
+    prompt_ref = file_entry.get("initial_prompt_ref") or {}
+    if prompt_ref.get("content_hash") and prompt_ref["content_hash"] not in hashes:
+        hashes.append(prompt_ref["content_hash"])
+    return hashes
+
+def claim_file_contents(owner_id, files_data):
+    """把 owner_id 持有的内容同步为 files_data 中各条目引用的内容：被删除或替换的文件的内容随之释放。"""
+    set_owned_contents(
+        owner_id, [content_hash for file_entry in files_data.values() for content_hash in get_prompt_content_hashes(file_entry)]
+    )
+
+def resolve_message(file_entry, message):
+    """把引用初始请求的消息还原为 {"role", "content"}，普通消息原样返回。"""
+    if message.get("prompt_ref") == INITIAL_PROMPT_REF:
+        return {"role": message["role"], "content": get_initial_prompt(file_entry)}
+    return message
+
+def make_initial_prompt_ref(content_hash, user_instruction, chunked=False):
+    """生成初始请求的引用：单次分析引用文件内容，分块分析的合并请求由各分块结果重建。"""
+    if chunked:
+        return {"kind": "reduce", "instruction": user_instruction}
+    return {"kind": "initial", "content_hash": content_hash, "instruction": user_instruction}
+
+def make_stored_prompt_ref(prompt):
+    """生成原样保存的请求的引用，用于无法由模板重建的请求（如无法识别的旧版数据）。"""
+    return {"kind": "stored", "content_hash": store_content(prompt)}
+
+def _infer_prompt_ref(file_entry, content_hash, prompt):
+    """为旧格式条目推断初始请求的引用：能按模板逐字节重建时只记录指令，否则原样保存请求。"""
+    match = PROMPT_INSTRUCTION_PATTERN.search(prompt or "")
+    if match:
+        instruction = match.group(1)
+        candidate = {**file_entry, "content_hash": content_hash,
+                     "initial_prompt_ref": make_initial_prompt_ref(content_hash, instruction, bool(file_entry.get("chunks")))}
+        if get_initial_prompt(candidate) == prompt:
+            return candidate["initial_prompt_ref"]
+    return make_stored_prompt_ref(prompt or "")
+
+def compact_file_entry(file_entry):
+    """
+    把旧格式的文件条目（content_str、initial_user_prompt_content 以及 chat_history[0] 各保存一份全文）
+    原地转换为引用内容库的紧凑格式，已是紧凑格式的条目不做改动。
+
+    返回:
+    - dict: 同一个条目。
+    """
+    if "content_str" not in file_entry:
+        return file_entry
+    content_str = file_entry.pop("content_str") or ""
+    prompt = file_entry.pop("initial_user_prompt_content", None)
+    content_hash = store_content(content_str)
+    file_entry["content_hash"] = content_hash
+    file_entry["initial_prompt_ref"] = _infer_prompt_ref(file_entry, content_hash, prompt)
+    chat_history = file_entry.get("chat_history") or []
+    if chat_history and chat_history[0].get("role") == "user" and chat_history[0].get("content") == prompt:
+        chat_history[0] = {"role": "user", "prompt_ref": INITIAL_PROMPT_REF}
+    return file_entry
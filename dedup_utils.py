@@ -0,0 +1,110 @@
+import collections
+import difflib
+import zlib
+
+from content_utils import hash_content
+
+DEDUP_NEAR_MODES = {
+    "diff": "对比代表文件，只分析差异",
+    "full": "仍完整分析（仅标注分组）",
+    "off": "不检测近似重复",
+}
+DEFAULT_DEDUP_OPTIONS = {
+    "skip_exact": True, # 内容完全相同的文件直接复用代表文件的分析结果
+    "near_mode": "diff", # 近似重复文件的处理方式，见 DEDUP_NEAR_MODES
+    "threshold": 0.85, # 估计相似度（Jaccard）不低于此值视为近似重复
+}
+SHINGLE_CHARS = 5 # 按字符切分的 shingle 长度，对中文和英文都适用
+MINHASH_BINS = 128 # MinHash 签名长度（单次哈希分桶，即 one-permutation hashing）
+LSH_BANDS = 32 # LSH 分段数：签名被分为 32 段，任一段完全相同的文件才会进一步比较
+MIN_NEAR_DUPLICATE_CHARS = 200 # 过短的文件签名不稳定，只检测完全相同
+MAX_DIFF_RATIO = 0.5 # 差异文本超过文件长度的这一比例时，对比分析不再划算，改为完整分析
+
+_EMPTY_BIN = 1 << 32
+
+def minhash_signature(text):
+    """
+    计算文本的 MinHash 签名（忽略空白差异）。
+
+    每个 shingle 只哈希一次，按哈希值分到 MINHASH_BINS 个桶中并保留各桶的最小值，
+    耗时与文本长度成线性关系。
+    """
+    normalized = " ".join(text.split())
+    signature = [_EMPTY_BIN] * MINHASH_BINS
+    for start in range(max(1, len(normalized) - SHINGLE_CHARS + 1)):
+        value = zlib.crc32(normalized[start:start + SHINGLE_CHARS].encode("utf-8"))
+        bin_index = value % MINHASH_BINS
+        if value < signature[bin_index]:
+            signature[bin_index] = value
+    return tuple(signature)
+
+def estimate_similarity(signature_a, signature_b):
+    """由两个签名估计 Jaccard 相似度（0~1）。"""
+    compared = matched = 0
+    for value_a, value_b in zip(signature_a, signature_b):
+        if value_a == _EMPTY_BIN and value_b == _EMPTY_BIN:
+            continue
+        compared += 1
+        matched += value_a == value_b
+    return matched / compared if compared else 0.0
+
+def _signature_bands(signature):
+    rows = MINHASH_BINS // LSH_BANDS
+    return [(band, signature[band * rows:(band + 1) * rows]) for band in range(LSH_BANDS)]
+
+def new_dedup_index():
+    """创建一个批次内的去重索引（随文件解析逐个加入）。"""
+    return {
+        "exact": {}, # 内容哈希 -> 最先出现该内容的文件名
+        "bands": collections.defaultdict(list), # (段号, 段内容) -> [代表文件名]
+        "signatures": {}, # 代表文件名 -> 签名
+    }
+
+def find_duplicate(index, filename, content_str, options=None, signature=None):
+    """
+    在已加入索引的文件中查找 filename 的重复文件，并把 filename 加入索引。
+
+    近似重复只与各组的代表文件比较，因此每组的成员都直接挂在代表文件下，不会形成链。
+    signature 为预先（如在解析阶段）计算好的 minhash_signature(content_str)，缺省时在这里计算。
+
+    返回:
+    - dict: {"filename": 代表文件名, "kind": "exact" 或 "near", "similarity": 估计相似度}，
+            不是重复文件时返回None。
+    """
+    options = {**DEFAULT_DEDUP_OPTIONS, **(options or {})}
+    content_hash = hash_content(content_str)
+    if content_hash in index["exact"]:
+        return {"filename": index["exact"][content_hash], "kind": "exact", "similarity": 1.0}
+    index["exact"][content_hash] = filename
+    if options["near_mode"] == "off" or len(content_str) < MIN_NEAR_DUPLICATE_CHARS:
+        return None
+
+    signature = signature or minhash_signature(content_str)
+    bands = _signature_bands(signature)
+    best = None
+    candidates = {candidate for band in bands for candidate in index["bands"].get(band, ())}
+    for candidate in sorted(candidates):
+        # 内容并不完全相同，估计值为1时也记为0.99
+        similarity = min(0.99, estimate_similarity(signature, index["signatures"][candidate]))
+        if similarity >= options["threshold"] and (best is None or similarity > best["similarity"]):
+            best = {"filename": candidate, "kind": "near", "similarity": similarity}
+    if best is None: # 成为新的一组的代表文件
+        index["signatures"][filename] = signature
+        for band in bands:
+            index["bands"][band].append(filename)
+    return best
+
+def make_content_diff(old_text, new_text, context_lines=2):
+    """
+    生成两份文本按行比较的差异（unified diff 格式）。
+
+    返回:
+    - str: 差异文本；差异超过 new_text 长度的 MAX_DIFF_RATIO 时返回None，表示不适合只分析差异。
+    """
+    diff_lines = difflib.unified_diff(
+        old_text.splitlines(), new_text.splitlines(), "代表文件", "当前文件", n=context_lines, lineterm=""
+    )
+    diff_text = "\n".join(diff_lines)
+    if len(diff_text) > len(new_text) * MAX_DIFF_RATIO:
+        return None
+    return diff_text
@@ -0,0 +1,273 @@
+"""
+本地模拟的 OpenAI 兼容服务（只实现 /v1/chat/completions），用于离线压测，不消耗真实API额度。
+
+用法:
+    python fake_openai_server.py --port 8765 --latency-ms 300 --tokens-per-second 80 --rate-429 0.02
+然后设置环境变量 OPENAI_BASE_URL=http://127.0.0.1:8765/v1 再运行应用或 benchmark.py。
+"""
+import argparse
+import html
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_SERVER_CONFIG = {
+    "latency_ms": 300, # 首个token前等待时间的中位数（毫秒）
+    "latency_sigma": 0.5, # 等待时间服从对数正态分布，sigma 越大长尾越明显
+    "tokens_per_second": 80, # 每个请求产出token的速度
+    "completion_tokens": 150, # 每个回应包含的token数
+    "rate_429": 0.0, # 返回 429 限流错误的概率
+    "rate_5xx": 0.0, # 返回 500/503 服务端错误的概率
+    "retry_after_ms": 200, # 429 响应中建议的等待时间
+    "rate_bad_json": 0.0, # 结构化输出（response_format 为 json_schema）请求返回无效JSON的概率
+    "rpm_limit": 0, # 模拟服务端的每分钟请求数上限，0 表示不限制
+    "tpm_limit": 0, # 模拟服务端的每分钟token数上限，0 表示不限制
+    "seed": 0,
+}
+STREAM_CHUNK_TOKENS = 5 # 流式响应中每个数据块包含的token数
+PACKED_FILE_PATTERN = re.compile(r'<file name="(.*?)">') # 打包请求中各文件的分隔标记（见 generate_packed_analysis_prompt）
+
+def _structured_content(request, completion_tokens, bad_json):
+    """
+    为结构化输出请求生成回应：对提示中的每个文件给出一项分析（每项 completion_tokens 个词）。
+
+    返回:
+    - tuple: (回应文本, 回应的token数)，bad_json 为True时返回被截断的JSON。
+    """
+    prompt = "".join(message.get("content") or "" for message in request.get("messages", []))
+    filenames = [html.unescape(name) for name in PACKED_FILE_PATTERN.findall(prompt)] or ["file"]
+    analysis = " ".join(f"词{i % 100}" for i in range(completion_tokens))
+    content = json.dumps({"files": [{"filename": name, "analysis": analysis} for name in filenames]}, ensure_ascii=False)
+    if bad_json:
+        content = content[:len(content) // 2]
+    return content, completion_tokens * len(filenames)
+
+def _make_handler(config, stats, rng, rng_lock):
+    """根据配置构造请求处理类；stats 记录收到的请求数与注入的错误数。"""
+    # 服务端额度：按上限每分钟匀速恢复，与 OpenAI 的 x-ratelimit-* 头语义一致
+    quotas = {
+        kind: {"limit": float(config[f"{prefix}_limit"]), "remaining": float(config[f"{prefix}_limit"]), "updated_at": time.monotonic()}
+        for kind, prefix in (("requests", "rpm"), ("tokens", "tpm"))
+    }
+
+    def take_quota(requested_tokens):
+        """扣除本次请求的额度，额度不足时返回False；同时返回要附加在响应中的限流头。"""
+        now = time.monotonic()
+        headers = {}
+        allowed = True
+        for kind, cost in (("requests", 1), ("tokens", requested_tokens)):
+            quota = quotas[kind]
+            if not quota["limit"]:
+                continue
+            quota["remaining"] = min(quota["limit"], quota["remaining"] + (now - quota["updated_at"]) * quota["limit"] / 60)
+            quota["updated_at"] = now
+            if quota["remaining"] < cost:
+                allowed = False
+        if allowed:
+            for kind, cost in (("requests", 1), ("tokens", requested_tokens)):
+                quotas[kind]["remaining"] -= cost if quotas[kind]["limit"] else 0
+        for kind, quota in quotas.items():
+            if quota["limit"]:
+                headers[f"x-ratelimit-limit-{kind}"] = str(int(quota["limit"]))
+                headers[f"x-ratelimit-remaining-{kind}"] = str(max(0, int(quota["remaining"])))
+                headers[f"x-ratelimit-reset-{kind}"] = f"{(quota['limit'] - quota['remaining']) * 60 / quota['limit']:.3f}s"
+        return allowed, headers
+
+    class FakeOpenAIHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # 支持长连接，与真实服务一致地复用连接池
+
+        def log_message(self, format, *args):
+            pass # 压测时不输出访问日志
+
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_chunk(self, data):
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path.rstrip("/") != "/v1/chat/completions":
+                self._send_json(404, {"error": {"message": f"未实现的接口: {self.path}", "type": "invalid_request_error"}})
+                return
+            request = json.loads(body or b"{}")
+            prompt_tokens = sum(len(message.get("content") or "") for message in request.get("messages", [])) // 4
+            completion_tokens = int(config["completion_tokens"])
+            structured = (request.get("response_format") or {}).get("type") == "json_schema"
+            with rng_lock:
+                stats["requests"] += 1
+                roll = rng.random()
+                bad_json = structured and rng.random() < config["rate_bad_json"]
+                stats["bad_json"] += bad_json
+                latency = config["latency_ms"] / 1000 * math.exp(rng.gauss(0, config["latency_sigma"]))
+                within_quota, rate_limit_headers = take_quota(prompt_tokens + completion_tokens)
+                if not within_quota:
+                    stats["quota_429"] += 1
+            if not within_quota:
+                self._send_json(
+                    429,
+                    {"error": {"message": "超出模拟的速率限制", "type": "rate_limit_error"}},
+                    {**rate_limit_headers, "retry-after-ms": str(config["retry_after_ms"])},
+                )
+                return
+            if roll < config["rate_429"]:
+                with rng_lock:
+                    stats["injected_429"] += 1
+                self._send_json(
+                    429,
+                    {"error": {"message": "模拟的速率限制", "type": "rate_limit_error"}},
+                    {"retry-after-ms": str(config["retry_after_ms"])},
+                )
+                return
+            if roll < config["rate_429"] + config["rate_5xx"]:
+                with rng_lock:
+                    stats["injected_5xx"] += 1
+                status = 503 if roll < config["rate_429"] + config["rate_5xx"] / 2 else 500
+                self._send_json(status, {"error": {"message": "模拟的服务端错误", "type": "server_error"}})
+                return
+
+            if structured:
+                content, completion_tokens = _structured_content(request, completion_tokens, bad_json)
+                # 按字符切分数据块，块数与token数大致相当
+                piece_chars = max(1, len(content) // max(1, completion_tokens // STREAM_CHUNK_TOKENS))
+                pieces = [content[start:start + piece_chars] for start in range(0, len(content), piece_chars)]
+            else:
+                words = [f"词{i % 100}" for i in range(completion_tokens)]
+                content = " ".join(words)
+                pieces = [
+                    " ".join(words[start:start + STREAM_CHUNK_TOKENS]) + " "
+                    for start in range(0, completion_tokens, STREAM_CHUNK_TOKENS)
+                ]
+            token_interval = 1 / config["tokens_per_second"] if config["tokens_per_second"] else 0
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+            response_id = f"chatcmpl-fake-{stats['requests']}"
+            model = request.get("model", "fake-model")
+            time.sleep(latency)
+
+            if not request.get("stream"):
+                time.sleep(token_interval * completion_tokens)
+                self._send_json(200, {
+                    "id": response_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                }, rate_limit_headers)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            for name, value in rate_limit_headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+
+            def send_event(choices, **extra):
+                payload = {
+                    "id": response_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": choices,
+                    **extra,
+                }
+                self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+            for piece in pieces:
+                send_event([{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+                time.sleep(token_interval * completion_tokens / len(pieces))
+            send_event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (request.get("stream_options") or {}).get("include_usage"):
+                send_event([], usage=usage)
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+
+    return FakeOpenAIHandler
+
+class _QuietThreadingHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端中途断开（如压测进程结束、请求被取消）属于正常情况，不打印堆栈
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+def start_fake_server(host="127.0.0.1", port=0, **config_overrides):
+    """
+    在后台线程中启动模拟服务。
+
+    参数:
+    - port (int): 监听端口，0 表示自动选择空闲端口。
+    - config_overrides: 覆盖 DEFAULT_SERVER_CONFIG 中的配置项。
+
+    返回:
+    - tuple: (server, base_url, stats)，base_url 可直接作为 OPENAI_BASE_URL 使用，
+             stats 中 quota_429 为超出 rpm_limit/tpm_limit 而拒绝的请求数，bad_json 为注入的无效结构化输出数；
+             停止服务时调用 server.shutdown()。
+    """
+    config = {**DEFAULT_SERVER_CONFIG, **config_overrides}
+    stats = {"requests": 0, "injected_429": 0, "injected_5xx": 0, "quota_429": 0, "bad_json": 0}
+    handler = _make_handler(config, stats, random.Random(config["seed"]), threading.Lock())
+    server = _QuietThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="fake-openai-server", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1", stats
+
+def add_server_arguments(parser):
+    """把模拟服务的配置项添加为命令行参数（benchmark.py 共用）。"""
+    parser.add_argument("--latency-ms", type=float, default=DEFAULT_SERVER_CONFIG["latency_ms"], help="首个token前等待时间的中位数")
+    parser.add_argument("--latency-sigma", type=float, default=DEFAULT_SERVER_CONFIG["latency_sigma"], help="等待时间对数正态分布的sigma")
+    parser.add_argument("--tokens-per-second", type=float, default=DEFAULT_SERVER_CONFIG["tokens_per_second"])
+    parser.add_argument("--completion-tokens", type=int, default=DEFAULT_SERVER_CONFIG["completion_tokens"])
+    parser.add_argument("--rate-429", type=float, default=DEFAULT_SERVER_CONFIG["rate_429"], help="返回429的概率")
+    parser.add_argument("--rate-5xx", type=float, default=DEFAULT_SERVER_CONFIG["rate_5xx"], help="返回500/503的概率")
+    parser.add_argument("--rate-bad-json", type=float, default=DEFAULT_SERVER_CONFIG["rate_bad_json"], help="结构化输出返回无效JSON的概率")
+    parser.add_argument("--rpm-limit", type=int, default=DEFAULT_SERVER_CONFIG["rpm_limit"], help="模拟的每分钟请求数上限，0 表示不限制")
+    parser.add_argument("--tpm-limit", type=int, default=DEFAULT_SERVER_CONFIG["tpm_limit"], help="模拟的每分钟token数上限，0 表示不限制")
+
+def server_config_from_args(args):
+    return {
+        "latency_ms": args.latency_ms,
+        "latency_sigma": args.latency_sigma,
+        "tokens_per_second": args.tokens_per_second,
+        "completion_tokens": args.completion_tokens,
+        "rate_429": args.rate_429,
+        "rate_5xx": args.rate_5xx,
+        "rate_bad_json": args.rate_bad_json,
+        "rpm_limit": args.rpm_limit,
+        "tpm_limit": args.tpm_limit,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟的 OpenAI 兼容服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server, base_url, _ = start_fake_server(args.host, args.port, **server_config_from_args(args))
+    print(f"模拟服务已启动: OPENAI_BASE_URL={base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,132 @@
+from chunking_utils import count_tokens
+from content_utils import INITIAL_PROMPT_REF, get_initial_prompt, resolve_message
+
+DEFAULT_HISTORY_TOKEN_BUDGET = 32000 # 每次对话请求允许发送的token上限
+HISTORY_COMPACTION_MODES = {"summarize": "摘要早期对话", "drop": "直接丢弃早期对话"}
+PREFIX_MESSAGE_COUNT = 2 # 初始分析请求（含文件内容与指令）及首次回复，始终原样发送
+MESSAGE_OVERHEAD_TOKENS = 4 # 每条消息在角色、分隔符等格式上的额外开销
+COMPACTION_TARGET_RATIO = 0.5 # 压缩后近期对话最多占用剩余预算的比例，避免每轮都重新压缩
+PROMPT_TOKENS_KEY = "initial_prompt_tokens" # 文件条目中缓存初始请求token数的键
+
+def _initial_prompt_tokens(file_data):
+    """
+    初始请求（含完整文件内容）的token数。
+
+    结果以 {"key", "tokens"} 的形式缓存在文件条目上，key 为内容哈希与请求引用（含指令），
+    两者不变时无需重建请求文本即可得到token数；缓存中不保存文本本身。
+    """
+    cache_key = {"content_hash": file_data.get("content_hash"), "prompt_ref": file_data.get("initial_prompt_ref")}
+    cached = file_data.get(PROMPT_TOKENS_KEY)
+    if not cached or cached["key"] != cache_key:
+        cached = {"key": cache_key, "tokens": count_tokens(get_initial_prompt(file_data) or "")}
+        file_data[PROMPT_TOKENS_KEY] = cached
+    return cached["tokens"]
+
+def count_message_tokens(message, file_data=None):
+    """统计单条消息的token数（含格式开销）。引用初始请求的消息需要提供所属的 file_data。"""
+    if message.get("prompt_ref") == INITIAL_PROMPT_REF:
+        return _initial_prompt_tokens(file_data) + MESSAGE_OVERHEAD_TOKENS
+    return count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+def _summary_message(history_summary):
+    return {
+        "role": "system",
+        "content": f"以下是此前部分对话的摘要（原始对话已省略）：\n{history_summary['content']}",
+    }
+
+def _request_messages(file_data):
+    """下一次请求包含的消息（引用初始请求的消息尚未还原）。"""
+    chat_history = file_data["chat_history"]
+    history_summary = file_data.get("history_summary")
+    if not history_summary:
+        return list(chat_history)
+    messages = chat_history[:PREFIX_MESSAGE_COUNT]
+    if history_summary.get("content"):
+        messages.append(_summary_message(history_summary))
+    messages.extend(chat_history[history_summary["upto"]:])
+    return messages
+
+def build_chat_messages(file_data):
+    """
+    按当前的压缩状态构造发送给模型的消息列表：
+    固定前缀（初始分析请求与首次回复）+ 早期对话摘要（如有）+ 未被压缩的近期对话。
+
+    前缀始终逐字节不变，以便服务端的提示缓存（prompt caching）可以命中。
+    引用内容库的初始请求在这里按需重建。
+    """
+    return [resolve_message(file_data, message) for message in _request_messages(file_data)]
+
+def estimate_request_tokens(file_data):
+    """
+    估算下一次请求将发送的token数。
+
+    返回:
+    - dict: {"total", "prefix", "compacted_messages"}，compacted_messages 为已被摘要或丢弃的消息数。
+    """
+    messages = _request_messages(file_data)
+    history_summary = file_data.get("history_summary") or {}
+    return {
+        "total": sum(count_message_tokens(message, file_data) for message in messages),
+        "prefix": sum(count_message_tokens(message, file_data) for message in messages[:PREFIX_MESSAGE_COUNT]),
+        "compacted_messages": max(0, history_summary.get("upto", PREFIX_MESSAGE_COUNT) - PREFIX_MESSAGE_COUNT),
+    }
+
+def generate_history_summary_prompt(previous_summary, messages_to_summarize):
+    """
+    生成把一段早期对话（连同之前的摘要）压缩为摘要的提示。
+    """
+    conversation = "\n\n".join(
+        f"{'用户' if message['role'] == 'user' else 'AI'}：{message['content']}" for message in messages_to_summarize
+    )
+    previous_section = f"此前的摘要：\n{previous_summary}\n\n" if previous_summary else ""
+    return f"""请把以下关于某个文件的对话压缩为简洁的摘要，保留用户提出的问题、已确认的结论、修改建议及未解决的事项，以便后续对话继续引用。
+
+{previous_section}需要压缩的对话：
+---
+{conversation}
+---
+
+请输出摘要：
+"""
+
+def compact_history(file_data, token_budget, mode, summarize_fn=None):
+    """
+    如果下一次请求超出 token_budget，把最早的若干轮近期对话并入摘要（或直接丢弃），
+    并更新 file_data["history_summary"] = {"upto": 已压缩到的消息位置, "content": 摘要或None}。
+
+    压缩时会一次压缩到近期对话只占剩余预算的一部分，使之后若干轮请求的前缀保持不变。
+    至少保留最后一条消息。
+
+    参数:
+    - summarize_fn (callable): 接收提示文本、返回摘要文本的函数；mode 为 "summarize" 时必须提供。
+      摘要失败（返回空）时退化为丢弃，已有的摘要保持不变。
+
+    返回:
+    - bool: 是否进行了压缩。
+    """
+    chat_history = file_data["chat_history"]
+    if estimate_request_tokens(file_data)["total"] <= token_budget:
+        return False
+
+    history_summary = file_data.get("history_summary") or {"upto": PREFIX_MESSAGE_COUNT, "content": None}
+    upto = max(PREFIX_MESSAGE_COUNT, history_summary["upto"])
+    prefix_tokens = sum(count_message_tokens(message, file_data) for message in chat_history[:PREFIX_MESSAGE_COUNT])
+    recent_budget = max(0, token_budget - prefix_tokens) * COMPACTION_TARGET_RATIO
+
+    new_upto = upto
+    recent_tokens = sum(count_message_tokens(message) for message in chat_history[upto:])
+    while new_upto < len(chat_history) - 1 and recent_tokens > recent_budget:
+        recent_tokens -= count_message_tokens(chat_history[new_upto])
+        new_upto += 1
+    # 尽量从用户消息开始保留，避免近期对话以孤立的AI回复开头
+    while new_upto < len(chat_history) - 1 and chat_history[new_upto]["role"] != "user":
+        new_upto += 1
+    if new_upto == upto:
+        return False
+
+    summary_content = history_summary.get("content") # 丢弃模式下保留已有的摘要
+    if mode == "summarize" and summarize_fn is not None:
+        summary_prompt = generate_history_summary_prompt(summary_content, chat_history[upto:new_upto])
+        summary_content = summarize_fn(summary_prompt) or summary_content
+    file_data["history_summary"] = {"upto": new_upto, "content": summary_content}
+    return True
@@ -0,0 +1,277 @@
+import codecs
+import csv
+import datetime
+import io
+import random
+import time
+
+import openpyxl
+
+EXCEL_OUTPUT_FORMATS = {"markdown": "Markdown 表格", "csv": "CSV (紧凑，节省token)", "tsv": "TSV (制表符分隔，节省token)"}
+EXCEL_SAMPLING_MODES = {"head": "保留前 N 行", "uniform": "在全表中均匀随机抽样 N 行"}
+DEFAULT_EXCEL_OPTIONS = {
+    "output_format": "markdown", # 与之前的输出保持一致；CSV/TSV 更紧凑，可按需选择
+    "max_rows_per_sheet": 2000, # 每个工作表最多保留的数据行数（不含表头），0 表示不限制
+    "max_columns": 50, # 每行最多保留的列数，0 表示不限制
+    "sampling": "head",
+}
+SAMPLING_SEED = 0 # 固定随机种子，保证同一文件多次读取的抽样结果一致（也使响应缓存可以命中）
+EXCEL_EXTENSIONS = ('.xls', '.xlsx', '.xlsm')
+SUPPORTED_FILE_TYPES = ['txt', 'md', 'csv', 'json', 'py', 'html', 'css', 'js', 'xls', 'xlsx', 'xlsm'] # 可处理的文件扩展名
+ENCODING_SAMPLE_BYTES = 64 * 1024 # 编码检测只检查文件开头的这部分字节
+
+def _format_cell(value):
+    """把单元格的值转换为紧凑的文本。"""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=" ") if value.time() != datetime.time() else value.date().isoformat()
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value).replace("\r\n", "\n")
+
+def _row_serializer(output_format):
+    """返回把一行单元格文本序列化为一行输出的函数。"""
+    if output_format == "markdown":
+        def serialize(cells):
+            escaped = [cell.replace("|", "\\|").replace("\n", "<br>") for cell in cells]
+            return "| " + " | ".join(escaped) + " |\n"
+        return serialize
+
+    delimiter = "\t" if output_format == "tsv" else ","
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter, lineterminator="\n")
+
+    def serialize(cells):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(cells)
+        return buffer.getvalue()
+    return serialize
+
+def _serialize_sheet(sheet_name, filename, rows, options, stats):
+    """
+    流式地读取一个工作表的行，按行/列上限与抽样方式保留数据，返回该工作表的文本。
+
+    rows 为逐行产出单元格值序列的迭代器；内存占用只与保留的行数有关，与工作表大小无关。
+    """
+    output_format = options["output_format"]
+    max_rows = int(options["max_rows_per_sheet"]) or None
+    max_columns = int(options["max_columns"]) or None
+    serialize = _row_serializer(output_format)
+    rng = random.Random(SAMPLING_SEED)
+
+    header, kept_rows = None, [] # kept_rows: [(行序号, 单元格文本)]
+    data_rows_seen = 0
+    columns_truncated = False
+    for row in rows:
+        cells = [_format_cell(value) for value in row]
+        while cells and not cells[-1]: # 去掉行尾的空单元格
+            cells.pop()
+        if not cells:
+            continue # 跳过空行（只读模式下常有大量空行）
+        if max_columns and len(cells) > max_columns:
+            cells = cells[:max_columns]
+            columns_truncated = True
+        if header is None:
+            header = cells
+            continue
+        data_rows_seen += 1
+        if max_rows is None or len(kept_rows) < max_rows:
+            kept_rows.append((data_rows_seen, cells))
+        elif options["sampling"] == "uniform": # 蓄水池抽样，保持内存有界
+            replace_index = rng.randrange(data_rows_seen)
+            if replace_index < max_rows:
+                kept_rows[replace_index] = (data_rows_seen, cells)
+        # "head" 模式下超出上限的行直接丢弃，只计数
+
+    stats["sheets"] += 1
+    parts = [f"--- 工作表: {sheet_name} (来自文件: {filename}) ---\n"]
+    if header is None:
+        parts.append("此工作表为空。\n\n")
+        return "".join(parts)
+
+    column_count = max([len(header)] + [len(cells) for _, cells in kept_rows])
+    def pad(cells):
+        return cells + [""] * (column_count - len(cells))
+
+    parts.append(serialize(pad(header)))
+    if output_format == "markdown":
+        parts.append("|" + " --- |" * column_count + "\n")
+    kept_rows.sort(key=lambda item: item[0])
+    parts.extend(serialize(pad(cells)) for _, cells in kept_rows)
+
+    rows_dropped = data_rows_seen - len(kept_rows)
+    notes = []
+    if rows_dropped:
+        sampling_desc = "均匀抽样" if options["sampling"] == "uniform" else "前"
+        notes.append(f"此工作表共 {data_rows_seen} 行数据，仅保留{sampling_desc} {len(kept_rows)} 行")
+    if columns_truncated:
+        notes.append(f"每行仅保留前 {max_columns} 列")
+    if notes:
+        parts.append(f"({'；'.join(notes)})\n")
+    parts.append("\n")
+
+    stats["rows_total"] += data_rows_seen
+    stats["rows_kept"] += len(kept_rows)
+    stats["rows_dropped"] += rows_dropped
+    if columns_truncated:
+        stats["sheets_columns_truncated"].append(sheet_name)
+    return "".join(parts)
+
+def _iter_xlsx_sheets(file_obj):
+    """以只读模式逐个产出 (工作表名, 行迭代器)，适用于 .xlsx/.xlsm。"""
+    workbook = openpyxl.load_workbook(file_obj, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            yield worksheet.title, worksheet.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def _iter_xls_sheets(file_obj):
+    """逐个产出 (工作表名, 行迭代器)，适用于旧版 .xls（需要 xlrd）。"""
+    try:
+        import xlrd
+    except ImportError:
+        raise ImportError("读取 .xls 文件需要安装 xlrd (pip install xlrd)，或将文件另存为 .xlsx。")
+
+    workbook = xlrd.open_workbook(file_contents=file_obj.read(), on_demand=True)
+
+    def iter_rows(sheet):
+        for row_index in range(sheet.nrows):
+            values = []
+            for cell in sheet.row(row_index):
+                if cell.ctype == xlrd.XL_CELL_DATE:
+                    values.append(xlrd.xldate_as_datetime(cell.value, workbook.datemode))
+                else:
+                    values.append(cell.value)
+            yield values
+
+    try:
+        for sheet_name in workbook.sheet_names():
+            sheet = workbook.sheet_by_name(sheet_name)
+            yield sheet_name, iter_rows(sheet)
+            workbook.unload_sheet(sheet_name) # 处理完立即释放该工作表
+    finally:
+        workbook.release_resources()
+
+def read_excel_as_text(file_obj, filename, options=None):
+    """
+    以流式方式把 Excel 文件转换为适合发送给模型的文本。
+
+    参数:
+    - file_obj: 可读取的二进制文件对象（如 Streamlit 的 UploadedFile）。
+    - filename (str): 文件名，用于判断 .xls/.xlsx 以及生成工作表标题。
+    - options (dict): 见 DEFAULT_EXCEL_OPTIONS，缺省项使用默认值。
+
+    返回:
+    - tuple: (文本内容, 统计信息 {"sheets", "rows_total", "rows_kept", "rows_dropped", "sheets_columns_truncated"})
+    """
+    options = {**DEFAULT_EXCEL_OPTIONS, **(options or {})}
+    stats = {"sheets": 0, "rows_total": 0, "rows_kept": 0, "rows_dropped": 0, "sheets_columns_truncated": []}
+    if filename.lower().endswith(".xls"):
+        sheets = _iter_xls_sheets(file_obj)
+    else:
+        sheets = _iter_xlsx_sheets(file_obj)
+
+    content_parts = [
+        _serialize_sheet(sheet_name, filename, rows, options, stats)
+        for sheet_name, rows in sheets
+    ]
+    if not content_parts:
+        content_parts = [f"--- 文件: {filename} (Excel) ---\n", "Excel 文件中没有找到工作表。\n\n"]
+    return "".join(content_parts), stats
+
+def _prefix_decodes_as(data_prefix, encoding):
+    """检查字节前缀能否按 encoding 解码（允许末尾被截断的多字节字符）。"""
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(data_prefix, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+def detect_text_encoding(data):
+    """
+    根据文件开头的一段字节推测编码，依次尝试 UTF-8、GBK，都失败时返回 latin-1。
+    """
+    if data.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    sample = data[:ENCODING_SAMPLE_BYTES]
+    for encoding in ("utf-8", "gbk"):
+        if _prefix_decodes_as(sample, encoding):
+            return encoding
+    return "latin-1"
+
+def decode_text_bytes(data):
+    """
+    解码文本文件内容。通常只需按检测到的编码完整解码一次；若文件后部与检测结果不符，
+    再依次回退到 UTF-8、GBK 和 latin-1。
+
+    返回:
+    - tuple: (文本内容, 实际使用的编码)
+    """
+    detected_encoding = detect_text_encoding(data)
+    try:
+        return data.decode(detected_encoding), detected_encoding
+    except UnicodeDecodeError:
+        pass
+    for encoding in ("utf-8", "gbk"):
+        if encoding == detected_encoding:
+            continue
+        try:
+            return data.decode(encoding), encoding
+        except UnicodeDecodeError:
+            continue
+    return data.decode("latin-1", errors='replace'), "latin-1"
+
+def parse_file(filename, data, excel_options=None):
+    """
+    把上传文件的原始字节转换为文本。可在子进程中运行（参数与返回值均可序列化）。
+
+    读取失败时不抛出异常，而是把错误描述作为内容返回，以便仍然发送给AI说明哪个文件出错。
+
+    返回:
+    - dict: {"filename", "content_str", "error", "notices", "bytes", "parse_time"}，
+            notices 为需要提示给用户的信息列表 [(级别 "info"/"warning", 文本)]，parse_time 为解析耗时（秒）。
+    """
+    started_at = time.perf_counter()
+    notices = []
+    error = None
+    if filename.lower().endswith(EXCEL_EXTENSIONS):
+        try:
+            # 以只读模式逐行读取，内存占用与工作表大小无关
+            content_str, excel_stats = read_excel_as_text(io.BytesIO(data), filename, excel_options)
+            if excel_stats["rows_dropped"] or excel_stats["sheets_columns_truncated"]:
+                notices.append(("info",
+                    f"文件 {filename}: 共 {excel_stats['rows_total']} 行数据，"
+                    f"保留 {excel_stats['rows_kept']} 行，省略 {excel_stats['rows_dropped']} 行"
+                    + (f"；以下工作表的列被截断: {', '.join(excel_stats['sheets_columns_truncated'])}"
+                       if excel_stats["sheets_columns_truncated"] else "")
+                ))
+            if not content_str.strip():
+                content_str = f"文件 {filename} (Excel) 内容为空或未能提取有效文本。"
+                notices.append(("info", content_str))
+        except Exception as e:
+            error = f"Excel 读取错误: {e}"
+            content_str = f"错误：无法读取Excel文件 {filename}。错误信息：{e}" # 提供错误信息给AI
+    else:
+        try:
+            content_str, encoding = decode_text_bytes(data)
+            if encoding == "latin-1":
+                notices.append(("warning", f"文件 {filename} 使用UTF-8和GBK解码失败，已尝试latin-1解码。"))
+            if not content_str.strip():
+                content_str = f"文件 {filename} 内容为空。"
+                notices.append(("info", content_str))
+        except Exception as e:
+            error = f"文本文件读取错误: {e}"
+            content_str = f"错误：无法读取文本文件 {filename}。错误信息：{e}" # 提供错误信息给AI
+    return {
+        "filename": filename,
+        "content_str": content_str,
+        "error": error,
+        "notices": notices,
+        "bytes": len(data),
+        "parse_time": time.perf_counter() - started_at,
+    }
@@ -0,0 +1,234 @@
+import threading
+import time
+import uuid
+
+import streamlit as st
+
+from batch_utils import DEFAULT_MAX_CONCURRENCY, iter_batch_analysis
+from content_utils import get_prompt_content_hashes, release_content_owner, retain_contents
+
+JOB_POLL_INTERVAL = 1.0 # 界面刷新后台任务状态的间隔（秒）
+JOB_RETENTION_SECONDS = 3600 # 已结束的任务保留的时间：所属会话已关闭时，其未取走的结果在此之后被清除
+ACTIVE_JOB_STATUSES = ("running", "paused", "cancelling")
+JOB_STATUS_LABELS = {
+    "running": "处理中",
+    "paused": "已暂停",
+    "cancelling": "正在取消",
+    "cancelled": "已取消",
+    "finished": "已完成",
+    "failed": "出错",
+}
+
+@st.cache_resource
+def _get_job_registry():
+    """
+    进程内共享的后台任务表，在重新运行和页面切换之间保持不变。
+
+    任务表被所有浏览器会话共享，各会话在 session_state 中记录自己提交的任务ID，
+    查询和取走结果时只处理这些任务。
+    """
+    return {"jobs": {}, "lock": threading.Lock()}
+
+def _new_job(job_id, total):
+    return {
+        "id": job_id,
+        "created_at": time.time(),
+        "finished_at": None,
+        "status": "running",
+        "error": None,
+        "total": total,
+        "parsed": 0,
+        "completed": 0,
+        "cached": 0,
+        "deduplicated": 0, # 复用了相同文件的结果或只分析了差异的文件数
+        "in_flight": 0,
+        "finished_files": [], # 按完成顺序记录已成功的文件名
+        "failures": {}, # 文件名 -> 失败原因
+        "notices": [], # [(级别, 提示文本)]
+        "partial_responses": {},
+        "results": {}, # 尚未被界面取走的结果：文件名 -> files_data 格式的条目
+        "lock": threading.Lock(),
+        "pause_event": threading.Event(),
+        "cancel_event": threading.Event(),
+    }
+
+def _run_job(job, api_key, file_sources, instruction, max_workers, bypass_cache, excel_options, dedup_options, pack_small_files):
+    """后台线程：运行批处理流程并把事件汇总到任务状态中。"""
+    try:
+        for event in iter_batch_analysis(
+            api_key,
+            file_sources,
+            instruction,
+            max_workers,
+            bypass_cache=bypass_cache,
+            excel_options=excel_options,
+            batch_id=job["id"],
+            pause_event=job["pause_event"],
+            cancel_event=job["cancel_event"],
+            dedup_options=dedup_options,
+            pack_small_files=pack_small_files,
+            content_owner_id=job["id"], # 任务运行期间持有结果引用的内容，直到结果被取走
+        ):
+            with job["lock"]:
+                job["completed"] = event["completed"]
+                job["in_flight"] = event["in_flight"]
+                if event["event"] == "parsed":
+                    job["parsed"] = event["parsed"]
+                    job["notices"].extend(event["notices"])
+                    if event["error"]:
+                        job["notices"].append(("warning", f"读取文件 {event['filename']} 时发生错误: {event['error']}"))
+                elif event["event"] == "partial":
+                    job["partial_responses"] = event["partial_responses"]
+                elif event["file_data"]:
+                    job["results"][event["filename"]] = event["file_data"]
+                    job["finished_files"].append(event["filename"])
+                    job["cached"] += event["cached"]
+                    job["deduplicated"] += bool(event["duplicate_of"]) and event["duplicate_of"]["analysis"] != "full"
+                else:
+                    job["failures"][event["filename"]] = event["error"] or "API无回应或错误"
+        final_status = "cancelled" if job["cancel_event"].is_set() else "finished"
+        final_error = None
+    except Exception as e:
+        final_status, final_error = "failed", str(e)
+    with job["lock"]:
+        job["status"] = final_status
+        job["finished_at"] = time.time()
+        job["error"] = final_error
+        job["in_flight"] = 0
+        job["partial_responses"] = {}
+
+def start_batch_job(
+    api_key,
+    file_sources,
+    user_instruction,
+    max_workers=DEFAULT_MAX_CONCURRENCY,
+    bypass_cache=False,
+    excel_options=None,
+    dedup_options=None,
+    pack_small_files=False,
+):
+    """
+    在后台线程中开始一个批处理任务，立即返回任务ID。参数与 batch_utils.iter_batch_analysis 相同。
+
+    任务独立于 Streamlit 脚本的运行：页面重新运行、切换视图都不会中断它。
+    调用方需记录返回的任务ID（每个会话只查看自己的任务），完成的结果需要通过 drain_job_results 取走并存入 files_data。
+    """
+    job_id = uuid.uuid4().hex[:12]
+    job = _new_job(job_id, len(file_sources))
+    registry = _get_job_registry()
+    with registry["lock"]:
+        _prune_jobs(registry)
+        registry["jobs"][job_id] = job
+    threading.Thread(
+        target=_run_job,
+        args=(
+            job, api_key, file_sources, user_instruction, max_workers, bypass_cache, excel_options, dedup_options,
+            pack_small_files,
+        ),
+        name=f"batch-job-{job_id}",
+        daemon=True,
+    ).start()
+    return job_id
+
+def _prune_jobs(registry):
+    """清除结束超过 JOB_RETENTION_SECONDS 的任务（如所属会话已关闭、结果无人取走的任务）。调用方需持有任务表的锁。"""
+    expire_before = time.time() - JOB_RETENTION_SECONDS
+    for job_id, job in list(registry["jobs"].items()):
+        if job["finished_at"] is not None and job["finished_at"] < expire_before:
+            del registry["jobs"][job_id]
+            release_content_owner(job_id)
+
+def _get_job(job_id):
+    registry = _get_job_registry()
+    with registry["lock"]:
+        return registry["jobs"].get(job_id)
+
+def list_jobs(job_ids):
+    """
+    返回指定任务（通常是当前会话提交的任务）状态的快照（按创建时间排序），不含尚未取走的结果内容。
+    已被移除或清除的任务ID会被忽略。
+
+    返回:
+    - list: [dict]，字段同任务状态，另有 "pending_results"（待取走的结果数）。
+    """
+    registry = _get_job_registry()
+    with registry["lock"]:
+        jobs = [registry["jobs"][job_id] for job_id in job_ids if job_id in registry["jobs"]]
+    snapshots = []
+    for job in sorted(jobs, key=lambda job: job["created_at"]):
+        with job["lock"]:
+            snapshot = {
+                key: value for key, value in job.items()
+                if key not in ("results", "lock", "pause_event", "cancel_event")
+            }
+            snapshot["finished_files"] = list(job["finished_files"])
+            snapshot["failures"] = dict(job["failures"])
+            snapshot["notices"] = list(job["notices"])
+            snapshot["pending_results"] = len(job["results"])
+        snapshots.append(snapshot)
+    return snapshots
+
+def has_active_jobs(job_ids):
+    """指定的任务中是否有仍在运行（含暂停）的任务，或仍有结果未被取走的任务。"""
+    return any(job["status"] in ACTIVE_JOB_STATUSES or job["pending_results"] for job in list_jobs(job_ids))
+
+def drain_job_results(job_id, content_owner_id):
+    """
+    取走任务中已完成但尚未交付的结果（每个结果只交付一次）。
+
+    结果引用的内容转由 content_owner_id（取走结果的会话）持有；任务结束且结果全部取走后，任务不再持有任何内容。
+
+    返回:
+    - dict: 文件名 -> files_data 格式的条目，任务不存在时为空。
+    """
+    job = _get_job(job_id)
+    if job is None:
+        return {}
+    with job["lock"]:
+        drained = job["results"]
+        job["results"] = {}
+        job_finished = job["status"] not in ACTIVE_JOB_STATUSES
+    retain_contents(
+        content_owner_id, [content_hash for file_data in drained.values() for content_hash in get_prompt_content_hashes(file_data)]
+    )
+    if job_finished:
+        release_content_owner(job_id)
+    return drained
+
+def pause_job(job_id):
+    """暂停任务：不再发出新的请求，进行中的请求会继续完成。"""
+    job = _get_job(job_id)
+    if job is None:
+        return
+    with job["lock"]:
+        if job["status"] == "running":
+            job["pause_event"].set()
+            job["status"] = "paused"
+
+def resume_job(job_id):
+    job = _get_job(job_id)
+    if job is None:
+        return
+    with job["lock"]:
+        if job["status"] == "paused":
+            job["pause_event"].clear()
+            job["status"] = "running"
+
+def cancel_job(job_id):
+    """取消任务：已完成的结果保留，进行中的请求被中止。"""
+    job = _get_job(job_id)
+    if job is None:
+        return
+    with job["lock"]:
+        if job["status"] in ("running", "paused"):
+            job["cancel_event"].set()
+            job["status"] = "cancelling"
+
+def remove_job(job_id):
+    """从任务列表中移除已结束的任务（运行中的任务不会被移除）。"""
+    registry = _get_job_registry()
+    with registry["lock"]:
+        job = registry["jobs"].get(job_id)
+        if job is not None and job["status"] not in ACTIVE_JOB_STATUSES:
+            del registry["jobs"][job_id]
+            release_content_owner(job_id)
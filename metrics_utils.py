@@ -0,0 +1,120 @@
+import collections
+import json
+import os
+import threading
+import time
+
+METRICS_BUFFER_SIZE = int(os.getenv("METRICS_BUFFER_SIZE", "5000"))  # 内存中保留的最近记录条数
+METRICS_LOG_FILE = os.getenv("METRICS_LOG_FILE", "")  # 设置后每条记录同时追加写入该JSONL文件
+
+_records = collections.deque(maxlen=METRICS_BUFFER_SIZE)  # 在所有会话与重新运行之间共享
+_records_lock = threading.Lock()
+
+def record_metric(kind, **fields):
+    """
+    记录一条性能数据，可在任意线程中调用。
+
+    参数:
+    - kind (str): 记录类型，"request"（一次模型调用）、"parse"（一个文件的解析）、"batch"（一次批量处理）
+      或 "pack_fallback"（打包请求的回应无效，部分文件改为单独请求）。
+    - fields: 记录内容，如 wall_time、queue_wait、prompt_tokens、completion_tokens、retries、cached、bytes 等。
+    """
+    record = {"kind": kind, "ts": time.time(), **fields}
+    with _records_lock:
+        _records.append(record)
+        if METRICS_LOG_FILE:
+            try:
+                with open(METRICS_LOG_FILE, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except OSError:
+                pass  # 日志写入失败不影响正常处理
+    return record
+
+def get_metric_records(kind=None, batch_id=None):
+    """返回内存中的记录（从旧到新），可按类型和批次过滤。"""
+    with _records_lock:
+        records = list(_records)
+    return [
+        record for record in records
+        if (kind is None or record["kind"] == kind) and (batch_id is None or record.get("batch_id") == batch_id)
+    ]
+
+def clear_metrics():
+    """清空内存中的记录（不影响已写入的JSONL文件）。"""
+    with _records_lock:
+        _records.clear()
+
+def export_metrics_jsonl():
+    """把内存中的全部记录导出为JSONL文本。"""
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in get_metric_records())
+
+def _percentile(values, percent):
+    """最近秩法计算百分位数，values 为空时返回None。"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))  # 向上取整
+    return ordered[int(rank) - 1]
+
+def summarize_requests(records):
+    """
+    汇总一组 "request" 记录。
+
+    返回:
+    - dict: {"requests", "cached", "errors", "retries", "p50_latency", "p95_latency",
+             "p50_queue_wait", "p95_queue_wait", "p95_throttle_wait", "prompt_tokens", "completion_tokens",
+             "tokens_per_second"}，throttle_wait 为客户端限流造成的等待。
+            延迟只统计实际发送给模型的请求；tokens_per_second 为输出token数除以这些请求的总耗时。
+    """
+    sent = [record for record in records if not record.get("cached")]
+    succeeded = [record for record in sent if not record.get("error")]
+    latencies = [record["wall_time"] for record in succeeded]
+    queue_waits = [record["queue_wait"] for record in sent if record.get("queue_wait") is not None]
+    throttle_waits = [record["throttle_wait"] for record in sent if record.get("throttle_wait") is not None]
+    completion_tokens = sum(record.get("completion_tokens") or 0 for record in succeeded)
+    total_time = sum(latencies)
+    return {
+        "requests": len(records),
+        "cached": len(records) - len(sent),
+        "errors": len(sent) - len(succeeded),
+        "retries": sum(record.get("retries") or 0 for record in sent),
+        "p50_latency": _percentile(latencies, 50),
+        "p95_latency": _percentile(latencies, 95),
+        "p50_queue_wait": _percentile(queue_waits, 50),
+        "p95_queue_wait": _percentile(queue_waits, 95),
+        "p95_throttle_wait": _percentile(throttle_waits, 95),
+        "prompt_tokens": sum(record.get("prompt_tokens") or 0 for record in succeeded),
+        "completion_tokens": completion_tokens,
+        "tokens_per_second": completion_tokens / total_time if total_time > 0 else None,
+    }
+
+def summarize_batches(limit=5):
+    """
+    汇总最近 limit 次批量处理（新的在前）。
+
+    返回:
+    - list: [{"batch_id", "started_at", "wall_time", "files", "completed", "bytes_parsed", "parse_time",
+              "slowest_file", **summarize_requests(该批次的请求记录)}]
+    """
+    summaries = []
+    for batch_record in reversed(get_metric_records("batch")[-limit:]):
+        batch_id = batch_record["batch_id"]
+        parse_records = get_metric_records("parse", batch_id)
+        request_records = get_metric_records("request", batch_id)
+        slowest = max(
+            (record for record in request_records if not record.get("cached")),
+            key=lambda record: record["wall_time"],
+            default=None,
+        )
+        summaries.append({
+            "batch_id": batch_id,
+            "started_at": batch_record["ts"] - batch_record["wall_time"],
+            "wall_time": batch_record["wall_time"],
+            "files": batch_record["files"],
+            "completed": batch_record["completed"],
+            "bytes_parsed": sum(record.get("bytes") or 0 for record in parse_records),
+            "parse_time": sum(record.get("wall_time") or 0 for record in parse_records),
+            "slowest_file": slowest["label"] if slowest else None,
+            **summarize_requests(request_records),
+        })
+    return summaries
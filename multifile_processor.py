@@ -0,0 +1,282 @@
+"""
+无界面的批量处理命令行工具，处理逻辑与 Streamlit 应用相同（batch_utils.iter_batch_analysis）。
+
+用法:
+    python -m multifile_processor run --instruction "请总结..." --input docs/ --out results/ --concurrency 8
+
+每个文件完成后立即追加到输出目录的 results.jsonl（检查点）。任务中断后用相同的命令重新运行，
+已完成的文件会被跳过。结果格式与应用中的 files_data 相同，可在应用的“导入命令行批处理结果”中载入继续对话。
+"""
+import argparse
+import json
+import os
+import pathlib
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from batch_utils import DEFAULT_MAX_CONCURRENCY, iter_batch_analysis
+from content_utils import compact_file_entry, get_content, get_prompt_content_hashes, put_content
+from dedup_utils import DEDUP_NEAR_MODES, DEFAULT_DEDUP_OPTIONS
+from ingest_utils import DEFAULT_EXCEL_OPTIONS, EXCEL_OUTPUT_FORMATS, EXCEL_SAMPLING_MODES, SUPPORTED_FILE_TYPES
+
+RESULTS_FILE = "results.jsonl" # 每行一个已完成的文件: {"filename", "file_data", "contents"}，contents 为条目引用的内容（哈希 -> 文本）
+FAILURES_FILE = "failures.jsonl" # 每行一次失败记录: {"filename", "error", "time"}；失败的文件在下次运行时重试
+JOB_FILE = "job.json" # 任务参数，用于在续跑时检查指令是否一致
+
+def collect_input_files(input_paths):
+    """
+    收集待处理的文件（目录会被递归展开，只保留支持的文件类型）。
+
+    返回:
+    - list: [(文件名, 文件路径)]，目录中的文件以相对该目录的路径作为文件名，避免不同子目录中的同名文件冲突。
+    """
+    supported_suffixes = tuple(f".{file_type}" for file_type in SUPPORTED_FILE_TYPES)
+    collected = {}
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            for root, dirs, files in os.walk(input_path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(supported_suffixes):
+                        path = os.path.join(root, name)
+                        collected[os.path.relpath(path, input_path).replace(os.sep, "/")] = path
+        elif os.path.isfile(input_path):
+            collected[os.path.basename(input_path)] = input_path
+        else:
+            raise FileNotFoundError(f"找不到输入路径: {input_path}")
+    return list(collected.items())
+
+def load_results(out_dir):
+    """
+    读取输出目录中已完成文件的结果（检查点）。
+
+    末尾因中断而写了一半的行会被忽略；同一文件出现多次时以最后一次为准。
+
+    返回:
+    - dict: 文件名 -> files_data 格式的条目。
+    """
+    results_path = os.path.join(out_dir, RESULTS_FILE)
+    files_data = {}
+    if not os.path.exists(results_path):
+        return files_data
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            for content_hash, text in (record.get("contents") or {}).items():
+                put_content(content_hash, text)
+            files_data[record["filename"]] = compact_file_entry(record["file_data"])
+    return files_data
+
+def _append_jsonl(path, record):
+    """追加一行并立即落盘，保证中断时已完成的结果不会丢失。"""
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def _truncate_torn_line(path):
+    """截去文件末尾因中断而写了一半的行，使之后追加的记录从新的一行开始。"""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        position = f.seek(0, os.SEEK_END)
+        while position > 0: # 从末尾向前查找最后一个换行符，不读取整个文件
+            block_start = max(0, position - 64 * 1024)
+            f.seek(block_start)
+            newline_index = f.read(position - block_start).rfind(b"\n")
+            if newline_index >= 0:
+                position = block_start + newline_index + 1
+                break
+            position = block_start
+        f.truncate(position)
+
+def _check_job_parameters(out_dir, instruction, excel_options):
+    """首次运行时记录任务参数；续跑时若指令或 Excel 选项不同则报错，避免混合两种指令的结果。"""
+    job_path = os.path.join(out_dir, JOB_FILE)
+    job = {"instruction": instruction, "excel_options": excel_options}
+    if os.path.exists(job_path):
+        with open(job_path, "r", encoding="utf-8") as f:
+            previous_job = json.load(f)
+        if previous_job != job:
+            raise ValueError(
+                f"输出目录 {out_dir} 中已有使用不同指令或 Excel 选项的任务。请使用新的输出目录，或删除其中的 {JOB_FILE} 和 {RESULTS_FILE}。"
+            )
+        return
+    with open(job_path, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False, indent=2)
+
+def run_job(
+    api_key,
+    input_paths,
+    instruction,
+    out_dir,
+    max_workers=DEFAULT_MAX_CONCURRENCY,
+    bypass_cache=False,
+    excel_options=None,
+    dedup_options=None,
+    pack_small_files=False,
+    log=print,
+):
+    """
+    批量处理文件并把每个完成的文件写入检查点，已在检查点中的文件会被跳过。
+
+    参数:
+    - api_key (str): OpenAI API密钥。
+    - input_paths (list): 文件或目录路径。
+    - instruction (str): 通用处理指令。
+    - out_dir (str): 输出目录，不存在时自动创建。
+    - max_workers (int): 同时进行中的最大请求数。
+    - bypass_cache (bool): 为True时不读取响应缓存。
+    - excel_options (dict): Excel 读取选项，见 ingest_utils.DEFAULT_EXCEL_OPTIONS。
+    - dedup_options (dict): 重复文件检测选项，见 dedup_utils.DEFAULT_DEDUP_OPTIONS。
+      重复文件只在本次运行的文件之间检测，检查点中已完成的文件不参与。
+    - pack_small_files (bool): 为True时把多个小文件合并为一次请求，见 batch_utils.iter_batch_analysis。
+    - log (callable): 输出进度信息的函数。
+
+    返回:
+    - dict: {"total", "skipped", "completed", "failed", "cached", "deduplicated", "seconds"}
+    """
+    excel_options = {**DEFAULT_EXCEL_OPTIONS, **(excel_options or {})}
+    os.makedirs(out_dir, exist_ok=True)
+    _check_job_parameters(out_dir, instruction, excel_options)
+
+    input_files = collect_input_files(input_paths)
+    finished = load_results(out_dir)
+    pending_files = [(filename, path) for filename, path in input_files if filename not in finished]
+    summary = {
+        "total": len(input_files),
+        "skipped": len(input_files) - len(pending_files),
+        "completed": 0,
+        "failed": 0,
+        "cached": 0,
+        "deduplicated": 0,
+        "seconds": 0.0,
+    }
+    if summary["skipped"]:
+        log(f"检查点中已有 {summary['skipped']} 个文件的结果，将跳过。")
+    if not pending_files:
+        log("没有需要处理的文件。")
+        return summary
+
+    results_path = os.path.join(out_dir, RESULTS_FILE)
+    failures_path = os.path.join(out_dir, FAILURES_FILE)
+    for path in (results_path, failures_path):
+        _truncate_torn_line(path)
+    file_sources = [(filename, lambda path=path: pathlib.Path(path).read_bytes()) for filename, path in pending_files]
+    started_at = time.monotonic()
+    try:
+        for event in iter_batch_analysis(
+            api_key, file_sources, instruction, max_workers, bypass_cache=bypass_cache, excel_options=excel_options,
+            dedup_options=dedup_options, pack_small_files=pack_small_files,
+        ):
+            if event["event"] == "parsed":
+                for _, notice_text in event["notices"]:
+                    log(f"  提示: {notice_text}")
+                if event["error"]:
+                    log(f"  读取 {event['filename']} 时发生错误: {event['error']}")
+                continue
+            if event["event"] != "result":
+                continue
+            progress = f"[{summary['skipped'] + event['completed']}/{summary['total']}]"
+            if event["file_data"]:
+                contents = {
+                    content_hash: get_content(content_hash) for content_hash in get_prompt_content_hashes(event["file_data"])
+                }
+                _append_jsonl(results_path, {"filename": event["filename"], "file_data": event["file_data"], "contents": contents})
+                summary["completed"] += 1
+                summary["cached"] += event["cached"]
+                duplicate_of = event["duplicate_of"]
+                if duplicate_of and duplicate_of["analysis"] != "full":
+                    summary["deduplicated"] += 1
+                    note = (
+                        f" (与 {duplicate_of['filename']} 相同，复用其结果)" if duplicate_of["analysis"] == "reused"
+                        else f" (与 {duplicate_of['filename']} 相似 {duplicate_of['similarity']:.0%}，只分析差异)"
+                    )
+                else:
+                    note = " (来自缓存)" if event["cached"] else ""
+                log(f"{progress} 完成 {event['filename']}{note}")
+            else:
+                _append_jsonl(failures_path, {"filename": event["filename"], "error": event["error"], "time": time.time()})
+                summary["failed"] += 1
+                log(f"{progress} 失败 {event['filename']}: {event['error']}")
+    finally:
+        summary["seconds"] = time.monotonic() - started_at
+    return summary
+
+def _build_parser():
+    parser = argparse.ArgumentParser(prog="python -m multifile_processor", description="批量文件智能处理（命令行）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="批量分析文件，可中断后续跑")
+    instruction_group = run_parser.add_mutually_exclusive_group(required=True)
+    instruction_group.add_argument("--instruction", help="通用处理指令")
+    instruction_group.add_argument("--instruction-file", help="从文本文件读取通用处理指令")
+    run_parser.add_argument("--input", nargs="+", required=True, help="待处理的文件或目录（目录会被递归展开）")
+    run_parser.add_argument("--out", required=True, help="输出目录（检查点与结果）")
+    run_parser.add_argument("--concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY, help="最大并发请求数")
+    run_parser.add_argument("--bypass-cache", action="store_true", help="跳过响应缓存，强制重新请求")
+    run_parser.add_argument("--api-key", help="OpenAI API密钥，默认读取环境变量 OPENAI_API_KEY")
+    run_parser.add_argument("--excel-format", choices=list(EXCEL_OUTPUT_FORMATS), default=DEFAULT_EXCEL_OPTIONS["output_format"])
+    run_parser.add_argument("--excel-max-rows", type=int, default=DEFAULT_EXCEL_OPTIONS["max_rows_per_sheet"], help="每个工作表最多保留的行数，0 表示不限制")
+    run_parser.add_argument("--excel-max-columns", type=int, default=DEFAULT_EXCEL_OPTIONS["max_columns"], help="每行最多保留的列数，0 表示不限制")
+    run_parser.add_argument("--excel-sampling", choices=list(EXCEL_SAMPLING_MODES), default=DEFAULT_EXCEL_OPTIONS["sampling"])
+    run_parser.add_argument("--pack-small-files", action="store_true", help="把多个小文件合并为一次请求，大幅减少请求数")
+    run_parser.add_argument("--no-skip-exact", action="store_true", help="内容完全相同的文件也分别请求分析")
+    run_parser.add_argument("--near-duplicates", choices=list(DEDUP_NEAR_MODES), default=DEFAULT_DEDUP_OPTIONS["near_mode"], help="近似重复文件的处理方式")
+    run_parser.add_argument("--similarity-threshold", type=float, default=DEFAULT_DEDUP_OPTIONS["threshold"], help="视为近似重复的最低相似度 (0~1)")
+    return parser
+
+def main(argv=None):
+    load_dotenv()
+    args = _build_parser().parse_args(argv)
+
+    api_key = args.api_key or os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        print("缺少API密钥：请使用 --api-key 或设置环境变量 OPENAI_API_KEY。", file=sys.stderr)
+        return 2
+    if args.instruction_file:
+        with open(args.instruction_file, "r", encoding="utf-8") as f:
+            instruction = f.read().strip()
+    else:
+        instruction = args.instruction.strip()
+    if not instruction:
+        print("处理指令不能为空。", file=sys.stderr)
+        return 2
+    excel_options = {
+        "output_format": args.excel_format,
+        "max_rows_per_sheet": args.excel_max_rows,
+        "max_columns": args.excel_max_columns,
+        "sampling": args.excel_sampling,
+    }
+    dedup_options = {
+        "skip_exact": not args.no_skip_exact,
+        "near_mode": args.near_duplicates,
+        "threshold": args.similarity_threshold,
+    }
+
+    try:
+        summary = run_job(
+            api_key, args.input, instruction, args.out, args.concurrency,
+            bypass_cache=args.bypass_cache, excel_options=excel_options, dedup_options=dedup_options,
+            pack_small_files=args.pack_small_files,
+        )
+    except KeyboardInterrupt:
+        print(f"\n已中断。已完成的文件保存在 {os.path.join(args.out, RESULTS_FILE)}，重新运行相同的命令即可继续。", file=sys.stderr)
+        return 130
+    except (FileNotFoundError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 2
+    print(
+        f"共 {summary['total']} 个文件：本次完成 {summary['completed']} 个 (缓存命中 {summary['cached']}，"
+        f"重复或相似文件免于完整分析 {summary['deduplicated']})，"
+        f"失败 {summary['failed']} 个，跳过 {summary['skipped']} 个，用时 {summary['seconds']:.1f} 秒。"
+    )
+    return 1 if summary["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
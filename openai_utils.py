@@ -1,7 +1,434 @@
+import email.utils
+import hashlib
+import html
+import os
+import random
+import re
+import threading
+import time
+
+import httpx
 import openai
 import streamlit as st
 
-def get_gpt4o_response(api_key, messages):
+from cache_utils import get_cached_response, store_cached_response
+from chunking_utils import count_tokens
+from metrics_utils import record_metric
+
+MODEL_NAME = "gpt-4o"  # 或者您希望使用的特定模型如 "gpt-4o-2024-05-13"
+
+# --- 连接与重试配置 (可通过环境变量覆盖) ---
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))  # 建立连接的超时秒数
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", "180"))  # 等待响应数据的超时秒数
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))  # 429/5xx/网络错误的最大重试次数
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "1.0"))  # 指数退避的初始秒数
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "60"))  # 指数退避单次等待的上限秒数（不限制 Retry-After）
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "64"))  # 每个客户端的连接池大小
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None  # 兼容OpenAI接口的服务地址，如本地模拟服务；默认使用官方API
+
+# --- 客户端限流配置：初始值按环境变量设置，之后根据响应头 x-ratelimit-* 自动调整 ---
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))  # 每分钟请求数上限
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))  # 每分钟token数上限
+ESTIMATED_COMPLETION_TOKENS = int(os.getenv("ESTIMATED_COMPLETION_TOKENS", "1000"))  # 发送前预估的回应token数
+INTERACTIVE_RESERVE_RATIO = 0.1  # 为对话请求保留的额度比例，批量请求不会用掉这部分
+PRIORITY_INTERACTIVE = "interactive"  # 用户在对话中等待的请求，优先发送
+PRIORITY_BATCH = "batch"  # 批量分析请求
+RATE_LIMIT_RESET_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+
+# 打包请求（多个小文件合并为一次请求）要求的结构化输出：每个文件一项分析结果
+PACKED_ANALYSIS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "file_analyses",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "files": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "filename": {"type": "string"},
+                            "analysis": {"type": "string"},
+                        },
+                        "required": ["filename", "analysis"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["files"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+_clients = {}  # API密钥的哈希 -> openai.OpenAI，在所有会话与重新运行之间共享
+_rate_limiters = {}  # API密钥的哈希 -> 该密钥的令牌桶（见 _new_rate_limiter）
+_clients_lock = threading.Lock()
+
+def _client_key(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+def get_openai_client(api_key):
+    """
+    获取（或创建）与API密钥对应的共享OpenAI客户端。
+
+    客户端在进程内按密钥缓存，复用同一个保持长连接的HTTP连接池，
+    避免每次请求都重新建立连接和TLS握手。SDK自带的重试被关闭，
+    由 _call_with_retries 统一处理。
+    """
+    client_key = _client_key(api_key)
+    with _clients_lock:
+        client = _clients.get(client_key)
+        if client is None:
+            client = openai.OpenAI(
+                api_key=api_key,
+                base_url=OPENAI_BASE_URL,
+                timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+                max_retries=0,
+                http_client=openai.DefaultHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                    )
+                ),
+            )
+            _clients[client_key] = client
+        return client
+
+def _is_retryable_error(error):
+    """判断异常是否属于可以重试的暂时性错误（限流、服务端错误、网络/超时）。"""
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500
+    return False
+
+def _get_retry_after_seconds(error):
+    """从错误响应的 Retry-After / retry-after-ms 头中解析服务端建议的等待秒数。"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:  # HTTP-date 格式
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _get_backoff_seconds(attempt, error):
+    """
+    计算第 attempt 次重试前的等待时间：带完全抖动的指数退避，且不短于 Retry-After。
+
+    OPENAI_BACKOFF_MAX 只限制计算出的退避时间，服务端通过 Retry-After 要求的等待时间原样遵守。
+    """
+    backoff = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * (2 ** attempt)))
+    retry_after = _get_retry_after_seconds(error)
+    if retry_after is not None:
+        return max(retry_after, backoff)
+    return backoff
+
+def _call_with_retries(request_fn, call_stats=None):
+    """
+    执行 request_fn，遇到可重试错误时按退避策略重试，重试用尽后抛出最后一次的异常。
+
+    提供 call_stats (dict) 时，会把重试次数记录在 call_stats["retries"] 中。
+    """
+    attempt = 0
+    while True:
+        try:
+            return request_fn()
+        except Exception as e:
+            if attempt >= OPENAI_MAX_RETRIES or not _is_retryable_error(e):
+                raise
+            time.sleep(_get_backoff_seconds(attempt, e))
+            attempt += 1
+            if call_stats is not None:
+                call_stats["retries"] = attempt
+
+def _new_bucket(per_minute):
+    return {"capacity": float(per_minute), "rate": per_minute / 60.0, "level": float(per_minute), "updated_at": time.monotonic()}
+
+def _new_rate_limiter():
+    """一个API密钥的令牌桶（请求数与token数各一个）。"""
+    return {
+        "requests": _new_bucket(OPENAI_RPM_LIMIT),
+        "tokens": _new_bucket(OPENAI_TPM_LIMIT),
+        "waiting_interactive": 0,
+        "condition": threading.Condition(),
+    }
+
+def _get_rate_limiter(api_key):
+    """
+    获取（或创建）与API密钥对应的令牌桶。
+
+    额度和响应头中的 x-ratelimit-* 都属于各自的账户，因此每个密钥单独限流；
+    使用同一密钥的所有会话与后台任务共用这一份额度。
+    """
+    client_key = _client_key(api_key)
+    with _clients_lock:
+        rate_limiter = _rate_limiters.get(client_key)
+        if rate_limiter is None:
+            rate_limiter = _rate_limiters[client_key] = _new_rate_limiter()
+        return rate_limiter
+
+def _refill(bucket, now):
+    bucket["level"] = min(bucket["capacity"], bucket["level"] + (now - bucket["updated_at"]) * bucket["rate"])
+    bucket["updated_at"] = now
+
+def estimate_rate_limit_tokens(messages):
+    """发送前估算一次请求计入TPM的token数（输入token + 预估的回应token）。"""
+    return sum(count_tokens(message.get("content") or "") for message in messages) + ESTIMATED_COMPLETION_TOKENS
+
+def _acquire_rate_limit(rate_limiter, estimated_tokens, priority):
+    """
+    等待令牌桶中有足够的额度后扣除，返回等待的秒数。
+
+    对话请求优先：有对话请求在等待时批量请求不会取走额度，且批量请求不能使用为对话保留的部分。
+    单个请求超过桶容量时只要求桶满，避免永远等待。
+    """
+    condition = rate_limiter["condition"]
+    requests_bucket, tokens_bucket = rate_limiter["requests"], rate_limiter["tokens"]
+    started_at = time.monotonic()
+    with condition:
+        interactive = priority == PRIORITY_INTERACTIVE
+        if interactive:
+            rate_limiter["waiting_interactive"] += 1
+        try:
+            while True:
+                now = time.monotonic()
+                _refill(requests_bucket, now)
+                _refill(tokens_bucket, now)
+                reserve = 0.0 if interactive else INTERACTIVE_RESERVE_RATIO
+                needed_requests = 1 + requests_bucket["capacity"] * reserve
+                needed_tokens = min(estimated_tokens, tokens_bucket["capacity"]) + tokens_bucket["capacity"] * reserve
+                if (interactive or rate_limiter["waiting_interactive"] == 0) and \
+                        requests_bucket["level"] >= min(needed_requests, requests_bucket["capacity"]) and \
+                        tokens_bucket["level"] >= min(needed_tokens, tokens_bucket["capacity"]):
+                    requests_bucket["level"] -= 1
+                    tokens_bucket["level"] -= estimated_tokens # 允许为负，超出的部分由之后的补充抵消
+                    return now - started_at
+                wait_seconds = max(
+                    (needed_requests - requests_bucket["level"]) / requests_bucket["rate"],
+                    (needed_tokens - tokens_bucket["level"]) / tokens_bucket["rate"],
+                    0.01,
+                )
+                condition.wait(min(wait_seconds, 1.0))
+        finally:
+            if interactive:
+                rate_limiter["waiting_interactive"] -= 1
+                condition.notify_all()
+
+def _settle_rate_limit(rate_limiter, estimated_tokens, actual_tokens):
+    """请求完成后按实际用量修正token桶（多退少补）。"""
+    if actual_tokens is None:
+        return
+    with rate_limiter["condition"]:
+        rate_limiter["tokens"]["level"] += estimated_tokens - actual_tokens
+        rate_limiter["condition"].notify_all()
+
+def _parse_reset_seconds(value):
+    """解析 x-ratelimit-reset-* 头中的时长，如 "1s"、"6m0s"、"20ms"。"""
+    if not value:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    matches = RATE_LIMIT_RESET_PATTERN.findall(value)
+    return sum(float(number) * units[unit] for number, unit in matches) if matches else None
+
+def _update_rate_limits(rate_limiter, headers):
+    """
+    根据响应头 x-ratelimit-limit-* / x-ratelimit-remaining-* / x-ratelimit-reset-* 调整令牌桶。
+
+    上限决定桶容量与补充速度；剩余额度低于本地记录时以服务端为准（只向下校正，
+    避免重复计入仍在进行中的请求），并按重置时间推算补充速度。
+    """
+    if headers is None:
+        return
+    with rate_limiter["condition"]:
+        now = time.monotonic()
+        for kind in ("requests", "tokens"):
+            bucket = rate_limiter[kind]
+            try:
+                limit = float(headers.get(f"x-ratelimit-limit-{kind}") or 0)
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                remaining = float(remaining) if remaining is not None else None
+            except ValueError:
+                continue
+            _refill(bucket, now)
+            if limit > 0:
+                bucket["capacity"] = limit
+                bucket["rate"] = limit / 60.0
+            if remaining is not None and remaining < bucket["level"]:
+                bucket["level"] = remaining
+                reset_seconds = _parse_reset_seconds(headers.get(f"x-ratelimit-reset-{kind}"))
+                if reset_seconds and limit > 0:
+                    # 服务端在 reset_seconds 内恢复到上限，补充速度不应快于此
+                    bucket["rate"] = min(bucket["rate"], max(limit - remaining, 1.0) / reset_seconds)
+        rate_limiter["condition"].notify_all()
+
+def _send_request(client, rate_limiter, request_kwargs, estimated_tokens, priority, call_stats):
+    """
+    经过限流后发送一次请求，返回解析后的结果（流式请求为数据流）。
+
+    使用 with_raw_response 读取响应头以调整限流额度；限流错误的响应头同样会被用于调整。
+    """
+    call_stats["throttle_wait"] = (
+        call_stats.get("throttle_wait", 0.0) + _acquire_rate_limit(rate_limiter, estimated_tokens, priority)
+    )
+    try:
+        raw_response = client.chat.completions.with_raw_response.create(**request_kwargs)
+    except openai.APIStatusError as e:
+        _update_rate_limits(rate_limiter, e.response.headers)
+        _settle_rate_limit(rate_limiter, estimated_tokens, 0) # 失败的请求不消耗token额度
+        raise
+    _update_rate_limits(rate_limiter, raw_response.headers)
+    return raw_response.parse()
+
+def _record_request(started_at, call_stats, metric_tags, **fields):
+    """记录一次模型调用的耗时、重试与token用量，metric_tags 中的标签（如 source、label、batch_id）一并记录。"""
+    record_metric(
+        "request",
+        model=MODEL_NAME,
+        wall_time=time.monotonic() - started_at,
+        retries=call_stats.get("retries", 0),
+        throttle_wait=call_stats.get("throttle_wait", 0.0),
+        **(metric_tags or {}),
+        **fields,
+    )
+
+def request_gpt4o_completion(api_key, messages, use_cache=True, metric_tags=None, priority=PRIORITY_INTERACTIVE):
+    """
+    调用GPT-4o模型并返回回应内容，出错时直接抛出异常。
+
+    与 get_gpt4o_response 不同，此函数不调用任何 Streamlit 组件，
+    因此可以安全地在后台线程（如批量并发处理）中使用。
+    暂时性错误（429、5xx、网络超时）会按指数退避自动重试。
+    use_cache 为 False 时跳过缓存读取（强制重新请求），但仍会用新结果刷新缓存。
+    每次调用都会记录一条性能数据，metric_tags 为附加在记录上的标签。
+    请求经过该API密钥的客户端限流，priority 为 PRIORITY_INTERACTIVE（默认）或 PRIORITY_BATCH。
+    """
+    started_at = time.monotonic()
+    call_stats = {}
+    if use_cache:
+        cached_response = get_cached_response(MODEL_NAME, messages)
+        if cached_response is not None:
+            _record_request(started_at, call_stats, metric_tags, cached=True)
+            return cached_response
+    client = get_openai_client(api_key)
+    rate_limiter = _get_rate_limiter(api_key)
+    estimated_tokens = estimate_rate_limit_tokens(messages)
+    try:
+        completion = _call_with_retries(
+            lambda: _send_request(
+                client, rate_limiter, {"model": MODEL_NAME, "messages": messages}, estimated_tokens, priority, call_stats
+            ),
+            call_stats,
+        )
+    except Exception as e:
+        _record_request(started_at, call_stats, metric_tags, cached=False, error=str(e))
+        raise
+    usage = completion.usage
+    _settle_rate_limit(rate_limiter, estimated_tokens, usage.total_tokens if usage else None)
+    _record_request(
+        started_at, call_stats, metric_tags, cached=False,
+        prompt_tokens=usage.prompt_tokens if usage else None,
+        completion_tokens=usage.completion_tokens if usage else None,
+    )
+    response = completion.choices[0].message.content
+    store_cached_response(MODEL_NAME, messages, response)
+    return response
+
+def stream_gpt4o_completion(
+    api_key, messages, use_cache=True, metric_tags=None, priority=PRIORITY_INTERACTIVE, response_format=None
+):
+    """
+    以流式方式调用GPT-4o模型，逐段产出回应文本，出错时直接抛出异常。
+
+    只有在收到第一个数据块之前发生的暂时性错误才会重试；完整回应会在流结束后写入缓存。
+    缓存命中时一次性产出完整内容。性能数据（含首个数据块的等待时间）在流结束或中断时记录。
+    限流与 priority 的含义同 request_gpt4o_completion。
+    response_format 为结构化输出的格式要求（如 PACKED_ANALYSIS_RESPONSE_FORMAT），产出的是JSON文本片段。
+    """
+    started_at = time.monotonic()
+    call_stats = {}
+    if use_cache:
+        cached_response = get_cached_response(MODEL_NAME, messages)
+        if cached_response is not None:
+            _record_request(started_at, call_stats, metric_tags, cached=True)
+            yield cached_response
+            return
+    client = get_openai_client(api_key)
+    rate_limiter = _get_rate_limiter(api_key)
+    estimated_tokens = estimate_rate_limit_tokens(messages)
+    request_kwargs = {
+        "model": MODEL_NAME,
+        "messages": messages,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+    if response_format is not None:
+        request_kwargs["response_format"] = response_format
+    usage = None
+    first_token_at = None
+    error = None
+    try:
+        stream = _call_with_retries(
+            lambda: _send_request(client, rate_limiter, request_kwargs, estimated_tokens, priority, call_stats), call_stats
+        )
+        response_parts = []
+        for chunk in stream:
+            if chunk.usage: # 用量信息在最后一个（choices为空的）数据块中
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta_content = chunk.choices[0].delta.content
+            if delta_content:
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                response_parts.append(delta_content)
+                yield delta_content
+    except GeneratorExit:
+        error = "已中断"
+        raise
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        _settle_rate_limit(rate_limiter, estimated_tokens, usage.total_tokens if usage else None)
+        _record_request(
+            started_at, call_stats, metric_tags, cached=False, error=error,
+            time_to_first_token=first_token_at - started_at if first_token_at is not None else None,
+            prompt_tokens=usage.prompt_tokens if usage else None,
+            completion_tokens=usage.completion_tokens if usage else None,
+        )
+    store_cached_response(MODEL_NAME, messages, "".join(response_parts))
+
+def get_gpt4o_response_stream(api_key, messages, metric_tags=None):
+    """
+    get_gpt4o_response 的流式版本，适合直接传给 st.write_stream。
+
+    出错时显示错误信息并结束产出，已经产出的部分内容保持不变。
+    """
+    try:
+        yield from stream_gpt4o_completion(api_key, messages, metric_tags=metric_tags)
+    except Exception as e:
+        st.error(f"调用OpenAI API时发生错误: {e}")
+
+def get_gpt4o_response(api_key, messages, metric_tags=None):
     """
     使用GPT-4o模型获取回应。
 
@@ -10,17 +437,13 @@ def get_gpt4o_response(api_key, messages):
     - messages (list): 对话历史消息列表，格式为:
                        [{"role": "user", "content": "你好"},
                         {"role": "assistant", "content": "你好！有什么可以帮您？"}]
+    - metric_tags (dict): 附加在性能记录上的标签，如 {"source": "chat", "label": 文件名}。
 
     返回:
     - str: GPT-4o的回应内容，如果出错则返回None。
     """
     try:
-        client = openai.OpenAI(api_key=api_key)
-        completion = client.chat.completions.create(
-            model="gpt-4o",  # 或者您希望使用的特定模型如 "gpt-4o-2024-05-13"
-            messages=messages
-        )
-        return completion.choices[0].message.content
+        return request_gpt4o_completion(api_key, messages, metric_tags=metric_tags)
     except Exception as e:
         st.error(f"调用OpenAI API时发生错误: {e}")
         return None
@@ -40,4 +463,84 @@ def generate_initial_analysis_prompt(file_content_str, user_instruction):
 ---
 
 请提供您的分析结果：
-"""
\ No newline at end of file
+"""
+
+def generate_chunk_analysis_prompt(chunk_content_str, user_instruction, chunk_index, total_chunks):
+    """
+    为超长文件的单个分块生成分析提示（分块从1开始编号）。
+    """
+    return f"""以下是一个较长文件的第 {chunk_index}/{total_chunks} 部分，以及用户的处理指令。请仅根据这一部分的内容按指令进行分析，结论需可以与其他部分的结果合并。
+
+用户指令：
+{user_instruction}
+
+文件内容（第 {chunk_index}/{total_chunks} 部分）：
+---
+{chunk_content_str}
+---
+
+请提供这一部分的分析结果：
+"""
+
+def generate_reduce_prompt(chunk_responses, user_instruction):
+    """
+    生成把各分块分析结果合并为整体分析的提示。引用分块时使用 [块 N] 标记。
+    """
+    chunk_sections = "\n\n".join(
+        f"[块 {i}]\n{chunk_response}" for i, chunk_response in enumerate(chunk_responses, start=1)
+    )
+    return f"""以下文件因篇幅过长被分为 {len(chunk_responses)} 个部分分别分析。请根据用户指令，将各部分的分析结果合并为一份完整、去重、结构清晰的整体分析。引用具体问题时请注明来源，如 [块 2]。
+
+用户指令：
+{user_instruction}
+
+各部分的分析结果：
+---
+{chunk_sections}
+---
+
+请提供合并后的整体分析结果：
+"""
+
+def generate_diff_analysis_prompt(representative_filename, representative_response, content_diff, user_instruction):
+    """
+    为近似重复的文件生成只分析差异的提示：给出代表文件的分析结果及两者的差异。
+    """
+    return f"""以下文件与已分析过的文件 '{representative_filename}' 内容高度相似。请根据用户指令，参考该文件的分析结果，结合两者的差异，给出当前文件完整的分析结果。重点说明差异部分带来的新问题或已解决的问题；与代表文件相同的结论可以简要沿用。
+
+用户指令：
+{user_instruction}
+
+代表文件 '{representative_filename}' 的分析结果：
+---
+{representative_response}
+---
+
+当前文件相对代表文件的差异（unified diff，以 - 开头的行仅在代表文件中，以 + 开头的行仅在当前文件中）：
+---
+{content_diff}
+---
+
+请提供当前文件的分析结果：
+"""
+
+def generate_packed_analysis_prompt(files, user_instruction):
+    """
+    为打包在一次请求中的多个小文件生成分析提示，回应格式见 PACKED_ANALYSIS_RESPONSE_FORMAT。
+
+    参数:
+    - files (list): [(文件名, 文件内容)]。
+    """
+    file_sections = "\n\n".join(
+        f'<file name="{html.escape(filename)}">\n{content_str}\n</file>' for filename, content_str in files
+    )
+    return f"""以下是用户提供的 {len(files)} 个文件和处理指令。请根据指令分别分析每个文件，各文件的分析相互独立，不要混用其他文件的内容。
+
+用户指令：
+{user_instruction}
+
+文件内容（每个文件以 <file name="文件名"> 开始，以 </file> 结束）：
+{file_sections}
+
+请以JSON格式输出：files 数组中每个文件一项，顺序与上面相同；filename 为上面给出的文件名（原样照抄），analysis 为该文件完整的分析结果（可使用Markdown）。
+"""
@@ -1,42 +1,380 @@
+import contextlib
+import hashlib
 import json
+import sqlite3
 import streamlit as st
 import os
 
-STATE_FILE = "session_data.json"
+from content_utils import (
+    CONTENT_OWNER_KEY, compact_file_entry, compress_content, decompress_content, get_content, get_prompt_content_hashes, has_content,
+    put_content, retain_contents,
+)
+from history_utils import PROMPT_TOKENS_KEY
+from search_utils import (
+    SEARCH_AVAILABLE, SEARCH_INDEX_VERSION, index_content, index_text, remove_documents, remove_file, remove_unreferenced_contents,
+    reset_search_schema,
+)
 
-def save_app_state():
-    """将Streamlit session_state中的特定数据保存到文件。"""
-    state_to_save = {}
-    if 'files_data' in st.session_state:
-        state_to_save['files_data'] = st.session_state.files_data
-    if 'api_key' in st.session_state: # 保存API密钥可能不是最佳实践，但按需求保留
-        state_to_save['api_key'] = st.session_state.api_key
-    if 'user_general_instruction' in st.session_state:
-        state_to_save['user_general_instruction'] = st.session_state.user_general_instruction
+STATE_FILE = "session_data.json" # 旧版整体JSON状态文件，仅用于一次性迁移
+STATE_DB_FILE = "session_data.sqlite3"
+PERSISTED_SETTINGS = ("api_key", "user_general_instruction") # 保存API密钥可能不是最佳实践，但按需求保留
 
+# files 表中单独成列的字段；analyses 表保存分析结果；其余字段以JSON形式保存在 files.extra_json。
+# 文件内容按哈希压缩保存在 contents 表中，相同内容只保存一份；files 表中的 content_str 和
+# initial_user_prompt_content 两列仅用于读取旧版数据，新写入的行中为NULL。
+FILE_COLUMNS = ("content_hash", "initial_prompt_ref")
+ANALYSIS_COLUMNS = ("initial_response", "chunks")
+# 懒加载的文件条目只包含概要（initial_response），并带有 details_loaded=False 标记
+DETAILS_LOADED_KEY = "details_loaded"
+PERSISTED_INDEX_KEY = "persisted_files_index" # session_state 中记录已写入数据库内容的键
+# 不写入 files.extra_json 的字段：对话历史单独保存在 chat_messages 表中；加载状态与可重新计算的token数缓存
+# 只在内存中使用，它们的变化也不会使文件行需要重写
+NON_EXTRA_FILE_KEYS = ("chat_history", DETAILS_LOADED_KEY, PROMPT_TOKENS_KEY)
+SEARCH_INDEX_VERSION_KEY = "search_index_version" # settings 表中记录全文检索索引版本的键
+
+@contextlib.contextmanager
+def _connect(db_path):
+    """打开状态数据库连接（WAL模式），成功时提交事务，结束后关闭连接。"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        with conn:
+            _ensure_schema(conn)
+            yield conn
+    finally:
+        conn.close()
+
+def _ensure_schema(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            filename TEXT PRIMARY KEY,
+            content_str TEXT,
+            initial_user_prompt_content TEXT,
+            extra_json TEXT
+        );
+        CREATE TABLE IF NOT EXISTS analyses (
+            filename TEXT PRIMARY KEY REFERENCES files (filename) ON DELETE CASCADE,
+            initial_response TEXT,
+            chunks_json TEXT
+        );
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            filename TEXT NOT NULL REFERENCES files (filename) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT,
+            PRIMARY KEY (filename, seq)
+        );
+        CREATE TABLE IF NOT EXISTS contents (
+            content_hash TEXT PRIMARY KEY,
+            compression TEXT NOT NULL,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL
+        );
+        """
+    )
+    # 为旧版数据库补充新增的列
+    _add_missing_columns(conn, "files", {"content_hash": "TEXT", "prompt_ref_json": "TEXT"})
+    _add_missing_columns(conn, "chat_messages", {"prompt_ref": "TEXT"})
+    if SEARCH_AVAILABLE: # SQLite 不支持 FTS5 时不建立全文检索索引
+        version_row = conn.execute("SELECT value FROM settings WHERE key = ?", (SEARCH_INDEX_VERSION_KEY,)).fetchone()
+        if version_row is None or json.loads(version_row[0]) != SEARCH_INDEX_VERSION:
+            _rebuild_search_index(conn)
+
+def _add_missing_columns(conn, table, columns):
+    existing_columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for column, column_type in columns.items():
+        if column not in existing_columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+def _rebuild_search_index(conn):
+    """由数据库中已保存的数据整体重建全文检索索引（旧版数据库首次打开或索引版本变化时）。"""
+    reset_search_schema(conn)
+    for content_hash, compression, data in conn.execute(
+        "SELECT content_hash, compression, data FROM contents "
+        "WHERE content_hash IN (SELECT content_hash FROM files WHERE content_hash IS NOT NULL)"
+    ).fetchall():
+        index_content(conn, content_hash, decompress_content(compression, data))
+    # 旧版行（content_hash 为空）的文件内容在被加载并按新格式重写时索引
+    for filename, initial_response in conn.execute("SELECT filename, initial_response FROM analyses").fetchall():
+        index_text(conn, "analysis", filename, 0, initial_response)
+    for filename, seq, content in conn.execute(
+        "SELECT m.filename, m.seq, m.content FROM chat_messages m "
+        "JOIN files f ON f.filename = m.filename LEFT JOIN analyses a ON a.filename = m.filename "
+        "WHERE m.prompt_ref IS NULL AND m.content IS NOT NULL "
+        "AND m.content IS NOT a.initial_response AND m.content IS NOT f.initial_user_prompt_content"
+    ).fetchall():
+        index_text(conn, "message", filename, seq, content)
+    conn.execute(
+        "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+        (SEARCH_INDEX_VERSION_KEY, json.dumps(SEARCH_INDEX_VERSION)),
+    )
+
+def _fingerprint(value):
+    payload = json.dumps(value, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _split_file_entry(file_entry):
+    """把 files_data 中的一个条目拆分为 files 行、analyses 行和对话历史。"""
+    file_row = {column: file_entry.get(column) for column in FILE_COLUMNS}
+    file_row["extra"] = {
+        key: value for key, value in file_entry.items()
+        if key not in FILE_COLUMNS and key not in ANALYSIS_COLUMNS and key not in NON_EXTRA_FILE_KEYS
+    }
+    analysis_row = {column: file_entry.get(column) for column in ANALYSIS_COLUMNS}
+    return file_row, analysis_row, file_entry.get("chat_history", [])
+
+def _write_contents(conn, content_hashes):
+    """把尚未保存的内容压缩后写入 contents 表（已存在的哈希直接跳过）。"""
+    for content_hash in content_hashes:
+        if conn.execute("SELECT 1 FROM contents WHERE content_hash = ?", (content_hash,)).fetchone():
+            continue
+        text = get_content(content_hash)
+        if text is None:
+            continue
+        compression, data = compress_content(text)
+        conn.execute(
+            "INSERT INTO contents (content_hash, compression, data, size) VALUES (?, ?, ?, ?)",
+            (content_hash, compression, data, len(text)),
+        )
+
+def _delete_unreferenced_contents(conn):
+    """删除已没有任何文件引用的内容（及其全文检索索引）。"""
+    remove_unreferenced_contents(conn)
+    conn.execute(
+        "DELETE FROM contents WHERE content_hash NOT IN ("
+        "SELECT content_hash FROM files WHERE content_hash IS NOT NULL "
+        "UNION SELECT json_extract(prompt_ref_json, '$.content_hash') FROM files "
+        "WHERE json_extract(prompt_ref_json, '$.content_hash') IS NOT NULL)"
+    )
+
+def _load_contents(conn, content_hashes):
+    """把内容库中缺少的内容从 contents 表加载进来。"""
+    for content_hash in content_hashes:
+        if has_content(content_hash):
+            continue
+        row = conn.execute("SELECT compression, data FROM contents WHERE content_hash = ?", (content_hash,)).fetchone()
+        if row is not None:
+            put_content(content_hash, decompress_content(*row))
+
+def _write_file_entry(conn, filename, file_entry, persisted):
+    """
+    只把与上次保存相比发生变化的部分写入数据库，返回新的持久化记录。
+
+    persisted 为该文件上次保存时的记录 {"file", "content", "analysis", "messages", "last_message"}，
+    新文件或尚未加载过详情的文件为None。对话历史只追加新增消息；若已保存的部分被改写（如文件被重新分析），则整体重写。
+    全文检索索引随之增量更新。
+    """
+    file_row, analysis_row, chat_history = _split_file_entry(file_entry)
+    persisted = persisted or {"file": None, "content": None, "analysis": None, "messages": 0, "last_message": None}
+    file_fingerprint = _fingerprint(file_row)
+    content_fingerprint = _fingerprint({column: file_row[column] for column in FILE_COLUMNS})
+    analysis_fingerprint = _fingerprint(analysis_row)
+
+    if file_fingerprint != persisted["file"]:
+        _write_contents(conn, get_prompt_content_hashes(file_entry))
+        content_str = get_content(file_row["content_hash"]) if file_row["content_hash"] else None
+        if content_str is not None:
+            index_content(conn, file_row["content_hash"], content_str)
+        conn.execute(
+            "INSERT INTO files (filename, content_hash, prompt_ref_json, content_str, initial_user_prompt_content, extra_json) "
+            "VALUES (?, ?, ?, NULL, NULL, ?) "
+            "ON CONFLICT (filename) DO UPDATE SET content_hash = excluded.content_hash, "
+            "prompt_ref_json = excluded.prompt_ref_json, content_str = NULL, initial_user_prompt_content = NULL, "
+            "extra_json = excluded.extra_json",
+            (filename, file_row["content_hash"], json.dumps(file_row["initial_prompt_ref"], ensure_ascii=False),
+             json.dumps(file_row["extra"], ensure_ascii=False)),
+        )
+    if analysis_fingerprint != persisted["analysis"]:
+        remove_documents(conn, "analysis", filename) # 索引中的旧分析结果需在原文被改写前移除
+        conn.execute(
+            "INSERT INTO analyses (filename, initial_response, chunks_json) VALUES (?, ?, ?) "
+            "ON CONFLICT (filename) DO UPDATE SET initial_response = excluded.initial_response, "
+            "chunks_json = excluded.chunks_json",
+            (filename, analysis_row["initial_response"],
+             json.dumps(analysis_row["chunks"], ensure_ascii=False) if analysis_row["chunks"] else None),
+        )
+        index_text(conn, "analysis", filename, 0, analysis_row["initial_response"])
+
+    persisted_count = persisted["messages"]
+    history_rewritten = (
+        content_fingerprint != persisted["content"] # 新文件或文件被重新分析
+        or persisted_count > len(chat_history)
+        or (persisted_count > 0 and _fingerprint(chat_history[persisted_count - 1]) != persisted["last_message"])
+    )
+    if history_rewritten:
+        remove_documents(conn, "message", filename)
+        conn.execute("DELETE FROM chat_messages WHERE filename = ?", (filename,))
+        persisted_count = 0
+    new_messages = list(enumerate(chat_history[persisted_count:], start=persisted_count))
+    conn.executemany(
+        "INSERT INTO chat_messages (filename, seq, role, content, prompt_ref) VALUES (?, ?, ?, ?, ?)",
+        [(filename, seq, message["role"], message.get("content"), message.get("prompt_ref"))
+         for seq, message in new_messages],
+    )
+    for seq, message in new_messages:
+        # 初始请求（引用文件内容）和与分析结果相同的首条回复已分别作为文件内容和分析结果索引
+        if message.get("content") and message["content"] != analysis_row["initial_response"]:
+            index_text(conn, "message", filename, seq, message["content"])
+    return {
+        "file": file_fingerprint,
+        "content": content_fingerprint,
+        "analysis": analysis_fingerprint,
+        "messages": len(chat_history),
+        "last_message": _fingerprint(chat_history[-1]) if chat_history else None,
+    }
+
+def save_app_state(state=None, db_path=STATE_DB_FILE):
+    """
+    将 session_state 中的特定数据增量保存到SQLite数据库。
+
+    只写入自上次保存以来新增或变化的文件、分析结果和对话消息；
+    尚未加载详情的（懒加载）文件不会被改写。旧格式的文件条目会先被转换为引用内容库的紧凑格式。
+
+    返回:
+    - bool: 保存是否成功。
+    """
+    state = st.session_state if state is None else state
+    persisted_index = state.get(PERSISTED_INDEX_KEY) or {}
+    files_data = state.get("files_data") or {}
     try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(state_to_save, f, ensure_ascii=False, indent=4)
+        with _connect(db_path) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                [(key, json.dumps(state[key], ensure_ascii=False)) for key in PERSISTED_SETTINGS if key in state],
+            )
+            files_changed = False
+            for filename in [name for name in persisted_index if name not in files_data]: # 已被删除的文件
+                remove_file(conn, filename) # 在级联删除分析结果和对话之前移除其索引
+                conn.execute("DELETE FROM files WHERE filename = ?", (filename,))
+                del persisted_index[filename]
+                files_changed = True
+            for filename, file_entry in files_data.items():
+                if file_entry.get(DETAILS_LOADED_KEY) is False:
+                    continue
+                compact_file_entry(file_entry)
+                previous = persisted_index.get(filename)
+                persisted_index[filename] = _write_file_entry(conn, filename, file_entry, previous)
+                files_changed = files_changed or previous is None or previous["file"] != persisted_index[filename]["file"]
+            if files_changed:
+                _delete_unreferenced_contents(conn)
+        state[PERSISTED_INDEX_KEY] = persisted_index
+        return True
     except Exception as e:
         st.warning(f"保存应用状态失败: {e}")
+        return False
+
+def _migrate_json_state(db_path):
+    """如果存在旧版JSON状态文件且数据库中尚无文件，将其一次性导入数据库并重命名原文件。"""
+    if not os.path.exists(STATE_FILE):
+        return
+    with _connect(db_path) as conn:
+        if conn.execute("SELECT 1 FROM files LIMIT 1").fetchone():
+            return
+    with open(STATE_FILE, "r", encoding="utf-8") as f:
+        legacy_state = json.load(f)
+    legacy_state.setdefault("files_data", {})
+    if save_app_state(legacy_state, db_path):
+        os.replace(STATE_FILE, STATE_FILE + ".migrated")
+
+def load_app_state(state=None, db_path=STATE_DB_FILE):
+    """
+    从SQLite数据库加载应用状态到 session_state。
+
+    冷启动时只加载文件列表和分析概要；文件内容、分块结果和对话历史
+    在打开文件时通过 load_file_details 按需加载。
+    """
+    state = st.session_state if state is None else state
+    try:
+        _migrate_json_state(db_path)
+        if not os.path.exists(db_path):
+            return False
+        with _connect(db_path) as conn:
+            for key, value in conn.execute("SELECT key, value FROM settings"):
+                if key in PERSISTED_SETTINGS:
+                    state[key] = json.loads(value)
+            files_data = {}
+            for filename, initial_response, duplicate_of_json in conn.execute(
+                "SELECT f.filename, a.initial_response, json_extract(f.extra_json, '$.duplicate_of') "
+                "FROM files f LEFT JOIN analyses a ON a.filename = f.filename ORDER BY f.filename"
+            ):
+                files_data[filename] = {"initial_response": initial_response, DETAILS_LOADED_KEY: False}
+                if duplicate_of_json: # 概览中显示重复文件分组所需
+                    files_data[filename]["duplicate_of"] = json.loads(duplicate_of_json)
+        state["files_data"] = files_data
+        # 懒加载的文件记为None：保存时跳过，但在被删除时仍能从数据库中移除
+        state[PERSISTED_INDEX_KEY] = {filename: None for filename in files_data}
+        return True # 表示加载成功
+    except Exception as e:
+        st.warning(f"加载应用状态失败: {e}. 将使用默认值初始化。")
+        # 如果加载失败，确保核心结构存在
+        if 'files_data' not in state:
+            state["files_data"] = {} # filename -> data
+    return False # 表示未加载或加载失败
+
+def load_file_details(filename, state=None, db_path=STATE_DB_FILE):
+    """
+    为懒加载的文件补全内容、分块结果和对话历史。已加载或不存在的文件不做任何操作。
+
+    返回:
+    - dict: 该文件的完整数据；文件不存在、数据库中已没有该文件或加载失败时返回None
+            （懒加载的条目不含对话历史，不能当作完整数据使用）。
+    """
+    state = st.session_state if state is None else state
+    file_entry = state.get("files_data", {}).get(filename)
+    if file_entry is None or file_entry.get(DETAILS_LOADED_KEY) is not False:
+        return file_entry
+    try:
+        with _connect(db_path) as conn:
+            file_row = conn.execute(
+                "SELECT f.content_hash, f.prompt_ref_json, f.content_str, f.initial_user_prompt_content, f.extra_json, "
+                "a.initial_response, a.chunks_json "
+                "FROM files f LEFT JOIN analyses a ON a.filename = f.filename WHERE f.filename = ?",
+                (filename,),
+            ).fetchone()
+            chat_history = []
+            for role, content, prompt_ref in conn.execute(
+                "SELECT role, content, prompt_ref FROM chat_messages WHERE filename = ? ORDER BY seq", (filename,)
+            ):
+                chat_history.append({"role": role, "prompt_ref": prompt_ref} if prompt_ref else {"role": role, "content": content})
+            if file_row is not None and file_row[0]:
+                prompt_ref = json.loads(file_row[1]) if file_row[1] else {}
+                content_hashes = get_prompt_content_hashes({"content_hash": file_row[0], "initial_prompt_ref": prompt_ref})
+                if state.get(CONTENT_OWNER_KEY) is not None: # 先由当前会话持有，已在内容库中的内容不会在加载期间被其他会话释放
+                    retain_contents(state[CONTENT_OWNER_KEY].id, content_hashes)
+                _load_contents(conn, content_hashes)
+    except Exception as e:
+        st.warning(f"加载文件 {filename} 的数据失败: {e}")
+        return None
+    if file_row is None: # 数据库中已没有该文件（如已在其他会话中被删除）
+        return None
 
-def load_app_state():
-    """从文件加载应用状态到Streamlit session_state。"""
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
-                loaded_state = json.load(f)
-                
-                if 'files_data' in loaded_state:
-                    st.session_state.files_data = loaded_state['files_data']
-                if 'api_key' in loaded_state:
-                    st.session_state.api_key = loaded_state['api_key']
-                if 'user_general_instruction' in loaded_state:
-                    st.session_state.user_general_instruction = loaded_state['user_general_instruction']
-                return True # 表示加载成功
-        except Exception as e:
-            st.warning(f"加载应用状态失败: {e}. 将使用默认值初始化。")
-            # 如果加载失败，确保核心结构存在
-            if 'files_data' not in st.session_state:
-                st.session_state.files_data = {} # filename -> data
-    return False # 表示未加载或加载失败
\ No newline at end of file
+    content_hash, prompt_ref_json, content_str, initial_prompt_content, extra_json, initial_response, chunks_json = file_row
+    loaded_entry = json.loads(extra_json) if extra_json else {}
+    loaded_entry.update({"initial_response": initial_response, "chat_history": chat_history})
+    if chunks_json:
+        loaded_entry["chunks"] = json.loads(chunks_json)
+    legacy_row = not content_hash
+    if legacy_row: # 旧版数据：转换为紧凑格式，下次保存时按新格式重写
+        loaded_entry.update({"content_str": content_str, "initial_user_prompt_content": initial_prompt_content})
+        compact_file_entry(loaded_entry)
+    else:
+        loaded_entry.update({"content_hash": content_hash, "initial_prompt_ref": json.loads(prompt_ref_json)})
+    state["files_data"][filename] = loaded_entry
+    # 记录已持久化的内容，之后的保存只追加新的消息
+    persisted_index = state.get(PERSISTED_INDEX_KEY) or {}
+    file_row_data, analysis_row_data, _ = _split_file_entry(loaded_entry)
+    persisted_index[filename] = {
+        "file": None if legacy_row else _fingerprint(file_row_data),
+        "content": None if legacy_row else _fingerprint({column: file_row_data[column] for column in FILE_COLUMNS}),
+        "analysis": _fingerprint(analysis_row_data),
+        "messages": len(chat_history),
+        "last_message": _fingerprint(chat_history[-1]) if chat_history else None,
+    }
+    state[PERSISTED_INDEX_KEY] = persisted_index
+    return loaded_entry
@@ -0,0 +1,264 @@
+import os
+import re
+import sqlite3
+
+from content_utils import decompress_content, get_content
+
+# 全文检索索引与应用状态保存在同一个SQLite数据库中，由 persistence_utils 在保存状态时增量维护：
+# search_index 为无内容（contentless）的 FTS5 索引，只保存词项；search_documents 只记录每个索引片段
+# 在原文中的位置（rowid 相同），原文仍只保存在 contents、analyses、chat_messages 表中，生成摘录时按位置读取。
+SEARCH_INDEX_VERSION = "3" # 分词方式或索引结构变化时递增，旧索引会被整体重建
+SEARCH_SOURCE_LABELS = {
+    "content": "文件内容",
+    "analysis": "分析结果",
+    "message": "对话",
+}
+PASSAGE_CHARS = 800 # 长文本按段落切分为约这么长的片段分别索引，命中位置更准确，摘录也只需读取命中的片段
+SNIPPET_CHARS = 120 # 摘录的长度
+MAX_HITS_PER_FILE = 3 # 每个文件最多显示的命中片段数
+
+# 中日韩文字没有空格分词：连续的文字按重叠的二元组（bigram）切分，如“术语问题”->“术语 语问 问题 题”。
+# 末尾单字也单独作为一个词，使单字查询（按前缀匹配）也能命中每个位置的字。
+_CJK_CHARS = "぀-ヿ㐀-䶿一-鿿가-힯豈-﫿"
+_CJK_RUN_PATTERN = re.compile(f"[{_CJK_CHARS}]+")
+_TERM_PATTERN = re.compile(f"[{_CJK_CHARS}]+|[^\\W{_CJK_CHARS}]+")
+# 在每个中日韩文字处取它与下一个字组成的二元组（连续文字的末尾取单字），其余文字按词取出，按原文顺序排列
+_INDEX_TOKEN_PATTERN = re.compile(f"(?=([{_CJK_CHARS}]{{1,2}}|[^\\W{_CJK_CHARS}]+))(?:[{_CJK_CHARS}]|[^\\W{_CJK_CHARS}]+)")
+
+def _fts5_available():
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE fts5_probe USING fts5 (body)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+# 部分 SQLite 构建不包含 FTS5，此时不建立索引，界面中的全文搜索不可用，其余功能不受影响
+SEARCH_AVAILABLE = _fts5_available()
+
+def reset_search_schema(conn):
+    """删除旧的索引表并按当前结构重新创建（之后需重新索引全部数据）。"""
+    if not SEARCH_AVAILABLE:
+        return
+    conn.executescript(
+        """
+        DROP TABLE IF EXISTS search_index;
+        DROP TABLE IF EXISTS search_documents;
+        CREATE TABLE search_documents (
+            rowid INTEGER PRIMARY KEY AUTOINCREMENT, -- 不重复使用已删除片段的rowid，见 _remove_rows
+            source TEXT NOT NULL,
+            ref TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            start INTEGER NOT NULL,
+            end INTEGER NOT NULL
+        );
+        CREATE INDEX search_documents_ref ON search_documents (source, ref);
+        CREATE VIRTUAL TABLE search_index USING fts5 (body, content = '', tokenize = 'unicode61');
+        """
+    )
+
+def tokenize_for_index(text):
+    """把文本转换为写入 FTS5 的形式：中日韩文字切分为二元组，其余文字交给 unicode61 分词器处理。"""
+    return " ".join(_INDEX_TOKEN_PATTERN.findall(text))
+
+def _term_to_phrase(term):
+    """把查询中的一个词转换为 FTS5 短语：二元组按顺序相邻即表示原文连续出现。"""
+    if _CJK_RUN_PATTERN.fullmatch(term):
+        if len(term) == 1:
+            return f'"{term}" *' # 单字：匹配以该字开头的二元组或末尾单字
+        return '"' + " ".join(term[i:i + 2] for i in range(len(term) - 1)) + '"'
+    return f'"{term}"'
+
+def parse_query(query):
+    """
+    把用户输入的查询转换为 FTS5 查询语句。
+
+    以空白分隔的各个关键词需同时出现；查询中的 FTS5 语法字符被忽略，不会引发语法错误。
+
+    返回:
+    - tuple: (FTS5 查询语句, 用于生成摘录的关键词列表)，没有有效关键词时为 (None, [])。
+    """
+    keywords = [keyword for keyword in query.split() if _TERM_PATTERN.search(keyword)]
+    phrases = []
+    for keyword in keywords:
+        terms = _TERM_PATTERN.findall(keyword)
+        if len(terms) == 1:
+            phrases.append(_term_to_phrase(terms[0]))
+        else: # 如“API接口”：各部分在原文中相邻
+            phrases.append("NEAR(" + " ".join(_term_to_phrase(term) for term in terms) + ", 0)")
+    if not phrases:
+        return None, []
+    return " AND ".join(phrases), keywords
+
+def split_passages(text):
+    """
+    按行把长文本切分为不超过约 PASSAGE_CHARS 个字符的片段（过长的行被截断为多段）。
+
+    返回:
+    - list: [(start, end)]，各片段在 text 中的字符位置，只含空白的片段被略去。
+    """
+    spans = []
+    start = end = 0
+    for line in text.splitlines(keepends=True):
+        while len(line) > PASSAGE_CHARS:
+            if end > start:
+                spans.append((start, end))
+            spans.append((end, end + PASSAGE_CHARS))
+            end += PASSAGE_CHARS
+            start = end
+            line = line[PASSAGE_CHARS:]
+        if end - start + len(line) > PASSAGE_CHARS:
+            spans.append((start, end))
+            start = end
+        end += len(line)
+    if end > start:
+        spans.append((start, end))
+    return [(start, end) for start, end in spans if text[start:end].strip()]
+
+def _load_text(conn, source, ref, seq):
+    """读取被索引的原文，原文已不存在时返回None。"""
+    if source == "content":
+        text = get_content(ref)
+        if text is None:
+            row = conn.execute("SELECT compression, data FROM contents WHERE content_hash = ?", (ref,)).fetchone()
+            text = decompress_content(*row) if row else None
+        return text
+    if source == "analysis":
+        row = conn.execute("SELECT initial_response FROM analyses WHERE filename = ?", (ref,)).fetchone()
+    else:
+        row = conn.execute("SELECT content FROM chat_messages WHERE filename = ? AND seq = ?", (ref, seq)).fetchone()
+    return row[0] if row else None
+
+def index_text(conn, source, ref, seq, text):
+    """
+    把一段文本切分为片段后加入索引。
+
+    参数:
+    - source: "content"（ref 为内容哈希）、"analysis" 或 "message"（ref 为文件名）。
+    - seq: 对话消息的序号，其他来源为0。
+    """
+    if not SEARCH_AVAILABLE or not text:
+        return
+    index_rows = []
+    for start, end in split_passages(text):
+        cursor = conn.execute(
+            "INSERT INTO search_documents (source, ref, seq, start, end) VALUES (?, ?, ?, ?, ?)", (source, ref, seq, start, end)
+        )
+        index_rows.append((cursor.lastrowid, tokenize_for_index(text[start:end])))
+    conn.executemany("INSERT INTO search_index (rowid, body) VALUES (?, ?)", index_rows)
+
+def index_content(conn, content_hash, text):
+    """索引文件内容。相同内容只索引一次，由引用它的所有文件共享。"""
+    if not SEARCH_AVAILABLE or conn.execute(
+        "SELECT 1 FROM search_documents WHERE source = 'content' AND ref = ? LIMIT 1", (content_hash,)
+    ).fetchone():
+        return
+    index_text(conn, "content", content_hash, 0, text)
+
+def _remove_rows(conn, rows):
+    """
+    移除索引片段。无内容的 FTS5 表需提供写入时的文本才能删除，因此由原文重新生成；
+    原文已不存在时只删除片段记录，残留的词项在查询时因找不到片段而被忽略
+    （片段的rowid不会被重复使用，残留的词项不会被误当作之后新增片段的内容）。
+    """
+    texts = {}
+    for rowid, source, ref, seq, start, end in rows:
+        if (source, ref, seq) not in texts:
+            texts[(source, ref, seq)] = _load_text(conn, source, ref, seq)
+        text = texts[(source, ref, seq)]
+        if text is not None:
+            conn.execute(
+                "INSERT INTO search_index (search_index, rowid, body) VALUES ('delete', ?, ?)",
+                (rowid, tokenize_for_index(text[start:end])),
+            )
+        conn.execute("DELETE FROM search_documents WHERE rowid = ?", (rowid,))
+
+def remove_documents(conn, source, ref):
+    """从索引中移除某个来源的文本。须在原文被改写或删除之前调用。"""
+    if not SEARCH_AVAILABLE:
+        return
+    _remove_rows(conn, conn.execute(
+        "SELECT rowid, source, ref, seq, start, end FROM search_documents WHERE source = ? AND ref = ?", (source, ref)
+    ).fetchall())
+
+def remove_file(conn, filename):
+    """
+    移除文件的分析结果和对话（须在删除 files 表中的行之前调用）；
+    文件内容在不再被任何文件引用时由 remove_unreferenced_contents 移除。
+    """
+    remove_documents(conn, "analysis", filename)
+    remove_documents(conn, "message", filename)
+
+def remove_unreferenced_contents(conn):
+    """移除已没有文件引用的内容的索引（须在删除 contents 表中的行之前调用）。"""
+    if not SEARCH_AVAILABLE:
+        return
+    _remove_rows(conn, conn.execute(
+        "SELECT rowid, source, ref, seq, start, end FROM search_documents WHERE source = 'content' AND ref NOT IN ("
+        "SELECT content_hash FROM files WHERE content_hash IS NOT NULL)"
+    ).fetchall())
+
+def make_snippet(text, keywords):
+    """截取文本中第一个命中关键词附近的一段，关键词加粗显示。"""
+    lowered = text.lower()
+    positions = [lowered.find(keyword.lower()) for keyword in keywords]
+    positions = [position for position in positions if position >= 0]
+    start = max(0, min(positions) - SNIPPET_CHARS // 3) if positions else 0
+    snippet = " ".join(text[start:start + SNIPPET_CHARS].split())
+    for keyword in sorted(keywords, key=len, reverse=True):
+        snippet = re.sub(re.escape(keyword), lambda match: f"**{match.group(0)}**", snippet, flags=re.I)
+    return ("…" if start > 0 else "") + snippet + ("…" if start + SNIPPET_CHARS < len(text) else "")
+
+def search_files(query, db_path, limit=20):
+    """
+    在索引中搜索文件内容、分析结果和对话消息。
+
+    只查询 FTS5 索引，并只为最终显示的命中片段读取原文，耗时与已处理文件的数量基本无关。
+
+    返回:
+    - list: 按相关度排序的文件 [{"filename", "score", "hits": [{"source", "seq", "snippet"}]}]，
+            score 为 bm25 分数（越小越相关）。
+    """
+    fts_query, keywords = parse_query(query)
+    if not SEARCH_AVAILABLE or fts_query is None or not os.path.exists(db_path):
+        return []
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'search_index'").fetchone():
+            return []
+        rows = conn.execute(
+            "SELECT d.source, d.ref, d.seq, d.start, d.end, bm25(search_index) AS score "
+            "FROM search_index JOIN search_documents d ON d.rowid = search_index.rowid "
+            "WHERE search_index MATCH ? ORDER BY score LIMIT ?",
+            (fts_query, limit * MAX_HITS_PER_FILE * 5),
+        ).fetchall()
+        content_hashes = {row[1] for row in rows if row[0] == "content"}
+        content_files = {}
+        if content_hashes:
+            placeholders = ",".join("?" * len(content_hashes))
+            for filename, content_hash in conn.execute(
+                f"SELECT filename, content_hash FROM files WHERE content_hash IN ({placeholders})", tuple(content_hashes)
+            ):
+                content_files.setdefault(content_hash, []).append(filename)
+
+        results = {}
+        for source, ref, seq, start, end, score in rows:
+            for filename in content_files.get(ref, []) if source == "content" else [ref]:
+                result = results.setdefault(filename, {"filename": filename, "score": score, "hits": []})
+                if len(result["hits"]) < MAX_HITS_PER_FILE:
+                    result["hits"].append({"source": source, "ref": ref, "seq": seq, "start": start, "end": end})
+        results = sorted(results.values(), key=lambda result: result["score"])[:limit]
+
+        texts = {}
+        for result in results:
+            for hit in result["hits"]:
+                text_key = (hit.pop("ref"), hit["seq"])
+                if (hit["source"], *text_key) not in texts:
+                    texts[(hit["source"], *text_key)] = _load_text(conn, hit["source"], *text_key) or ""
+                text = texts[(hit["source"], *text_key)]
+                hit["snippet"] = make_snippet(text[hit.pop("start"):hit.pop("end")], keywords)
+    finally:
+        conn.close()
+    return results
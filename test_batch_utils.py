@@ -0,0 +1,66 @@
+import json
+
+import cache_utils
+import openai_utils
+from batch_utils import _parse_packed_response, iter_batch_analysis
+from fake_openai_server import start_fake_server
+
+
+def _packed(*items):
+    return json.dumps({"files": list(items)}, ensure_ascii=False)
+
+
+def test_splits_response_by_filename():
+    response = _packed({"filename": "a.txt", "analysis": " 分析A "}, {"filename": "b.txt", "analysis": "分析B"})
+    assert _parse_packed_response(response, ["a.txt", "b.txt"]) == {"a.txt": "分析A", "b.txt": "分析B"}
+
+
+def test_skips_unexpected_empty_and_repeated_items():
+    response = _packed(
+        {"filename": "a.txt", "analysis": "分析A"},
+        {"filename": "a.txt", "analysis": "重复的分析"},
+        {"filename": "b.txt", "analysis": "  "},
+        {"filename": "other.txt", "analysis": "不在请求中"},
+        {"filename": "c.txt"},
+        "不是对象",
+    )
+    assert _parse_packed_response(response, ["a.txt", "b.txt", "c.txt"]) == {"a.txt": "分析A"}
+
+
+def test_unescapes_filenames():
+    response = _packed({"filename": "R&amp;D.txt", "analysis": "分析"})
+    assert _parse_packed_response(response, ["R&D.txt"]) == {"R&D.txt": "分析"}
+
+
+def test_invalid_response():
+    for response in (None, "不是JSON", "[]", '{"files": {}}'):
+        assert _parse_packed_response(response, ["a.txt"]) == {}
+
+
+def test_packed_batch_looks_up_each_file_once(tmp_path, monkeypatch):
+    server, base_url, stats = start_fake_server(latency_ms=1, completion_tokens=5, tokens_per_second=10000)
+    monkeypatch.setattr(openai_utils, "OPENAI_BASE_URL", base_url)
+    monkeypatch.setattr(openai_utils, "_clients", {}) # 客户端按密钥缓存，需连接到本测试的模拟服务
+    monkeypatch.setattr(cache_utils, "CACHE_FILE", str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(cache_utils, "_stats", {"hits": 0, "misses": 0})
+    file_sources = [(f"f{i}.txt", lambda i=i: f"小文件{i}的内容".encode("utf-8")) for i in range(10)]
+
+    def run_batch():
+        return {
+            event["filename"]: event for event in iter_batch_analysis("sk-test", file_sources, "总结", pack_small_files=True)
+            if event["event"] == "result"
+        }
+
+    try:
+        results = run_batch()
+        assert stats["requests"] == 1 # 10 个小文件合并为一次请求
+        assert all(event["file_data"] for event in results.values())
+        assert cache_utils._stats == {"hits": 0, "misses": 11} # 每个文件一次，加上打包请求一次
+
+        results = run_batch()
+        assert stats["requests"] == 1
+        assert all(event["cached"] for event in results.values())
+        assert cache_utils._stats == {"hits": 10, "misses": 11}
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,71 @@
+import uuid
+
+import pytest
+
+import cache_utils
+import openai_utils
+from cache_utils import evict_cache_entries, get_cache_stats, get_cached_response, store_cached_response
+from fake_openai_server import start_fake_server
+
+
+def _messages(text):
+    return [{"role": "user", "content": text}]
+
+
+@pytest.fixture(autouse=True)
+def cache_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_utils, "CACHE_FILE", str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(cache_utils, "_stats", {"hits": 0, "misses": 0})
+
+
+def test_store_and_hit():
+    assert get_cached_response("gpt-4o", _messages("a")) is None
+    store_cached_response("gpt-4o", _messages("a"), "回应A")
+    assert get_cached_response("gpt-4o", _messages("a")) == "回应A"
+    assert get_cached_response("other-model", _messages("a")) is None
+    assert get_cache_stats() == {"hits": 1, "misses": 2, "entries": 1, "bytes": len("回应A".encode("utf-8"))}
+
+
+def test_expired_entries_miss_and_are_evicted(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(cache_utils.time, "time", lambda: clock[0])
+    store_cached_response("gpt-4o", _messages("a"), "回应A")
+    clock[0] += cache_utils.CACHE_MAX_AGE_SECONDS + 1
+    assert get_cached_response("gpt-4o", _messages("a")) is None
+    evict_cache_entries()
+    assert get_cache_stats()["entries"] == 0
+
+
+def test_eviction_drops_least_recently_used(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(cache_utils.time, "time", lambda: clock[0])
+    monkeypatch.setattr(cache_utils, "CACHE_MAX_BYTES", 25)
+    for text in ("a", "b", "c"):
+        store_cached_response("gpt-4o", _messages(text), text * 10)
+        clock[0] += 1
+    get_cached_response("gpt-4o", _messages("a")) # a 成为最近访问的条目
+    evict_cache_entries()
+    assert get_cached_response("gpt-4o", _messages("a")) == "a" * 10
+    assert get_cached_response("gpt-4o", _messages("b")) is None
+    assert get_cached_response("gpt-4o", _messages("c")) == "c" * 10
+
+
+def test_empty_response_is_not_cached():
+    store_cached_response("gpt-4o", _messages("a"), "")
+    assert get_cache_stats()["entries"] == 0
+
+
+def test_bypass_skips_lookup_but_refreshes_entry(monkeypatch):
+    server, base_url, stats = start_fake_server(latency_ms=1, completion_tokens=5, tokens_per_second=10000)
+    try:
+        monkeypatch.setattr(openai_utils, "OPENAI_BASE_URL", base_url)
+        api_key = f"sk-test-{uuid.uuid4().hex}"
+        messages = _messages("bypass")
+        first = openai_utils.request_gpt4o_completion(api_key, messages)
+        assert openai_utils.request_gpt4o_completion(api_key, messages) == first
+        assert stats["requests"] == 1
+        refreshed = openai_utils.request_gpt4o_completion(api_key, messages, use_cache=False)
+        assert stats["requests"] == 2
+        assert get_cached_response(openai_utils.MODEL_NAME, messages) == refreshed
+    finally:
+        server.shutdown()
@@ -0,0 +1,38 @@
+from chunking_utils import count_tokens, split_into_chunks
+
+
+def test_short_text_is_single_chunk():
+    assert split_into_chunks("短文本", max_tokens=100) == [{"start": 0, "end": 3, "text": "短文本"}]
+
+
+def test_chunks_cover_text_in_order():
+    text = "\n\n".join(f"第{i}段。" + "内容" * 40 for i in range(30))
+    chunks = split_into_chunks(text, max_tokens=300)
+    assert len(chunks) > 1
+    assert "".join(chunk["text"] for chunk in chunks) == text
+    assert all(text[chunk["start"]:chunk["end"]] == chunk["text"] for chunk in chunks)
+    assert all(count_tokens(chunk["text"]) <= 300 for chunk in chunks)
+
+
+def test_table_header_is_repeated():
+    header = "| 名称 | 数量 |\n| --- | --- |\n"
+    rows = "".join(f"| 项目{i} | {i} |\n" for i in range(200))
+    chunks = split_into_chunks(header + rows, max_tokens=200)
+    assert len(chunks) > 1
+    assert all(chunk["text"].startswith(header) for chunk in chunks)
+    assert chunks[1]["start"] == chunks[0]["end"] # 重复的表头不计入位置范围
+
+
+def test_sheets_split_at_sheet_headers():
+    sheets = [f"--- 工作表: S{i} ---\n" + "数据行\n" * 150 for i in range(3)]
+    chunks = split_into_chunks("".join(sheets), max_tokens=count_tokens(sheets[0]) + 10)
+    assert [chunk["text"] for chunk in chunks] == sheets
+
+
+def test_oversized_table_header_is_not_repeated():
+    header = "| " + " | ".join(f"列{i}" for i in range(150)) + " |\n| " + " | ".join(["---"] * 150) + " |\n"
+    rows = "".join(f"| 项目{i} | {i} |\n" for i in range(200))
+    assert count_tokens(header) > 200
+    chunks = split_into_chunks(header + rows, max_tokens=200)
+    assert "".join(chunk["text"] for chunk in chunks) == header + rows
+    assert all(count_tokens(chunk["text"]) <= 200 for chunk in chunks)
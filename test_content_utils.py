@@ -0,0 +1,75 @@
+import gc
+
+import pytest
+
+import content_utils
+from content_utils import (
+    claim_file_contents, get_content, new_content_owner, release_content_owner, retain_contents, set_owned_contents,
+    store_content,
+)
+
+
+@pytest.fixture(autouse=True)
+def empty_store(monkeypatch):
+    monkeypatch.setattr(content_utils, "_contents", {})
+    monkeypatch.setattr(content_utils, "_content_owners", {})
+    monkeypatch.setattr(content_utils, "_content_refcounts", content_utils.collections.Counter())
+
+
+def test_content_is_released_with_its_last_owner():
+    content_hash = store_content("共享内容")
+    retain_contents("a", [content_hash])
+    retain_contents("b", [content_hash, content_hash])
+    release_content_owner("a")
+    assert get_content(content_hash) == "共享内容"
+    release_content_owner("b")
+    assert get_content(content_hash) is None
+    assert not content_utils._content_refcounts and not content_utils._content_owners
+
+
+def test_store_with_owner_cannot_be_freed_by_another_owner():
+    content_hash = store_content("内容", "other")
+    assert store_content("内容", "job") == content_hash
+    set_owned_contents("other", []) # 其他持有者在任务取走结果之前释放了同一内容
+    assert get_content(content_hash) == "内容"
+    release_content_owner("job")
+    assert get_content(content_hash) is None
+
+
+def test_retain_before_content_is_loaded():
+    content_hash = content_utils.hash_content("稍后加载")
+    retain_contents("session", [content_hash])
+    content_utils.put_content(content_hash, "稍后加载")
+    assert get_content(content_hash) == "稍后加载"
+    release_content_owner("session")
+    assert get_content(content_hash) is None
+
+
+def test_claim_releases_removed_and_replaced_files():
+    files_data = {
+        "a.txt": {"content_hash": store_content("旧内容")},
+        "b.txt": {
+            "content_hash": store_content("B"),
+            "initial_prompt_ref": {"kind": "stored", "content_hash": store_content("请求")},
+        },
+    }
+    claim_file_contents("session", files_data)
+    old_hash = files_data["a.txt"]["content_hash"]
+    files_data["a.txt"] = {"content_hash": store_content("新内容")}
+    claim_file_contents("session", files_data)
+    assert get_content(old_hash) is None
+    assert get_content(files_data["a.txt"]["content_hash"]) == "新内容"
+
+    prompt_hash = files_data["b.txt"]["initial_prompt_ref"]["content_hash"]
+    del files_data["b.txt"]
+    claim_file_contents("session", files_data)
+    assert get_content(prompt_hash) is None
+    assert content_utils._content_owners["session"] == {files_data["a.txt"]["content_hash"]}
+
+
+def test_session_owner_releases_when_collected():
+    owner = new_content_owner()
+    content_hash = store_content("会话内容", owner.id)
+    del owner
+    gc.collect()
+    assert get_content(content_hash) is None
@@ -0,0 +1,78 @@
+import cache_utils
+import openai_utils
+from batch_utils import iter_batch_analysis
+from content_utils import get_initial_prompt
+from dedup_utils import MIN_NEAR_DUPLICATE_CHARS, find_duplicate, make_content_diff, new_dedup_index
+from fake_openai_server import start_fake_server
+from history_utils import build_chat_messages
+from openai_utils import generate_initial_analysis_prompt
+
+BASE_TEXT = "\n".join(f"第{i}条：合同条款内容，付款期限为三十日。" for i in range(40))
+
+
+def test_exact_duplicate():
+    index = new_dedup_index()
+    assert find_duplicate(index, "a.txt", BASE_TEXT) is None
+    assert find_duplicate(index, "b.txt", BASE_TEXT) == {"filename": "a.txt", "kind": "exact", "similarity": 1.0}
+
+
+def test_near_duplicate_links_to_representative():
+    index = new_dedup_index()
+    find_duplicate(index, "a.txt", BASE_TEXT)
+    edited = BASE_TEXT.replace("第3条：合同条款内容", "第3条：修改后的条款")
+    duplicate = find_duplicate(index, "b.txt", edited)
+    assert duplicate["filename"] == "a.txt" and duplicate["kind"] == "near"
+    assert 0.8 <= duplicate["similarity"] < 1.0
+    # 成员不会成为代表文件
+    assert find_duplicate(index, "c.txt", edited + "\n补充")["filename"] == "a.txt"
+
+
+def test_unrelated_and_short_files():
+    index = new_dedup_index()
+    find_duplicate(index, "a.txt", BASE_TEXT)
+    assert find_duplicate(index, "b.txt", "完全不同的一份报告。" * 50) is None
+    assert find_duplicate(index, "c.txt", "短" * (MIN_NEAR_DUPLICATE_CHARS - 1)) is None
+
+
+def test_near_mode_off():
+    index = new_dedup_index()
+    find_duplicate(index, "a.txt", BASE_TEXT)
+    assert find_duplicate(index, "b.txt", BASE_TEXT + "\n补充", {"near_mode": "off"}) is None
+
+
+def test_make_content_diff():
+    edited = BASE_TEXT.replace("第3条：合同条款内容", "第3条：修改后的条款")
+    diff = make_content_diff(BASE_TEXT, edited)
+    assert "-第3条：合同条款内容，付款期限为三十日。" in diff
+    assert "+第3条：修改后的条款，付款期限为三十日。" in diff
+
+
+def test_make_content_diff_rejects_large_changes():
+    assert make_content_diff(BASE_TEXT, "完全不同的一份报告。\n" * 40) is None
+
+
+def test_batch_reuses_and_diffs_duplicates(tmp_path, monkeypatch):
+    server, base_url, stats = start_fake_server(latency_ms=1, completion_tokens=5, tokens_per_second=10000)
+    try:
+        monkeypatch.setattr(openai_utils, "OPENAI_BASE_URL", base_url)
+        monkeypatch.setattr(openai_utils, "_clients", {}) # 客户端按密钥缓存，需连接到本测试的模拟服务
+        monkeypatch.setattr(cache_utils, "CACHE_FILE", str(tmp_path / "cache.sqlite3"))
+        edited = BASE_TEXT.replace("第3条：合同条款内容", "第3条：修改后的条款")
+        texts = {"a.txt": BASE_TEXT, "b.txt": BASE_TEXT, "c.txt": edited}
+        file_sources = [(filename, lambda text=text: text.encode("utf-8")) for filename, text in texts.items()]
+        results = {
+            event["filename"]: event for event in iter_batch_analysis("sk-test", file_sources, "检查条款", max_workers=1)
+            if event["event"] == "result"
+        }
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert stats["requests"] == 2 # b.txt 复用 a.txt 的结果，c.txt 只分析差异
+    assert results["b.txt"]["duplicate_of"]["analysis"] == "reused"
+    assert results["b.txt"]["file_data"]["initial_response"] == results["a.txt"]["file_data"]["initial_response"]
+    assert results["c.txt"]["duplicate_of"]["analysis"] == "diff"
+    # 差异分析的文件在对话时仍以包含完整内容的标准请求为前缀
+    file_data = results["c.txt"]["file_data"]
+    assert get_initial_prompt(file_data) == generate_initial_analysis_prompt(edited, "检查条款")
+    assert build_chat_messages(file_data)[0]["content"] == get_initial_prompt(file_data)
@@ -0,0 +1,84 @@
+from batch_utils import build_file_entry
+from chunking_utils import count_tokens
+from history_utils import (
+    PREFIX_MESSAGE_COUNT, PROMPT_TOKENS_KEY, build_chat_messages, compact_history, estimate_request_tokens,
+)
+from content_utils import get_initial_prompt
+
+
+def _file_data(turns):
+    file_data = build_file_entry("文件内容。" * 200, "检查术语", "首次分析结果")
+    for turn in range(turns):
+        file_data["chat_history"].append({"role": "user", "content": f"问题{turn}：" + "请详细说明。" * 20})
+        file_data["chat_history"].append({"role": "assistant", "content": f"回答{turn}：" + "说明内容。" * 40})
+    return file_data
+
+
+def test_within_budget_is_unchanged():
+    file_data = _file_data(2)
+    assert not compact_history(file_data, 100000, "summarize", lambda prompt: "摘要")
+    assert "history_summary" not in file_data
+    assert build_chat_messages(file_data)[0]["content"] == get_initial_prompt(file_data)
+
+
+def test_summarize_keeps_prefix_and_fits_budget():
+    file_data = _file_data(20)
+    budget = estimate_request_tokens(file_data)["prefix"] + 2000
+    prompts = []
+    def summarize(prompt):
+        prompts.append(prompt)
+        return "早期对话的摘要"
+
+    assert compact_history(file_data, budget, "summarize", summarize)
+    upto = file_data["history_summary"]["upto"]
+    assert file_data["history_summary"]["content"] == "早期对话的摘要"
+    assert file_data["chat_history"][upto]["role"] == "user"
+    last_summarized_turn = (upto - PREFIX_MESSAGE_COUNT) // 2 - 1
+    assert "问题0：" in prompts[0] and f"问题{last_summarized_turn}：" in prompts[0]
+    assert f"问题{last_summarized_turn + 1}：" not in prompts[0]
+
+    messages = build_chat_messages(file_data)
+    assert messages[:PREFIX_MESSAGE_COUNT] == build_chat_messages(_file_data(0))
+    assert "早期对话的摘要" in messages[PREFIX_MESSAGE_COUNT]["content"]
+    assert messages[PREFIX_MESSAGE_COUNT + 1:] == file_data["chat_history"][upto:]
+    assert estimate_request_tokens(file_data)["total"] <= budget
+    assert estimate_request_tokens(file_data)["compacted_messages"] == upto - PREFIX_MESSAGE_COUNT
+
+    # 压缩后留有余量，下一轮不会再次压缩
+    file_data["chat_history"].append({"role": "user", "content": "再问一个问题"})
+    assert not compact_history(file_data, budget, "summarize", summarize)
+    assert len(prompts) == 1
+
+
+def test_drop_mode_omits_old_turns():
+    file_data = _file_data(20)
+    budget = estimate_request_tokens(file_data)["prefix"] + 2000
+    assert compact_history(file_data, budget, "drop")
+    assert file_data["history_summary"]["content"] is None
+    messages = build_chat_messages(file_data)
+    assert messages[PREFIX_MESSAGE_COUNT:] == file_data["chat_history"][file_data["history_summary"]["upto"]:]
+
+
+def test_failed_summary_falls_back_to_drop():
+    file_data = _file_data(20)
+    budget = estimate_request_tokens(file_data)["prefix"] + 2000
+    assert compact_history(file_data, budget, "summarize", lambda prompt: None)
+    assert file_data["history_summary"]["content"] is None
+
+
+def test_last_message_is_always_kept():
+    file_data = _file_data(3)
+    assert compact_history(file_data, 10, "drop")
+    assert file_data["history_summary"]["upto"] == len(file_data["chat_history"]) - 1
+
+
+def test_prompt_tokens_cached_until_instruction_changes():
+    file_data = _file_data(0)
+    prefix_tokens = estimate_request_tokens(file_data)["prefix"]
+    assert file_data[PROMPT_TOKENS_KEY]["tokens"] == count_tokens(get_initial_prompt(file_data))
+
+    file_data[PROMPT_TOKENS_KEY]["tokens"] += 1000 # 缓存命中时不会重新计算
+    assert estimate_request_tokens(file_data)["prefix"] == prefix_tokens + 1000
+    file_data["initial_prompt_ref"] = {**file_data["initial_prompt_ref"], "instruction": "另一条更长的指令" * 10}
+    assert estimate_request_tokens(file_data)["prefix"] > prefix_tokens
+    assert file_data[PROMPT_TOKENS_KEY]["tokens"] == count_tokens(get_initial_prompt(file_data))
@@ -0,0 +1,90 @@
+import datetime
+import io
+import sys
+
+import openpyxl
+import pytest
+
+from ingest_utils import read_excel_as_text
+
+
+def _xlsx(sheets):
+    workbook = openpyxl.Workbook()
+    workbook.remove(workbook.active)
+    for sheet_name, rows in sheets.items():
+        worksheet = workbook.create_sheet(sheet_name)
+        for row in rows:
+            worksheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def _rows(count):
+    return [["编号", "名称"]] + [[i, f"项目{i}"] for i in range(1, count + 1)]
+
+
+def test_default_output_is_markdown():
+    text, stats = read_excel_as_text(_xlsx({"S1": [["名称", "日期"], ["a|b", datetime.datetime(2024, 1, 2)]]}), "t.xlsx")
+    assert text == (
+        "--- 工作表: S1 (来自文件: t.xlsx) ---\n"
+        "| 名称 | 日期 |\n| --- | --- |\n| a\\|b | 2024-01-02 |\n\n"
+    )
+    assert stats == {"sheets": 1, "rows_total": 1, "rows_kept": 1, "rows_dropped": 0, "sheets_columns_truncated": []}
+
+
+@pytest.mark.parametrize("output_format, expected", [("csv", '名称,备注\n1,"x,y"\n'), ("tsv", "名称\t备注\n1\tx,y\n")])
+def test_compact_formats(output_format, expected):
+    text, _ = read_excel_as_text(_xlsx({"S1": [["名称", "备注"], [1.0, "x,y"]]}), "t.xlsx", {"output_format": output_format})
+    assert text == f"--- 工作表: S1 (来自文件: t.xlsx) ---\n{expected}\n"
+
+
+def test_row_and_column_caps_keep_head():
+    rows = [row + ["多余"] * 5 for row in _rows(100)]
+    text, stats = read_excel_as_text(
+        _xlsx({"S1": rows}), "t.xlsx", {"output_format": "csv", "max_rows_per_sheet": 10, "max_columns": 2}
+    )
+    lines = text.splitlines()
+    assert lines[1:12] == ["编号,名称"] + [f"{i},项目{i}" for i in range(1, 11)]
+    assert "(此工作表共 100 行数据，仅保留前 10 行；每行仅保留前 2 列)" in text
+    assert stats == {"sheets": 1, "rows_total": 100, "rows_kept": 10, "rows_dropped": 90, "sheets_columns_truncated": ["S1"]}
+
+
+def test_uniform_sampling_is_ordered_and_repeatable():
+    options = {"output_format": "csv", "max_rows_per_sheet": 20, "sampling": "uniform"}
+    text, stats = read_excel_as_text(_xlsx({"S1": _rows(1000)}), "t.xlsx", options)
+    kept_ids = [int(line.split(",")[0]) for line in text.splitlines()[2:22]]
+    assert len(kept_ids) == 20 and kept_ids == sorted(kept_ids)
+    assert kept_ids[-1] > 100 # 抽样覆盖整个工作表，而不只是开头
+    assert stats["rows_kept"] == 20 and stats["rows_dropped"] == 980
+    assert read_excel_as_text(_xlsx({"S1": _rows(1000)}), "t.xlsx", options)[0] == text
+
+
+def test_empty_sheets_and_rows():
+    text, stats = read_excel_as_text(_xlsx({"空": [], "S2": [[None, None], ["a", None, None], [], ["b"]]}), "t.xlsx")
+    assert "--- 工作表: 空 (来自文件: t.xlsx) ---\n此工作表为空。" in text
+    assert "| a |\n| --- |\n| b |\n" in text
+    assert stats["sheets"] == 2 and stats["rows_total"] == 1
+
+
+def test_xls_requires_xlrd(monkeypatch):
+    monkeypatch.setitem(sys.modules, "xlrd", None)
+    with pytest.raises(ImportError, match="xlrd"):
+        read_excel_as_text(io.BytesIO(b""), "old.xls")
+
+
+def test_xls_workbook():
+    pytest.importorskip("xlrd")
+    xlwt = pytest.importorskip("xlwt")
+    workbook = xlwt.Workbook()
+    worksheet = workbook.add_sheet("S1")
+    for row_index, row in enumerate(_rows(5)):
+        for column_index, value in enumerate(row):
+            worksheet.write(row_index, column_index, value)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    buffer.seek(0)
+    text, stats = read_excel_as_text(buffer, "old.xls", {"output_format": "csv", "max_rows_per_sheet": 3})
+    assert text.splitlines()[1:5] == ["编号,名称", "1,项目1", "2,项目2", "3,项目3"]
+    assert stats["rows_total"] == 5 and stats["rows_kept"] == 3
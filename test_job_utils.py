@@ -0,0 +1,111 @@
+import time
+
+import pytest
+
+import cache_utils
+import content_utils
+import openai_utils
+from content_utils import get_content
+from fake_openai_server import start_fake_server
+from job_utils import (
+    cancel_job, drain_job_results, has_active_jobs, list_jobs, pause_job, remove_job, resume_job, start_batch_job,
+)
+
+
+def _start_server(tmp_path, monkeypatch, latency_ms):
+    server, base_url, stats = start_fake_server(
+        latency_ms=latency_ms, latency_sigma=0, completion_tokens=5, tokens_per_second=10000
+    )
+    monkeypatch.setattr(openai_utils, "OPENAI_BASE_URL", base_url)
+    monkeypatch.setattr(openai_utils, "_clients", {}) # 客户端按密钥缓存，需连接到本测试的模拟服务
+    monkeypatch.setattr(cache_utils, "CACHE_FILE", str(tmp_path / "cache.sqlite3"))
+    return server, stats
+
+
+def _file_sources(prefix, count):
+    return [(f"{prefix}{i}.txt", lambda i=i: f"{prefix} 文件{i}".encode("utf-8")) for i in range(count)]
+
+
+def _wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "等待超时"
+        time.sleep(0.02)
+
+
+def _status(job_id):
+    return list_jobs([job_id])[0]["status"]
+
+
+@pytest.fixture
+def fast_server(tmp_path, monkeypatch):
+    server, stats = _start_server(tmp_path, monkeypatch, latency_ms=1)
+    yield stats
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def slow_server(tmp_path, monkeypatch):
+    server, stats = _start_server(tmp_path, monkeypatch, latency_ms=150)
+    yield stats
+    server.shutdown()
+    server.server_close()
+
+
+def test_sessions_only_see_and_drain_their_own_jobs(fast_server):
+    job_a = start_batch_job("sk-test", _file_sources("a", 3), "总结", bypass_cache=True)
+    job_b = start_batch_job("sk-test", _file_sources("b", 2), "总结", bypass_cache=True)
+    _wait_for(lambda: _status(job_a) == "finished" and _status(job_b) == "finished")
+
+    assert [job["id"] for job in list_jobs([job_a])] == [job_a]
+    assert list_jobs([job_a])[0]["pending_results"] == 3
+    assert has_active_jobs([job_a]) # 结果尚未取走
+
+    drained = drain_job_results(job_a, "session-a")
+    assert sorted(drained) == ["a0.txt", "a1.txt", "a2.txt"]
+    assert drain_job_results(job_a, "session-a") == {}
+    assert not has_active_jobs([job_a])
+    assert has_active_jobs([job_b])
+    assert sorted(drain_job_results(job_b, "session-b")) == ["b0.txt", "b1.txt"]
+
+    # 任务结束并被取走后，内容只由取走结果的会话持有
+    content_hash = drained["a0.txt"]["content_hash"]
+    assert get_content(content_hash) == "a 文件0"
+    content_utils.release_content_owner("session-a")
+    assert get_content(content_hash) is None
+    content_utils.release_content_owner("session-b")
+
+    remove_job(job_a)
+    assert list_jobs([job_a, job_b])[0]["id"] == job_b
+    assert drain_job_results(job_a, "session-a") == {}
+    remove_job(job_b)
+
+
+def test_pause_resume_and_cancel(slow_server):
+    job_id = start_batch_job("sk-test", _file_sources("p", 12), "总结", max_workers=1, bypass_cache=True)
+    _wait_for(lambda: slow_server["requests"] >= 1)
+    pause_job(job_id)
+    assert _status(job_id) == "paused"
+    time.sleep(0.5) # 进行中的请求完成后不再发出新请求
+    requests_while_paused = slow_server["requests"]
+    time.sleep(0.5)
+    assert slow_server["requests"] == requests_while_paused
+    assert has_active_jobs([job_id])
+
+    resume_job(job_id)
+    assert _status(job_id) == "running"
+    _wait_for(lambda: slow_server["requests"] > requests_while_paused)
+
+    remove_job(job_id) # 运行中的任务不会被移除
+    assert list_jobs([job_id])
+
+    cancel_job(job_id)
+    _wait_for(lambda: _status(job_id) == "cancelled")
+    job = list_jobs([job_id])[0]
+    assert job["finished_at"] is not None and job["in_flight"] == 0
+    assert job["completed"] < 12
+    assert len(drain_job_results(job_id, "session-p")) == len(job["finished_files"])
+    content_utils.release_content_owner("session-p")
+    remove_job(job_id)
+    assert list_jobs([job_id]) == []
@@ -0,0 +1,73 @@
+import json
+import os
+
+import pytest
+
+import cache_utils
+import openai_utils
+from fake_openai_server import start_fake_server
+from multifile_processor import RESULTS_FILE, load_results, run_job
+
+
+@pytest.fixture
+def fake_server(tmp_path, monkeypatch):
+    server, base_url, stats = start_fake_server(latency_ms=1, completion_tokens=5, tokens_per_second=10000)
+    monkeypatch.setattr(openai_utils, "OPENAI_BASE_URL", base_url)
+    monkeypatch.setattr(openai_utils, "_clients", {}) # 客户端按密钥缓存，需连接到本测试的模拟服务
+    monkeypatch.setattr(cache_utils, "CACHE_FILE", str(tmp_path / "cache.sqlite3"))
+    yield stats
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def input_dir(tmp_path):
+    input_dir = tmp_path / "input"
+    (input_dir / "sub").mkdir(parents=True)
+    for i in range(3):
+        (input_dir / f"f{i}.txt").write_text(f"文件{i}的内容", encoding="utf-8")
+    (input_dir / "sub" / "f0.txt").write_text("子目录中的同名文件", encoding="utf-8")
+    (input_dir / "skip.bin").write_bytes(b"\0")
+    return str(input_dir)
+
+
+def _run(input_dir, out_dir, instruction="总结"):
+    return run_job("sk-test", [input_dir], instruction, out_dir, bypass_cache=True, log=lambda message: None)
+
+
+def test_resume_skips_checkpointed_files(fake_server, input_dir, tmp_path):
+    out_dir = str(tmp_path / "out")
+    summary = _run(input_dir, out_dir)
+    assert (summary["total"], summary["completed"], summary["skipped"], summary["failed"]) == (4, 4, 0, 0)
+    assert sorted(load_results(out_dir)) == ["f0.txt", "f1.txt", "f2.txt", "sub/f0.txt"]
+    requests_sent = fake_server["requests"]
+
+    summary = _run(input_dir, out_dir)
+    assert (summary["completed"], summary["skipped"]) == (0, 4)
+    assert fake_server["requests"] == requests_sent
+
+
+def test_torn_last_line_is_ignored(fake_server, input_dir, tmp_path):
+    out_dir = str(tmp_path / "out")
+    _run(input_dir, out_dir)
+    results_path = os.path.join(out_dir, RESULTS_FILE)
+    with open(results_path, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    torn_filename = json.loads(lines[-1])["filename"]
+    with open(results_path, "w", encoding="utf-8") as f:
+        f.writelines(lines[:-1])
+        f.write(lines[-1][:len(lines[-1]) // 2]) # 模拟写入最后一行时中断
+    assert torn_filename not in load_results(out_dir)
+
+    summary = _run(input_dir, out_dir)
+    assert (summary["completed"], summary["skipped"]) == (1, 3)
+    assert sorted(load_results(out_dir)) == ["f0.txt", "f1.txt", "f2.txt", "sub/f0.txt"]
+
+
+def test_refuses_changed_job_parameters(fake_server, input_dir, tmp_path):
+    out_dir = str(tmp_path / "out")
+    _run(input_dir, out_dir)
+    with pytest.raises(ValueError, match="不同指令"):
+        _run(input_dir, out_dir, instruction="另一条指令")
+    with pytest.raises(ValueError, match="不同指令"):
+        run_job("sk-test", [input_dir], "总结", out_dir, excel_options={"output_format": "tsv"}, log=lambda message: None)
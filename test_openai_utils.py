@@ -0,0 +1,86 @@
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+
+import openai_utils
+from openai_utils import (
+    PRIORITY_BATCH, PRIORITY_INTERACTIVE, _acquire_rate_limit, _get_backoff_seconds, _get_rate_limiter, _new_rate_limiter,
+    _update_rate_limits,
+)
+
+
+def _rate_limit_error(headers):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(429, headers=headers, request=request)
+    return openai.RateLimitError("rate limited", response=response, body=None)
+
+
+def test_backoff_is_capped(monkeypatch):
+    monkeypatch.setattr(openai_utils, "OPENAI_BACKOFF_MAX", 5.0)
+    assert all(0 <= _get_backoff_seconds(10, Exception()) <= 5.0 for _ in range(100))
+
+
+def test_backoff_never_shortens_retry_after(monkeypatch):
+    monkeypatch.setattr(openai_utils, "OPENAI_BACKOFF_MAX", 5.0)
+    assert _get_backoff_seconds(0, _rate_limit_error({"retry-after": "30"})) == 30.0
+    assert _get_backoff_seconds(0, _rate_limit_error({"retry-after-ms": "45000"})) == 45.0
+
+
+@pytest.fixture
+def rate_limiter():
+    rate_limiter = _new_rate_limiter()
+    rate_limiter["requests"]["capacity"] = 60.0
+    rate_limiter["requests"]["rate"] = 0.001 # 测试期间基本不补充额度
+    return rate_limiter
+
+
+def _set_requests_level(rate_limiter, level):
+    with rate_limiter["condition"]:
+        rate_limiter["requests"]["level"] = level
+        rate_limiter["condition"].notify_all()
+
+
+def test_batch_requests_leave_interactive_reserve(rate_limiter):
+    _set_requests_level(rate_limiter, 3) # 低于为对话保留的 10% 额度
+    batch = threading.Thread(target=_acquire_rate_limit, args=(rate_limiter, 10, PRIORITY_BATCH))
+    batch.start()
+    batch.join(0.3)
+    assert batch.is_alive()
+
+    assert _acquire_rate_limit(rate_limiter, 10, PRIORITY_INTERACTIVE) < 0.1
+    _set_requests_level(rate_limiter, 60)
+    batch.join(2)
+    assert not batch.is_alive()
+
+
+def test_waiting_interactive_request_goes_first(rate_limiter):
+    _set_requests_level(rate_limiter, 0)
+    acquired = []
+    def acquire(priority):
+        _acquire_rate_limit(rate_limiter, 10, priority)
+        acquired.append(priority)
+
+    batch = threading.Thread(target=acquire, args=(PRIORITY_BATCH,))
+    batch.start()
+    time.sleep(0.1)
+    interactive = threading.Thread(target=acquire, args=(PRIORITY_INTERACTIVE,))
+    interactive.start()
+    time.sleep(0.1)
+    _set_requests_level(rate_limiter, 60)
+    interactive.join(2)
+    batch.join(2)
+    assert acquired == [PRIORITY_INTERACTIVE, PRIORITY_BATCH]
+
+
+def test_rate_limits_are_per_api_key():
+    limiter_a = _get_rate_limiter("sk-test-per-key-a")
+    limiter_b = _get_rate_limiter("sk-test-per-key-b")
+    assert _get_rate_limiter("sk-test-per-key-a") is limiter_a and limiter_a is not limiter_b
+    capacity_b = dict(limiter_b["requests"])
+    _update_rate_limits(limiter_a, {"x-ratelimit-limit-requests": "30", "x-ratelimit-remaining-requests": "0"})
+    assert limiter_a["requests"]["capacity"] == 30 and limiter_a["requests"]["level"] == 0
+    assert limiter_b["requests"]["capacity"] == capacity_b["capacity"]
+    assert limiter_b["requests"]["level"] >= capacity_b["level"]
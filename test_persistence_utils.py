@@ -0,0 +1,103 @@
+import sqlite3
+
+import pytest
+
+import content_utils
+from batch_utils import build_file_entry
+from content_utils import get_file_content, get_initial_prompt
+from history_utils import PROMPT_TOKENS_KEY, estimate_request_tokens
+from persistence_utils import DETAILS_LOADED_KEY, PERSISTED_INDEX_KEY, load_app_state, load_file_details, save_app_state
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # 避免读取工作目录中的旧版JSON状态文件
+    return str(tmp_path / "state.sqlite3")
+
+
+def _new_state():
+    return {
+        "api_key": "sk-test",
+        "user_general_instruction": "检查术语",
+        "files_data": {
+            "a.txt": build_file_entry("第一份文件，包含术语问题。", "检查术语", "分析：存在术语问题"),
+            "b.txt": build_file_entry("第二份文件 kerning", "检查术语", "分析：正常"),
+        },
+    }
+
+
+def _add_turn(file_entry, question, answer):
+    file_entry["chat_history"].extend([{"role": "user", "content": question}, {"role": "assistant", "content": answer}])
+
+
+def test_round_trip(db_path, monkeypatch):
+    state = _new_state()
+    assert save_app_state(state, db_path)
+    _add_turn(state["files_data"]["a.txt"], "什么是字距调整？", "字距调整是排版概念")
+    assert save_app_state(state, db_path)
+
+    monkeypatch.setattr(content_utils, "_contents", {}) # 模拟新进程：内容库为空
+    loaded = {}
+    assert load_app_state(loaded, db_path)
+    assert loaded["api_key"] == "sk-test"
+    assert loaded["files_data"]["a.txt"] == {"initial_response": "分析：存在术语问题", DETAILS_LOADED_KEY: False}
+
+    file_entry = load_file_details("a.txt", loaded, db_path)
+    assert DETAILS_LOADED_KEY not in file_entry
+    assert get_file_content(file_entry) == "第一份文件，包含术语问题。"
+    assert get_initial_prompt(file_entry) == get_initial_prompt(state["files_data"]["a.txt"])
+    assert file_entry["chat_history"] == state["files_data"]["a.txt"]["chat_history"]
+    assert loaded["files_data"]["b.txt"][DETAILS_LOADED_KEY] is False
+
+
+def test_lazy_entries_are_not_rewritten(db_path):
+    save_app_state(_new_state(), db_path)
+    loaded = {}
+    load_app_state(loaded, db_path)
+    assert save_app_state(loaded, db_path)
+
+    reloaded = {}
+    load_app_state(reloaded, db_path)
+    assert load_file_details("b.txt", reloaded, db_path)["initial_response"] == "分析：正常"
+
+
+def test_delete_file(db_path):
+    state = _new_state()
+    save_app_state(state, db_path)
+    loaded = {}
+    load_app_state(loaded, db_path)
+    del loaded["files_data"]["a.txt"] # 删除尚未加载详情的文件
+    assert save_app_state(loaded, db_path)
+
+    reloaded = {}
+    load_app_state(reloaded, db_path)
+    assert list(reloaded["files_data"]) == ["b.txt"]
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM chat_messages WHERE filename = 'a.txt'").fetchone() == (0,)
+        assert conn.execute("SELECT COUNT(*) FROM contents").fetchone() == (1,)
+
+
+def test_missing_file_row_returns_none(db_path):
+    save_app_state(_new_state(), db_path)
+    loaded = {}
+    load_app_state(loaded, db_path)
+    other_session = {}
+    load_app_state(other_session, db_path)
+    del other_session["files_data"]["a.txt"] # 另一个会话删除了文件
+    save_app_state(other_session, db_path)
+    assert load_file_details("a.txt", loaded, db_path) is None
+    assert load_file_details("missing.txt", loaded, db_path) is None
+
+
+def test_token_estimate_does_not_dirty_file_row(db_path):
+    save_app_state(_new_state(), db_path)
+    loaded = {}
+    load_app_state(loaded, db_path)
+    file_entry = load_file_details("a.txt", loaded, db_path)
+    fingerprint = loaded[PERSISTED_INDEX_KEY]["a.txt"]["file"]
+    estimate_request_tokens(file_entry) # 打开对话时会缓存初始请求的token数
+    assert PROMPT_TOKENS_KEY in file_entry
+    assert save_app_state(loaded, db_path)
+    assert loaded[PERSISTED_INDEX_KEY]["a.txt"]["file"] == fingerprint
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("SELECT extra_json FROM files WHERE filename = 'a.txt'").fetchone()[0] in (None, "{}")
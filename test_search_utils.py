@@ -0,0 +1,114 @@
+import sqlite3
+
+import pytest
+
+from batch_utils import build_file_entry
+from persistence_utils import save_app_state
+from search_utils import (
+    PASSAGE_CHARS, SEARCH_AVAILABLE, index_text, make_snippet, parse_query, remove_documents, search_files, split_passages,
+    tokenize_for_index,
+)
+
+requires_fts5 = pytest.mark.skipif(not SEARCH_AVAILABLE, reason="SQLite 不支持 FTS5")
+
+
+def test_tokenize_splits_cjk_into_bigrams():
+    assert tokenize_for_index("术语问题") == "术语 语问 问题 题"
+
+
+def test_tokenize_keeps_other_words_whole():
+    assert tokenize_for_index("API接口 字 abc foo_bar") == "API 接口 口 字 abc foo_bar"
+
+
+def test_tokenize_drops_punctuation():
+    assert tokenize_for_index("问题，API！") == "问题 题 API"
+
+
+def test_tokenize_empty_text():
+    assert tokenize_for_index("") == ""
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("术语问题", ('"术语 语问 问题"', ["术语问题"])),
+    ("字", ('"字" *', ["字"])),
+    ("API接口 kerning", ('NEAR("API" "接口", 0) AND "kerning"', ["API接口", "kerning"])),
+    ("", (None, [])),
+    ("，。 ()", (None, [])),
+])
+def test_parse_query(query, expected):
+    assert parse_query(query) == expected
+
+
+def test_parse_query_ignores_fts5_syntax():
+    fts_query, keywords = parse_query('"a OR b* NEAR(c)')
+    assert fts_query == '"a" AND "OR" AND "b" AND NEAR("NEAR" "c", 0)'
+    assert keywords == ['"a', "OR", "b*", "NEAR(c)"]
+
+
+def test_split_passages_covers_text_without_gaps():
+    text = "".join(f"第{i}行内容\n" for i in range(500)) + "x" * (PASSAGE_CHARS * 2 + 10)
+    spans = split_passages(text)
+    assert spans[0][0] == 0 and spans[-1][1] == len(text)
+    assert all(end == next_start for (_, end), (next_start, _) in zip(spans, spans[1:]))
+    assert all(end - start <= PASSAGE_CHARS for start, end in spans)
+
+
+def test_split_passages_skips_blank_text():
+    assert split_passages("\n   \n") == []
+
+
+def test_make_snippet_highlights_keywords():
+    text = "前言" * 100 + "这里有一个术语问题需要处理"
+    snippet = make_snippet(text, ["术语问题"])
+    assert snippet.startswith("…")
+    assert "**术语问题**" in snippet
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # 避免读取工作目录中的旧版JSON状态文件
+    return str(tmp_path / "state.sqlite3")
+
+
+def _new_state():
+    return {
+        "files_data": {
+            "a.txt": build_file_entry("第一份文件，包含术语问题。", "检查术语", "分析：存在术语问题"),
+            "b.txt": build_file_entry("第二份文件 kerning", "检查术语", "分析：正常"),
+        },
+    }
+
+
+@requires_fts5
+def test_search_follows_saved_state(db_path):
+    state = _new_state()
+    save_app_state(state, db_path)
+    assert [result["filename"] for result in search_files("术语问题", db_path)] == ["a.txt"]
+
+    state["files_data"]["b.txt"]["chat_history"].extend(
+        [{"role": "user", "content": "请解释字距"}, {"role": "assistant", "content": "字距调整是排版概念"}]
+    )
+    save_app_state(state, db_path)
+    results = search_files("字距调整", db_path)
+    assert [result["filename"] for result in results] == ["b.txt"]
+    assert results[0]["hits"] == [{"source": "message", "seq": 3, "snippet": "**字距调整**是排版概念"}]
+
+    del state["files_data"]["a.txt"]
+    save_app_state(state, db_path)
+    assert search_files("术语问题", db_path) == []
+    assert [result["filename"] for result in search_files("kerning", db_path)] == ["b.txt"]
+
+
+@requires_fts5
+def test_stale_terms_never_match_new_passages(db_path):
+    save_app_state(_new_state(), db_path)
+    with sqlite3.connect(db_path) as conn:
+        index_text(conn, "message", "b.txt", 9, "孤立的旧消息")
+        # 原文在移除索引之前就已不存在：无内容的索引无法删除其词项，只能删除片段记录
+        remove_documents(conn, "message", "b.txt")
+        conn.execute(
+            "INSERT INTO chat_messages (filename, seq, role, content) VALUES ('b.txt', 9, 'user', '新的消息')"
+        )
+        index_text(conn, "message", "b.txt", 9, "新的消息")
+    assert search_files("孤立", db_path) == []
+    assert [result["filename"] for result in search_files("新的消息", db_path)] == ["b.txt"]